@@ -0,0 +1,247 @@
+"""
+Benchmarks for the pro forma and developer models on synthetic parcels, so
+performance can be tracked without a full REMM / orca environment.  Run as a
+module, e.g.::
+
+    python -m urbansim.developer.benchmark --sizes 10000 100000 1000000 \\
+        --output benchmark.json
+
+Each stage is timed (wall and cpu time) and its peak memory is measured with
+tracemalloc, and the results are written as json or csv (by the extension of
+the output file) with one record per stage, size and repeat.
+
+"""
+from __future__ import print_function
+from __future__ import division
+
+import argparse
+import copy
+import json
+import platform
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+from . import sqftproforma, developer
+
+STAGES = ["lookup_table", "lookup_grid", "lookup_envelope", "lookup_fused",
+          "lookup_forms", "lookup_top_forms", "pick", "pick_keys"]
+
+
+def synthetic_parcels(n, seed=0, uses=None):
+    """
+    Generate a synthetic parcel frame with the columns the pro forma lookup
+    needs.  Parcels get a location factor which drives both rents and land
+    cost, so the distributions are skewed and correlated like real parcel
+    data rather than independent uniform noise.
+
+    Parameters
+    ----------
+    n : int
+        The number of parcels
+    seed : int
+        The random seed - the same seed always gives the same parcels
+    uses : list of strings, optional
+        The uses to generate yearly rents per sqft for - defaults to the uses
+        of the default pro forma configuration
+
+    Returns
+    -------
+    parcels : dataframe
+        Indexed by parcel_id, with parcel_size, land_cost, max_far,
+        max_height, max_dua, ave_unit_size and a rent column for each use
+
+    """
+    if uses is None:
+        uses = sqftproforma.SqFtProFormaConfig().uses
+    rng = np.random.RandomState(seed)
+
+    df = pd.DataFrame(index=pd.Index(np.arange(1, n + 1), name="parcel_id"))
+    location = rng.normal(0, 1, n)
+
+    # most parcels are a few thousand sqft with a long tail of large ones
+    df["parcel_size"] = np.exp(rng.normal(9.4, 1.1, n))
+
+    # zoning - a mix of unzoned (nan) parcels and typical zoning categories
+    df["max_far"] = rng.choice([np.nan, .5, 1.0, 2.0, 3.0, 5.0, 10.0], n,
+                               p=[.1, .25, .25, .15, .1, .1, .05])
+    df["max_height"] = rng.choice([np.nan, 20, 35, 45, 60, 100, 200], n,
+                                  p=[.1, .2, .3, .15, .1, .1, .05])
+    df["max_dua"] = rng.choice([np.nan, 4, 8, 15, 30, 60, 120], n,
+                               p=[.3, .2, .15, .15, .1, .05, .05])
+    df["ave_unit_size"] = np.clip(rng.normal(1200, 250, n), 500, None)
+
+    # yearly rents per sqft, higher in better locations
+    rents = {"retail": 24.0, "industrial": 10.0, "office": 26.0,
+             "residential": 20.0}
+    for use in uses:
+        df[use] = rents.get(use, 20.0) * np.exp(.25 * location +
+                                                rng.normal(0, .2, n))
+
+    # land is worth more per sqft in better locations
+    df["land_cost"] = df.parcel_size * np.exp(
+        2.5 + .6 * location + rng.normal(0, .5, n))
+
+    return df
+
+
+class _Measure(object):
+    """
+    Measure the wall time, cpu time and peak traced memory of a block
+    """
+
+    def __init__(self, memory=True):
+        self.memory = memory
+
+    def __enter__(self):
+        if self.memory:
+            tracemalloc.start()
+        self._wall = time.perf_counter()
+        self._cpu = time.process_time()
+        return self
+
+    def __exit__(self, *args):
+        self.wall = time.perf_counter() - self._wall
+        self.cpu = time.process_time() - self._cpu
+        self.peak = None
+        if self.memory:
+            self.peak = tracemalloc.get_traced_memory()[1] / 1e6
+            tracemalloc.stop()
+
+
+def _run_stage(stage, pf, df, chunksize, n_jobs):
+    """
+    Run a single stage and return the number of output rows
+    """
+    forms = sorted(pf.config.forms)
+
+    if stage == "lookup_table":
+        # generate the table on a copy so the cached table isn't replaced
+        copy.copy(pf)._generate_lookup()
+        return len(pf.lookup_forms_order)
+    if stage in ["lookup_grid", "lookup_envelope", "lookup_fused"]:
+        engine = stage.split("_")[1]
+        return sum(len(pf.lookup(form, df, chunksize=chunksize,
+                                 engine=engine)) for form in forms)
+    if stage == "lookup_forms":
+        d = pf.lookup_forms(forms, df, chunksize=chunksize, n_jobs=n_jobs)
+        return len(pd.concat(d.values(), keys=d.keys(), axis=1))
+    if stage == "lookup_top_forms":
+        return len(pf.lookup_top_forms(forms, df, k=1, chunksize=chunksize))
+    if stage in ["pick", "pick_keys"]:
+        sampler = "keys" if stage == "pick_keys" else "choice"
+        dev = developer.Developer(pf.lookup_forms(forms, df,
+                                                  chunksize=chunksize))
+        np.random.seed(0)
+        new_buildings = dev.pick(
+            ["residential", "mixedresidential"], len(df) // 10,
+            df.parcel_size, df.ave_unit_size.copy(),
+            pd.Series(0, index=df.index), sampler=sampler)
+        return 0 if new_buildings is None else len(new_buildings)
+    raise ValueError("Unknown benchmark stage: %s" % stage)
+
+
+def run_benchmarks(sizes, stages=None, repeat=1, chunksize=None, n_jobs=1,
+                   memory=True, seed=0, config=None):
+    """
+    Run the benchmark stages on synthetic parcels of each size
+
+    Parameters
+    ----------
+    sizes : list of ints
+        The numbers of parcels to benchmark
+    stages : list of strings, optional
+        The stages to run - defaults to all of STAGES
+    repeat : int
+        The number of times each stage is run for each size
+    chunksize : int, optional
+        Passed directly to the pro forma lookups
+    n_jobs : int
+        Passed directly to `SqFtProForma.lookup_forms`
+    memory : bool
+        Whether to trace peak memory - tracing slows down stages which make
+        many small python allocations
+    seed : int
+        The seed for the synthetic parcels
+    config : `SqFtProFormaConfig`, optional
+        The pro forma configuration - defaults to the default configuration
+
+    Returns
+    -------
+    results : list of dicts
+        One record per stage, size and repeat with the wall and cpu time in
+        seconds and the peak traced memory in megabytes (None if memory
+        isn't traced)
+
+    """
+    stages = stages or STAGES
+    pf = sqftproforma.SqFtProForma(config)
+
+    results = []
+    for size in sizes:
+        df = synthetic_parcels(size, seed=seed, uses=pf.config.uses)
+        for stage in stages:
+            for i in range(repeat):
+                with _Measure(memory) as m:
+                    out_rows = _run_stage(stage, pf, df, chunksize, n_jobs)
+                results.append({
+                    "stage": stage,
+                    "rows": size,
+                    "repeat": i,
+                    "wall_seconds": m.wall,
+                    "cpu_seconds": m.cpu,
+                    "peak_memory_mb": m.peak,
+                    "output_rows": out_rows,
+                    "chunksize": chunksize,
+                    "n_jobs": n_jobs,
+                    "python": platform.python_version(),
+                    "numpy": np.__version__,
+                    "pandas": pd.__version__
+                })
+                print("{:>18} {:>10,} rows  {:8.3f}s wall  {:8.3f}s cpu  "
+                      "{:>12} peak".format(
+                          stage, size, m.wall, m.cpu,
+                          "-" if m.peak is None else "%.1fMB" % m.peak))
+    return results
+
+
+def write_results(results, path):
+    """
+    Write benchmark results as csv if the path ends in .csv and as json
+    otherwise
+    """
+    if path.endswith(".csv"):
+        pd.DataFrame(results).to_csv(path, index=False)
+    else:
+        with open(path, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark the pro forma and developer models on "
+                    "synthetic parcels")
+    parser.add_argument("--sizes", type=int, nargs="+",
+                        default=[10000, 100000, 1000000])
+    parser.add_argument("--stages", nargs="+", choices=STAGES, default=STAGES)
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--chunksize", type=int, default=100000)
+    parser.add_argument("--n-jobs", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--no-memory", action="store_true",
+                        help="don't trace peak memory")
+    parser.add_argument("--output", default="benchmark.json",
+                        help="a .json or .csv file for the results")
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(args.sizes, args.stages, repeat=args.repeat,
+                             chunksize=args.chunksize, n_jobs=args.n_jobs,
+                             memory=not args.no_memory, seed=args.seed)
+    write_results(results, args.output)
+    print("Wrote {} results to {}".format(len(results), args.output))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,197 @@
+from __future__ import division
+
+import numpy as np
+import pandas as pd
+
+
+class BuildingIdAllocator(object):
+    """
+    Hands out building ids which always increase, so the id of a building
+    which is removed is never given to a new building (which can happen when
+    new ids start after the largest id of the current buildings and the
+    building with the largest id is redeveloped).
+
+    Parameters
+    ----------
+    next_id : int
+        The id of the next building
+
+    """
+
+    def __init__(self, next_id=0):
+        self.next_id = int(next_id)
+
+    @classmethod
+    def from_index(cls, index):
+        """
+        An allocator which starts after the largest id of an index of
+        buildings
+        """
+        return cls(np.max(index.values) + 1 if len(index) > 0 else 0)
+
+    def skip_past(self, index):
+        """
+        Make sure the next id is after the largest id of an index of
+        buildings - e.g. buildings which were added with ids from somewhere
+        else
+        """
+        if len(index) > 0:
+            self.next_id = max(self.next_id, int(np.max(index.values)) + 1)
+
+    def allocate(self, n):
+        """
+        The ids of n new buildings
+        """
+        ids = np.arange(self.next_id, self.next_id + n)
+        self.next_id += n
+        return ids
+
+
+class BuildingStore(object):
+    """
+    Applies the changes the developer makes to the buildings table in a year
+    - removing the buildings on redeveloped parcels and adding new buildings,
+    which get their ids from a `BuildingIdAllocator` so the ids of removed
+    buildings are never reused - and puts the changed table together with a
+    single concat in `to_frame`.
+
+    The store doesn't keep a copy of the buildings which could go stale:
+    other models update the buildings table in place (e.g. with
+    update_col_from_series), so `sync` the store with the current table
+    before the changes of each year.  The table passed to the store is
+    never modified - removed buildings are masked and new buildings are
+    kept aside until `to_frame`.
+
+    Finding the buildings on parcels and putting the table together both
+    take time in the number of buildings, so a year costs about as much as
+    `Developer.merge` - what the store adds is that building ids are never
+    reused and that the local columns aren't copied out of the table first.
+
+    Parameters
+    ----------
+    df : dataframe
+        The current buildings, indexed by building id, with a parcel_id
+        column for `remove_parcels`
+    id_allocator : `BuildingIdAllocator`, optional
+        Gives the ids of new buildings - defaults to an allocator which
+        starts after the largest id in df
+
+    """
+
+    def __init__(self, df, id_allocator=None):
+        if id_allocator is None:
+            id_allocator = BuildingIdAllocator.from_index(df.index)
+        self.id_allocator = id_allocator
+        self.sync(df)
+
+    def sync(self, df):
+        """
+        Start from the current buildings table, e.g. the local frame of the
+        orca table - changes which haven't been put together by `to_frame`
+        are discarded.  New buildings get ids after the largest id in df, in
+        case other models added buildings with their own ids.
+        """
+        self.id_allocator.skip_past(df.index)
+        self.columns = list(df.columns)
+        self._frames = [df]
+        # a boolean mask of the buildings of each frame which haven't been
+        # removed, or None if none have
+        self._alive = [None]
+        self._frame = df
+
+    def __len__(self):
+        return sum(len(df) if alive is None else int(alive.sum())
+                   for df, alive in zip(self._frames, self._alive))
+
+    def append(self, new_df):
+        """
+        Add new buildings with new building ids
+
+        Parameters
+        ----------
+        new_df : dataframe
+            The new buildings, which have at least the columns of the store -
+            the index is ignored
+
+        Returns
+        -------
+        index : pd.Index
+            The building ids of the new buildings, in order
+        """
+        df = new_df[self.columns].copy()
+        df.index = pd.Index(self.id_allocator.allocate(len(df)),
+                            name="building_id")
+        if len(df) > 0:
+            self._frames.append(df)
+            self._alive.append(None)
+            self._frame = None
+        return df.index
+
+    def _remove(self, masks):
+        removed = []
+        for i, (df, mask) in enumerate(zip(self._frames, masks)):
+            alive = self._alive[i]
+            if alive is not None:
+                mask = mask & alive
+            if not mask.any():
+                continue
+            removed.append(df[mask])
+            self._alive[i] = ~mask if alive is None else alive & ~mask
+            self._frame = None
+        if len(removed) == 0:
+            return pd.DataFrame(columns=self.columns,
+                                index=pd.Index([], name="building_id"))
+        return pd.concat(removed)
+
+    def remove(self, building_ids):
+        """
+        Remove buildings
+
+        Parameters
+        ----------
+        building_ids : array_like
+            The ids of the buildings to remove - ids which aren't in the
+            store (or were removed already) are ignored
+
+        Returns
+        -------
+        removed : dataframe
+            The buildings which were removed
+        """
+        return self._remove([df.index.isin(building_ids)
+                             for df in self._frames])
+
+    def remove_parcels(self, parcel_ids):
+        """
+        Remove the buildings on parcels - e.g. the parcels which are
+        redeveloped
+
+        Parameters
+        ----------
+        parcel_ids : array_like
+            The ids of the parcels
+
+        Returns
+        -------
+        removed : dataframe
+            The buildings which were removed
+        """
+        assert "parcel_id" in self.columns, \
+            "Buildings need a parcel_id column to remove parcels"
+        return self._remove([df.parcel_id.isin(parcel_ids).values
+                             for df in self._frames])
+
+    def to_frame(self):
+        """
+        The buildings as a single dataframe indexed by building id, with
+        the synced buildings in their order followed by new buildings in the
+        order they were added.  If there are changes this is a new frame,
+        which the store then starts from, as if it was synced with it.
+        """
+        if self._frame is None:
+            frames = [df if alive is None else df[alive]
+                      for df, alive in zip(self._frames, self._alive)]
+            df = pd.concat(frames, verify_integrity=True)
+            df.index.name = "building_id"
+            self.sync(df)
+        return self._frame
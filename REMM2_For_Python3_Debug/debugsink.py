@@ -0,0 +1,193 @@
+from __future__ import division
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+
+OFF = "off"
+SAMPLED = "sampled"
+FULL = "full"
+
+LEVELS = [OFF, SAMPLED, FULL]
+
+EXTENSIONS = {
+    "csv": ".csv",
+    "parquet": ".parquet",
+    "feather": ".feather",
+    "pickle": ".pkl"
+}
+
+
+class DebugSink(object):
+    """
+    A destination for the intermediate tables that the pro forma, developer
+    and REMM utilities dump for debugging.  Writing these tables every
+    simulation year is expensive, so by default nothing is written.
+
+    Parameters
+    ----------
+    level : string
+        One of "off" (the default - nothing is written), "sampled" (a random
+        sample of at most sample_size rows of each table is written) or
+        "full" (every table is written in full).
+    out_dir : string
+        The directory to write the tables to.  Will be created if it does
+        not exist.
+    fmt : string
+        The file format - one of "csv", "parquet", "feather" or "pickle".
+        Parquet and feather are columnar binary formats which are much
+        faster to write than csv but require pyarrow to be installed.
+    sample_size : int
+        The maximum number of rows written per table when level is "sampled"
+    asynchronous : bool
+        If true, tables are written on a background thread so the simulation
+        does not wait for the disk.  Call flush() to wait for pending writes.
+    random_state : int
+        The seed used to sample rows so sampled output is reproducible
+
+    """
+
+    def __init__(self, level=OFF, out_dir=".", fmt="csv", sample_size=1000,
+                 asynchronous=True, random_state=0):
+        assert level in LEVELS, "level must be one of %s" % LEVELS
+        assert fmt in EXTENSIONS, "fmt must be one of %s" % list(EXTENSIONS)
+        self.level = level
+        self.out_dir = out_dir
+        self.fmt = fmt
+        self.sample_size = sample_size
+        self.asynchronous = asynchronous
+        self.random_state = random_state
+        self._executor = None
+        self._pending = []
+
+    @property
+    def enabled(self):
+        """
+        Whether this sink writes anything - callers can check this to avoid
+        building a table which would only be written for debugging
+        """
+        return self.level != OFF
+
+    def path(self, name):
+        return os.path.join(self.out_dir, name + EXTENSIONS[self.fmt])
+
+    def write(self, name, df):
+        """
+        Write a table to the sink
+
+        Parameters
+        ----------
+        name : string
+            The name of the table, used as the file name without extension
+        df : DataFrame or Series
+            The table to write.  It is copied (or sampled) before this method
+            returns, so the caller is free to modify it afterwards.
+
+        Returns
+        -------
+        Nothing
+        """
+        if not self.enabled or df is None:
+            return
+
+        if self.level == SAMPLED and len(df) > self.sample_size:
+            df = df.sample(n=self.sample_size, random_state=self.random_state)
+        else:
+            df = df.copy()
+
+        if not self.asynchronous:
+            self._write(df, self.path(name))
+            return
+
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=1)
+        self._pending.append(
+            self._executor.submit(self._write, df, self.path(name)))
+
+    def _write(self, df, path):
+        if not os.path.exists(self.out_dir):
+            os.makedirs(self.out_dir)
+
+        if self.fmt == "csv":
+            df.to_csv(path)
+            return
+        if self.fmt == "pickle":
+            df.to_pickle(path)
+            return
+
+        # the binary columnar formats want a frame with flat string columns
+        if isinstance(df, pd.Series):
+            df = df.to_frame()
+        if isinstance(df.columns, pd.MultiIndex):
+            df = df.copy()
+            df.columns = [".".join(str(x) for x in col) for col in df.columns]
+        df = df.reset_index()
+        df.columns = [str(col) for col in df.columns]
+
+        if self.fmt == "parquet":
+            df.to_parquet(path)
+        else:
+            df.to_feather(path)
+
+    def flush(self):
+        """
+        Wait for all pending writes to finish - raises the first error
+        encountered by a pending write
+        """
+        pending, self._pending = self._pending, []
+        for future in pending:
+            future.result()
+
+    def settings(self):
+        """
+        The arguments to create a sink which writes the same tables to the
+        same place - e.g. in a worker process, where tables are written
+        synchronously so no write is lost when the worker exits
+        """
+        return dict(level=self.level, out_dir=self.out_dir, fmt=self.fmt,
+                    sample_size=self.sample_size, asynchronous=False,
+                    random_state=self.random_state)
+
+    def close(self):
+        """
+        Flush pending writes and stop the background thread
+        """
+        self.flush()
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+
+_debug_sink = DebugSink()
+
+
+def get_debug_sink():
+    """
+    Get the debug sink used by the pro forma, developer and REMM utilities.
+    By default this is a sink with level "off".
+    """
+    return _debug_sink
+
+
+def set_debug_sink(sink):
+    """
+    Set the debug sink used by the pro forma, developer and REMM utilities.
+    Pending writes on the previous sink are flushed.
+
+    Parameters
+    ----------
+    sink : DebugSink
+        The new sink - pass DebugSink(level="full") to get all the debug
+        tables which used to be written unconditionally
+
+    Returns
+    -------
+    previous : DebugSink
+        The sink which was replaced
+    """
+    global _debug_sink
+    previous = _debug_sink
+    previous.flush()
+    _debug_sink = sink
+    return previous
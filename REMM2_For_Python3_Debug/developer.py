@@ -4,21 +4,113 @@ from __future__ import division
 import pandas as pd
 import numpy as np
 
+from . import debugsink
+from .feasibility import FeasibilityStore
+
 
 class Developer(object):
     """
     Pass the dataframe that is returned by feasibility here
 
     Can also be a dictionary where keys are building forms and values are
-    the individual data frames returned by the proforma lookup routine.
+    the individual data frames returned by the proforma lookup routine, a
+    `FeasibilityStore`, or a long frame with a row per parcel and form and a
+    form column (e.g. the frame returned by `SqFtProForma.lookup_top_forms`)
+    which is turned into a `FeasibilityStore`.
+
+    The feasibility isn't modified when parcels are built on - the developer
+    keeps a mask of the parcels which are still available and the
+    feasibility attribute is the feasibility of the available parcels.
 
     """
 
     def __init__(self, feasibility):
         if isinstance(feasibility, dict):
             feasibility = pd.concat(feasibility.values(), keys=feasibility.keys(), axis=1)
+        elif isinstance(feasibility, pd.DataFrame) and \
+                "form" in feasibility.columns and \
+                not isinstance(feasibility.columns, pd.MultiIndex):
+            feasibility = FeasibilityStore(feasibility)
         self.feasibility = feasibility
 
+    @property
+    def feasibility(self):
+        """
+        The feasibility of the parcels which haven't been built on - the
+        feasibility passed to the developer if no parcels have been built on
+        and a filtered copy otherwise
+        """
+        if self._num_built == 0:
+            return self._feasibility
+        return self._where(self._feasibility, self._row_mask())
+
+    @feasibility.setter
+    def feasibility(self, feasibility):
+        self._feasibility = feasibility
+        f = feasibility.to_frame() if \
+            isinstance(feasibility, FeasibilityStore) else feasibility
+        # the position of each row's parcel in the availability mask
+        self._codes, self._parcels = pd.factorize(f.index)
+        self._available = np.ones(len(self._parcels), dtype="bool")
+        self._num_built = 0
+
+    def __len__(self):
+        """
+        The number of rows of the feasibility of the available parcels -
+        without filtering the feasibility
+        """
+        if self._num_built == 0:
+            return len(self._feasibility)
+        return int(np.count_nonzero(self._row_mask()))
+
+    def _row_mask(self, rows=slice(None)):
+        """
+        Whether the parcels of the rows of the feasibility are available
+        """
+        return self._available[self._codes[rows]]
+
+    @staticmethod
+    def _where(f, mask):
+        if isinstance(f, FeasibilityStore):
+            return f.where(mask)
+        return f[mask]
+
+    def _form_feasibility(self, form):
+        """
+        The feasibility of the available parcels for a single form, without
+        filtering the feasibility of the other forms
+        """
+        f = self._feasibility
+        df = f[form]
+        if self._num_built == 0:
+            return df
+        if isinstance(f, FeasibilityStore):
+            i = f.forms.index(form)
+            rows = slice(f._offsets[i], f._offsets[i + 1])
+        else:
+            rows = slice(None)
+        return df[self._row_mask(rows)]
+
+    def _build(self, parcel_ids):
+        """
+        Mark parcels as built on so they're no longer available
+        """
+        i = self._parcels.get_indexer(parcel_ids)
+        i = i[i >= 0]
+        self._num_built += np.count_nonzero(self._available[i])
+        self._available[i] = False
+
+    def feasibility_frame(self):
+        """
+        The feasibility of the available parcels as a dataframe - the long
+        frame if the feasibility is a `FeasibilityStore` and the wide frame
+        otherwise
+        """
+        f = self.feasibility
+        if isinstance(f, FeasibilityStore):
+            return f.to_frame()
+        return f
+
     @staticmethod
     def _max_form(f, colname):
         """
@@ -39,9 +131,40 @@ class Developer(object):
                           max_profit
                           max_profit_far
                           total_cost
+
+        Returns a series indexed by the parcels which have a value of colname
+        for at least one form, where values are the form with the largest
+        value - nans are skipped and ties go to the first form in sorted
+        order.  Parcels are in the order of the stack / unstack version of
+        this method, which pick samples by: sorted if every parcel has a
+        value and in the order of f otherwise.
         """
-        df = f.stack(level=0)[[colname]].stack().unstack(level=1).reset_index(level=1, drop=True)
-        return df.idxmax(axis=1)
+        forms, values = Developer._form_block(f, colname)
+        values = values.astype("float")
+        valid = ~np.isnan(values)
+        has_value = valid.any(axis=1)
+        values, valid = values[has_value], valid[has_value]
+
+        best = np.argmax(np.where(valid, values, -np.inf), axis=1)
+        # a row whose values are all -inf picks its first non-nan form
+        all_inf = values[np.arange(len(best)), best] == -np.inf
+        best[all_inf] = np.argmax(valid[all_inf], axis=1)
+
+        mu = pd.Series(np.array(forms, dtype="object")[best],
+                       index=f.index[has_value])
+        if has_value.all():
+            mu = mu.sort_index(kind="mergesort")
+        return mu
+
+    @staticmethod
+    def _form_block(f, colname):
+        """
+        The colname column of every form as a (parcels, forms) array, with
+        forms in sorted order and nans for forms without the column
+        """
+        forms = sorted(f.columns.get_level_values(0).unique())
+        block = f.xs(colname, axis=1, level=1, drop_level=True)
+        return forms, block.reindex(columns=forms).values
 
     def keep_form_with_max_profit(self, forms=None):
         """
@@ -59,20 +182,41 @@ class Developer(object):
         Nothing.  Goes from a multi-index to a single index with only the
         most profitable form.
         """
-        f = self.feasibility
+        # parcels are independent so the max profit form is found for all
+        # parcels and the parcels which aren't available are filtered after
+        f = self._feasibility
+
+        if isinstance(f, FeasibilityStore):
+            return self._available_parcels(f.max_profit_form(forms).copy())
 
         if forms is not None:
             f = f[forms]
 
-        if len(f) > 0:
-            mu = self._max_form(f, "max_profit")
-            indexes = [tuple(x) for x in mu.reset_index().values]
-        else:
-            indexes = []
-        df = f.stack(level=0).loc[indexes]
-        df.index.names = ["parcel_id", "form"]
-        df = df.reset_index(level=1)
-        return df
+        mu = self._max_form(f, "max_profit")
+        rows = f.index.get_indexer(mu.index)
+        forms = sorted(f.columns.get_level_values(0).unique())
+        cols = pd.Index(forms).get_indexer(mu.values)
+
+        # gather the columns of the winning form on each parcel - sorted as
+        # stack sorts them, unless there's a single form to stack
+        colnames = f.columns.get_level_values(1).unique()
+        if len(forms) > 1:
+            colnames = sorted(colnames)
+        df = pd.DataFrame({"form": mu.values}, index=mu.index)
+        for colname in colnames:
+            values = self._form_block(f, colname)[1]
+            df[colname] = values[rows, cols]
+        df.index.name = "parcel_id"
+        return self._available_parcels(df)
+
+    def _available_parcels(self, df):
+        """
+        The rows of a frame indexed by parcel id for the available parcels
+        """
+        if self._num_built == 0:
+            return df
+        i = self._parcels.get_indexer(df.index)
+        return df[(i >= 0) & self._available[i]]
 
     @staticmethod
     def compute_units_to_build(num_agents, num_units, target_vacancy):
@@ -106,7 +250,7 @@ class Developer(object):
     def pick(self, form, target_units, parcel_size, ave_unit_size,
              current_units, max_parcel_size=200000, min_unit_size=400,
              drop_after_build=True, residential=True, bldg_sqft_per_job=400.0,
-             profit_to_prob_func=None):
+             profit_to_prob_func=None, sampler="choice", seed=None):
         """
         Choose the buildings from the list that are feasible to build in
         order to match the specified demand.
@@ -156,6 +300,23 @@ class Developer(object):
             a function which takes the feasibility dataframe and returns
             a series of probabilities.  If no function is passed, the behavior
             of this method will not change
+        sampler : string, optional
+            How the buildings are sampled (without replacement, weighted by
+            the probabilities).  "choice" (the default) draws as many
+            buildings as there are target units with np.random.choice.
+            "keys" gives each building a random exponential key divided by
+            its probability and builds in order of the smallest keys
+            (Efraimidis-Spirakis sampling), only ordering as many buildings
+            as are needed to reach the target units - use it when there are
+            many feasible buildings and a large target.  The two samplers
+            draw from the same distribution but give different buildings for
+            the same seed.
+        seed : int or np.random.RandomState, optional
+            The random state of the "keys" sampler - defaults to numpy's
+            global random state, as used by the "choice" sampler.  An int
+            creates a new random state, so pass a random state (or a
+            different seed) to get different draws from calls which
+            should be independent
 
         Returns
         -------
@@ -164,18 +325,21 @@ class Developer(object):
             DataFrame of buildings to add.  These buildings are rows from the
             DataFrame that is returned from feasibility.
         """
-        if residential:
-            self.feasibility.to_csv("debug_feasibility_168.csv")
-        if len(self.feasibility) == 0:
+        debug_sink = debugsink.get_debug_sink()
+        if residential and debug_sink.enabled:
+            # the frame of the available parcels is a copy once parcels are
+            # built on, so it's only built if it will be written
+            debug_sink.write("debug_feasibility_168", self.feasibility_frame())
+        if len(self) == 0:
             # no feasible buildings, might as well bail
             return
 
         if form is None:
-            df = self.feasibility
+            df = self.feasibility_frame()
         elif isinstance(form, list):
             df = self.keep_form_with_max_profit(form)
         else:
-            df = self.feasibility[form]
+            df = self._form_feasibility(form)
 
         # feasible buildings only for this building type
         df = df[df.max_profit > 0]
@@ -190,7 +354,7 @@ class Developer(object):
         
         if residential:
             df['net_units'] = df.residential_units - df.current_units
-            df.to_csv("debug_developer_193.csv")
+            debug_sink.write("debug_developer_193", df)
         else:
             df['net_units'] = df.job_spaces - df.current_units
         df = df[df.net_units > 0]
@@ -215,7 +379,12 @@ class Developer(object):
             build_idx = df.index.values
         elif target_units <= 0:
             build_idx = []
+        elif sampler == "keys":
+            build_idx = df.index.values[self._sample_keys(
+                np.asarray(p, dtype="float"), df.net_units.values,
+                target_units, seed)]
         else:
+            assert sampler == "choice", "Unknown sampler: %s" % sampler
             # we don't know how many developments we will need, as they differ in net_units.
             # If all developments have net_units of 1 than we need target_units of them.
             # So we choose the smaller of available developments and target_units.
@@ -226,14 +395,114 @@ class Developer(object):
             build_idx = choices[:ind]
 
         if drop_after_build:
-            self.feasibility = self.feasibility.drop(build_idx)
+            self._build(build_idx)
 
         new_df = df.loc[build_idx]
         new_df.index.name = "parcel_id"
         return new_df.reset_index()
 
+    def pick_demands(self, demands, parcel_size, ave_unit_size, **kwargs):
+        """
+        Choose the buildings to meet several demands - e.g. residential units
+        and job spaces for groups of non-residential forms - against the
+        same feasibility, so the demands compete for parcels without
+        rebuilding the feasibility for each one.  Demands are met in order:
+        a parcel which is built on to meet a demand is dropped before the
+        next demand is picked (unless drop_after_build is False).
+
+        Parameters
+        ----------
+        demands : dict
+            Keys are names of the demands and values are dictionaries of the
+            arguments of `pick` for the demand, which must include form,
+            target_units and current_units - e.g.::
+
+                {"residential": {"form": ["residential"],
+                                 "target_units": 1000,
+                                 "current_units": residential_units},
+                 "office": {"form": ["office"],
+                            "target_units": 4000,
+                            "current_units": job_spaces,
+                            "residential": False}}
+        parcel_size : series
+            Passed directly to `pick`
+        ave_unit_size : series
+            Passed directly to `pick`
+        **kwargs
+            Other arguments of `pick` which are shared by all demands - the
+            arguments of a demand take precedence.  An int seed creates a
+            single random state which is shared by the demands, so each
+            demand gets different draws.
+
+        Returns
+        -------
+        new_buildings : dict
+            Keys are the names of the demands and values are the buildings
+            returned by `pick` for the demand, which are None if there were
+            no feasible buildings
+        """
+        seed = kwargs.get("seed")
+        if seed is not None and not isinstance(seed, np.random.RandomState):
+            kwargs["seed"] = np.random.RandomState(seed)
+
+        new_buildings = {}
+        for name, demand in demands.items():
+            args = dict(kwargs, **demand)
+            for arg in ["form", "target_units", "current_units"]:
+                assert arg in args, \
+                    "Demand %s doesn't have a %s" % (name, arg)
+            print("Picking buildings for {}".format(name))
+            new_buildings[name] = self.pick(
+                args.pop("form"), args.pop("target_units"), parcel_size,
+                ave_unit_size, args.pop("current_units"), **args)
+        return new_buildings
+
     @staticmethod
-    def merge(old_df, new_df, return_index=False):
+    def _sample_keys(p, net_units, target_units, seed=None):
+        """
+        Weighted sampling without replacement with exponential keys
+        (Efraimidis-Spirakis) - the positions of the buildings to build, in
+        the order they were sampled, up to and including the building where
+        the cumulative net units reach target_units.  As with
+        np.random.choice, buildings with a probability of zero are never
+        sampled, so fewer buildings than needed to reach target_units are
+        returned if the others don't have enough net units.
+        """
+        if seed is None:
+            rng = np.random
+        elif isinstance(seed, np.random.RandomState):
+            rng = seed
+        else:
+            rng = np.random.RandomState(seed)
+
+        candidates = np.flatnonzero(p > 0)
+        n = len(candidates)
+        if n == 0:
+            return candidates
+        # the smallest exponential / p keys are a weighted sample without
+        # replacement
+        keys = rng.standard_exponential(n) / p[candidates]
+        net_units = net_units[candidates]
+
+        # only sort as many keys as are likely to be needed to reach the
+        # target, doubling the number until the target is reached
+        m = min(n, max(1, int(np.ceil(target_units / net_units.mean()))))
+        while True:
+            if m < n:
+                top = np.argpartition(keys, m - 1)[:m]
+            else:
+                top = np.arange(n)
+            top = top[np.argsort(keys[top], kind="mergesort")]
+            tot_units = net_units[top].cumsum()
+            if tot_units[-1] >= target_units or m == n:
+                break
+            m = min(n, 2 * m)
+
+        ind = int(np.searchsorted(tot_units, target_units, side="left")) + 1
+        return candidates[top[:ind]]
+
+    @staticmethod
+    def merge(old_df, new_df, return_index=False, id_allocator=None):
         """
         Merge two dataframes of buildings.  The old dataframe is
         usually the buildings dataset and the new dataframe is a modified
@@ -249,6 +518,11 @@ class Developer(object):
             If return_index is true, this method will return the new
             index of new_df (which changes in order to create a unique
             index after the merge)
+        id_allocator : `buildings.BuildingIdAllocator`, optional
+            Gives the ids of the new buildings, which are always after the
+            largest id in old_df - by default the ids start right after the
+            largest id in old_df, which reuses the ids of removed
+            buildings if the buildings with the largest ids were removed
 
         Returns
         -------
@@ -259,9 +533,13 @@ class Developer(object):
             new_df dataframe (which changes in order to create a unique index
             after the merge)
         """
-        maxind = np.max(old_df.index.values)
         new_df = new_df.reset_index(drop=True)
-        new_df.index = new_df.index + maxind + 1
+        if id_allocator is not None:
+            id_allocator.skip_past(old_df.index)
+            new_df.index = id_allocator.allocate(len(new_df))
+        else:
+            maxind = np.max(old_df.index.values)
+            new_df.index = new_df.index + maxind + 1
         concat_df = pd.concat([old_df, new_df], verify_integrity=True)
         concat_df.index.name = 'building_id'
 
@@ -0,0 +1,201 @@
+from __future__ import division
+
+import numpy as np
+import pandas as pd
+
+
+class FeasibilityStore(object):
+    """
+    Feasibility in long form - one row for each parcel and form which is
+    feasible on the parcel, instead of the wide frame with a column level per
+    form which is mostly nan because each form is feasible on only some of
+    the parcels.  Rows are kept sorted by form so the feasibility of a single
+    form is a contiguous block.
+
+    Parameters
+    ----------
+    df : dataframe
+        A frame indexed by parcel id with a form column and the columns
+        returned by the pro forma lookup, e.g. the frame returned by
+        `SqFtProForma.lookup_top_forms`.  Use `from_forms` or `from_wide` to
+        build a store from the other feasibility formats.
+    forms : list of strings, optional
+        The forms in the store, in order.  Defaults to the forms in the form
+        column in sorted order.  Forms in this list which have no rows are
+        kept as empty forms.
+
+    """
+
+    def __init__(self, df, forms=None):
+        if forms is None:
+            forms = sorted(pd.unique(df.form))
+        self.forms = list(forms)
+
+        codes = pd.Categorical(df.form, categories=self.forms).codes
+        assert (codes >= 0).all(), "Rows have forms which aren't in forms"
+        order = np.argsort(codes, kind="mergesort")
+        self.frame = df.iloc[order]
+        self.frame.index.name = "parcel_id"
+        self._offsets = np.searchsorted(codes[order],
+                                        np.arange(len(self.forms) + 1))
+
+    @classmethod
+    def from_forms(cls, d):
+        """
+        Build a store from a dictionary where keys are forms and values are
+        the frames returned by the pro forma lookup for that form, e.g. the
+        dictionary returned by `SqFtProForma.lookup_forms`
+        """
+        frames = [df.assign(form=form) for form, df in d.items()
+                  if len(df) > 0]
+        if len(frames) == 0:
+            return cls(pd.DataFrame({"form": []}), forms=list(d))
+        df = pd.concat(frames)
+        # the form column goes first as on the frames from lookup_top_forms
+        df = df[["form"] + [col for col in df.columns if col != "form"]]
+        return cls(df, forms=list(d))
+
+    @classmethod
+    def from_wide(cls, df):
+        """
+        Build a store from the wide feasibility frame, which has forms as the
+        first level of its columns
+        """
+        forms = list(pd.unique(df.columns.get_level_values(0)))
+        return cls.from_forms({form: df[form].dropna(how="all")
+                               for form in forms})
+
+    def __len__(self):
+        return len(self.frame)
+
+    def __getitem__(self, form):
+        """
+        The feasibility of a single form, one row per parcel and without the
+        form column - the same frame as the wide feasibility frame gives for
+        the form but without the parcels where the form isn't feasible
+        """
+        i = self.forms.index(form)
+        return self.frame.iloc[self._offsets[i]:self._offsets[i + 1]].drop(
+            columns="form")
+
+    @property
+    def parcels(self):
+        """
+        The ids of the parcels which have at least one feasible form
+        """
+        return self.frame.index.unique()
+
+    def to_frame(self):
+        """
+        The long frame, sorted by form.  Not a copy.
+        """
+        return self.frame
+
+    def to_wide(self):
+        """
+        The wide feasibility frame with a column level per form
+        """
+        return pd.concat([self[form] for form in self.forms],
+                         keys=self.forms, axis=1)
+
+    def drop(self, parcel_ids):
+        """
+        A store without the given parcels - e.g. after the parcels are built on
+        """
+        return self.where(~self.frame.index.isin(parcel_ids))
+
+    def where(self, mask):
+        """
+        A store with only the rows where mask (a boolean array over the rows
+        of the long frame) is true - the rows stay sorted by form so they
+        aren't sorted again
+        """
+        store = FeasibilityStore.__new__(FeasibilityStore)
+        store.forms = self.forms
+        store.frame = self.frame[mask]
+        store._offsets = np.concatenate([[0], np.cumsum(mask)])[self._offsets]
+        return store
+
+    def max_profit_form(self, forms=None, colname="max_profit"):
+        """
+        The most profitable form on each parcel
+
+        Parameters
+        ----------
+        forms : list of strings, optional
+            The forms which compete with each other - defaults to all forms.
+            Ties go to the form which is listed first.
+        colname : string
+            The column to maximize
+
+        Returns
+        -------
+        df : dataframe
+            The row of the most profitable form on each parcel, indexed by
+            parcel id in sorted order, with a form column
+        """
+        if forms is None:
+            forms = self.forms
+        f = self.frame
+        rank = pd.Categorical(f.form, categories=forms).codes
+        f, rank = f[rank >= 0], rank[rank >= 0]
+
+        order = np.lexsort((rank, -f[colname].values))
+        best = order[~f.index[order].duplicated()]
+        return f.iloc[best].sort_index(kind="mergesort")
+
+
+def profit_per_sqft(df, forms=None, area="shape_area"):
+    """
+    Divide the max profit by the built floor area (max_profit_far times the
+    area of the parcel), which is how REMM's feasibility step was meant to
+    compare forms (see run_feasibility's profit_per_sqft)
+
+    Parameters
+    ----------
+    df : dataframe or dict
+        The lookup of a form, a long frame with a form column or a
+        dictionary where keys are forms and values are their lookups, with
+        max_profit, max_profit_far and area columns
+    forms : list of strings, optional
+        Only change the rows (or the lookups) of these forms
+    area : string
+        The column with the area of the parcel
+
+    Returns
+    -------
+    df : dataframe or dict
+        A copy of df with the max profit per sqft as the max profit
+    """
+    if isinstance(df, dict):
+        return {form: profit_per_sqft(f, area=area)
+                if (forms is None or form in forms) and len(f) > 0 else f
+                for form, f in df.items()}
+
+    max_profit = df.max_profit.values.astype("float")
+    per_sqft = max_profit / (df.max_profit_far.values * df[area].values)
+    if forms is not None:
+        per_sqft = np.where(df.form.isin(forms).values, per_sqft, max_profit)
+    return df.assign(max_profit=per_sqft)
+
+
+def profit_per_sqft_score(forms=None, area="shape_area"):
+    """
+    A score for `SqFtProForma.lookup_top_forms` which ranks the forms on
+    each parcel by `profit_per_sqft` rather than by max profit
+
+    Parameters
+    ----------
+    forms : list of strings, optional
+        Only score these forms by profit per sqft - other forms are scored
+        by max profit.  Defaults to all forms.
+    area : string
+        The column of the parcel frame with the area of the parcel
+    """
+    def score(lookup_forms, max_profit, max_profit_far, df):
+        per_sqft = max_profit / (max_profit_far * df[area].values)
+        if forms is None:
+            return per_sqft
+        scored = np.array([form in forms for form in lookup_forms])
+        return np.where(scored[:, np.newaxis], per_sqft, max_profit)
+    return score
@@ -0,0 +1,258 @@
+from __future__ import division
+
+import json
+import os
+import sys
+import time
+
+import pandas as pd
+
+
+class Span(object):
+    """
+    A timed stage of the pipeline - created by `Recorder.span` and used as a
+    context manager.  Set the rows attribute inside the block if the number
+    of rows processed isn't known when the span is opened.
+    """
+
+    def __init__(self, recorder, name, rows=None, year=None):
+        self.recorder = recorder
+        self.name = name
+        self.rows = rows
+        self.year = year
+
+    def __enter__(self):
+        self.recorder._stack.append(self.name)
+        self.stage = "/".join(self.recorder._stack)
+        self._rss = _rss_mb()
+        self._wall = time.perf_counter()
+        self._cpu = time.process_time()
+        return self
+
+    def __exit__(self, *args):
+        wall = time.perf_counter() - self._wall
+        cpu = time.process_time() - self._cpu
+        rss = _rss_mb()
+        self.recorder._stack.pop()
+        self.recorder.records.append({
+            "year": self.year if self.year is not None else self.recorder.year,
+            "stage": self.stage,
+            "wall_seconds": wall,
+            "cpu_seconds": cpu,
+            "rss_delta_mb": rss - self._rss
+            if rss is not None and self._rss is not None else None,
+            "max_rss_mb": _max_rss_mb(),
+            "rows": self.rows
+        })
+
+
+class _NullSpan(object):
+    """
+    The span returned by a disabled recorder - records nothing
+    """
+    rows = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+class Recorder(object):
+    """
+    Records the wall time, cpu time, memory and number of rows of the stages
+    of the REMM pipeline (feasibility, developer, location choice) so it's
+    possible to see which stage of which simulation year is slow or uses too
+    much memory in a long run.  By default nothing is recorded - use
+    `set_recorder(Recorder())` to turn recording on.
+
+    Memory is recorded as rss_delta_mb, the change in resident memory from
+    the start to the end of the span (memory which is allocated and freed
+    within the span doesn't show), and max_rss_mb, the high-water mark of
+    the resident memory of the process when the span ends - the peak since
+    the process started, not during the span.  Both come from psutil if it
+    is installed, which is needed on windows, and otherwise from /proc and
+    the resource module - a value which can't be measured is None.
+
+    Parameters
+    ----------
+    enabled : bool
+        Whether spans are recorded.  A disabled recorder costs almost nothing.
+
+    """
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.year = None
+        self.records = []
+        self._stack = []
+
+    def span(self, name, rows=None, year=None):
+        """
+        A context manager which records a stage of the pipeline, e.g.::
+
+            with recorder.span("lookup", rows=len(df)) as span:
+                ...
+
+        Spans can be nested, in which case the stage of the inner span is
+        the names of the open spans joined by slashes.
+
+        Parameters
+        ----------
+        name : string
+            The name of the stage
+        rows : int, optional
+            The number of rows processed by the stage - can also be set on
+            the span inside the block
+        year : int, optional
+            The simulation year - defaults to the year attribute of the
+            recorder
+
+        """
+        if not self.enabled:
+            return _NullSpan()
+        return Span(self, name, rows=rows, year=year)
+
+    def to_frame(self):
+        """
+        The records as a dataframe with a row per span, in the order the
+        spans finished
+        """
+        return pd.DataFrame(self.records, columns=[
+            "year", "stage", "wall_seconds", "cpu_seconds", "rss_delta_mb",
+            "max_rss_mb", "rows"])
+
+    def write(self, path, year=None):
+        """
+        Write the records as csv if the path ends in .csv and as json
+        otherwise
+
+        Parameters
+        ----------
+        path : string
+            The file to write
+        year : int, optional
+            Only write the records of this simulation year
+        """
+        records = [r for r in self.records
+                   if year is None or r["year"] == year]
+        if path.endswith(".csv"):
+            pd.DataFrame(records, columns=self.to_frame().columns).to_csv(
+                path, index=False)
+        else:
+            with open(path, "w") as f:
+                json.dump(records, f, indent=2, default=_to_json)
+
+    def write_years(self, out_dir=".", fmt="json"):
+        """
+        Write a file of records for each simulation year, called
+        instrumentation_<year>.<fmt>, to out_dir
+        """
+        assert fmt in ["json", "csv"]
+        if not os.path.exists(out_dir):
+            os.makedirs(out_dir)
+        for year in pd.unique([r["year"] for r in self.records]):
+            self.write(os.path.join(out_dir, "instrumentation_%s.%s" %
+                                    (year, fmt)), year=year)
+
+    def add_records(self, records):
+        """
+        Add the records of spans recorded by another recorder, e.g. in a
+        worker process, as if they were nested in the spans which are open
+        in this recorder and recorded in its year
+        """
+        if not self.enabled:
+            return
+        for record in records:
+            record = dict(record)
+            record["stage"] = "/".join(self._stack + [record["stage"]])
+            if record["year"] is None:
+                record["year"] = self.year
+            self.records.append(record)
+
+    def reset(self):
+        self.records = []
+
+
+def _to_json(v):
+    # numpy scalars (e.g. row counts) aren't json serializable
+    return v.item()
+
+
+def _memory_info():
+    """
+    The psutil memory info of this process, or None if psutil isn't
+    installed
+    """
+    try:
+        import psutil
+    except ImportError:
+        return None
+    return psutil.Process().memory_info()
+
+
+def _rss_mb():
+    """
+    The resident memory of this process in megabytes - from psutil, or from
+    /proc on linux - or None if it can't be measured
+    """
+    info = _memory_info()
+    if info is not None:
+        return info.rss / 1e6
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf("SC_PAGE_SIZE") / 1e6
+    except (IOError, OSError, ValueError, AttributeError):
+        return None
+
+
+def _max_rss_mb():
+    """
+    The peak resident memory of this process since it started in megabytes
+    - from the resource module, or psutil's peak working set on windows -
+    or None if it can't be measured
+    """
+    try:
+        import resource
+    except ImportError:
+        info = _memory_info()
+        peak = getattr(info, "peak_wset", None)
+        return peak / 1e6 if peak is not None else None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # linux reports kilobytes and macos bytes
+    if sys.platform == "darwin":
+        return peak / 1e6
+    return peak / 1e3
+
+
+_recorder = Recorder(enabled=False)
+
+
+def get_recorder():
+    """
+    Get the recorder used by the pro forma, developer and REMM utilities.
+    By default this is a disabled recorder.
+    """
+    return _recorder
+
+
+def set_recorder(recorder):
+    """
+    Set the recorder used by the pro forma, developer and REMM utilities.
+
+    Parameters
+    ----------
+    recorder : Recorder
+        The new recorder
+
+    Returns
+    -------
+    previous : Recorder
+        The recorder which was replaced
+    """
+    global _recorder
+    previous = _recorder
+    _recorder = recorder
+    return previous
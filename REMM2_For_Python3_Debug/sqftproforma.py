@@ -1,12 +1,31 @@
 from __future__ import division
 
+import os
+import copy
+import collections
+import hashlib
+import itertools
 import numpy as np
 import pandas as pd
 import logging
+import pickle
+import uuid
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+
+from . import debugsink, instrument
 
 
 logger = logging.getLogger(__name__)
 
+# lookup tables which have already been generated in this process, keyed by
+# SqFtProFormaConfig.lookup_key()
+_lookup_cache = {}
+
+# part of the lookup key - bump it whenever the layout of the lookup table
+# changes so tables cached on disk by an older version are regenerated
+LOOKUP_VERSION = 2
+
 
 class SqFtProFormaConfig(object):
     """
@@ -114,6 +133,18 @@ class SqFtProFormaConfig(object):
         This means $1/year is equivalent to 1/cap_rate present dollars.
         This is a macroeconomic input that is widely available on the
         internet.
+    form_cost_factors : dict
+        A dictionary where keys are forms and values multiply the
+        construction cost per sqft of that form - e.g. to model regional
+        cost variants of the same use mix.  Forms which aren't keys have a
+        factor of 1.0.  Usually set with `load_forms`.
+    dtype : string
+        The floating point type the parcel lookups are computed in -
+        "float64" (the default) or "float32".  Dollars per square foot don't
+        need 64 bit precision and float32 halves the memory used by the
+        lookup, but results can differ slightly from float64 for parcels
+        whose best buildings are very close in profit or right at a zoning
+        limit - use `SqFtProForma.compare_dtype` to check the differences.
 
     """
 
@@ -189,6 +220,58 @@ class SqFtProFormaConfig(object):
         self.max_retail_height = 2.0
         self.max_industrial_height = 2.0
 
+        self.form_cost_factors = {}
+
+        self.dtype = 'float64'
+
+    def load_forms(self, forms):
+        """
+        Replace the forms with a catalog of forms from a table - useful for
+        large catalogs of mixed use splits and cost variants which would be
+        unwieldy to write out as dictionaries.  Must be called before the
+        configuration is passed to `SqFtProForma`.
+
+        Parameters
+        ----------
+        forms : dataframe or string
+            A table (or the path to a csv file) with one row per form, where
+            the index (or a column called "form") is the name of the form and
+            there is a column for each use giving the proportion of that use
+            in the form.  Uses which aren't columns are not in any form.  An
+            optional "cost_factor" column is used for `form_cost_factors`.
+
+        Returns
+        -------
+        Nothing
+
+        """
+        assert all(isinstance(v, dict) for v in self.forms.values()), \
+            "Forms must be loaded before the config is used by a pro forma"
+
+        if isinstance(forms, str):
+            forms = pd.read_csv(forms)
+        if 'form' in forms.columns:
+            forms = forms.set_index('form')
+        assert forms.index.is_unique, "Form names must be unique"
+        unknown = set(forms.columns) - set(self.uses) - {'cost_factor'}
+        assert len(unknown) == 0, "Unknown uses in forms: %s" % sorted(unknown)
+
+        uses = [use for use in self.uses if use in forms.columns]
+        shares = forms[uses].fillna(0.0)
+        assert (shares.values >= 0).all()
+        assert (shares.sum(axis=1) > 0).all(), "Every form needs a use"
+
+        self.forms = {
+            str(name): {use: float(share)
+                        for use, share in row.items() if share > 0}
+            for name, row in shares.iterrows()
+        }
+        self.form_cost_factors = {}
+        if 'cost_factor' in forms.columns:
+            self.form_cost_factors = {
+                str(name): float(factor)
+                for name, factor in forms.cost_factor.fillna(1.0).items()}
+
     def _convert_types(self):
         """
         convert lists and dictionaries that are useful for users to
@@ -206,6 +289,27 @@ class SqFtProFormaConfig(object):
             self.res_ratios[k] = pd.Series(self.forms[k])[self.residential_uses].sum()
         self.costs = np.transpose(np.array([self.costs[use] for use in self.uses]))
 
+    def lookup_key(self):
+        """
+        A hash of the content of the (converted) configuration.  Two
+        configurations with the same key generate the same pro forma lookup
+        tables, so the key is used to cache the tables across constructions.
+
+        """
+        def canonical(v):
+            if isinstance(v, np.ndarray):
+                return ('ndarray', v.dtype.str, v.shape, v.tolist())
+            if isinstance(v, pd.Series):
+                return canonical(v.values)
+            if isinstance(v, dict):
+                return sorted((str(k), canonical(i)) for k, i in v.items())
+            if isinstance(v, (list, tuple)):
+                return [canonical(i) for i in v]
+            return v
+
+        return hashlib.sha1(repr(
+            (LOOKUP_VERSION, canonical(vars(self)))).encode('utf-8')).hexdigest()
+
     @property
     def tiled_parcel_sizes(self):
         return np.reshape(np.repeat(self.parcel_sizes, self.fars.size), (-1, 1))
@@ -214,6 +318,10 @@ class SqFtProFormaConfig(object):
         fars = pd.Series(self.fars)
         assert len(fars[fars > 20]) == 0
         assert len(fars[fars <= 0]) == 0
+        assert self.dtype in ['float32', 'float64']
+        for k, v in self.form_cost_factors.items():
+            assert k in self.forms
+            assert 0 < v < 10
         for k, v in self.forms.items():
             assert isinstance(v, dict)
             for k2, v2 in self.forms[k].items():
@@ -265,46 +373,177 @@ class SqFtProForma(object):
         The configuration object which should be an
         instance of `SqFtProFormaConfig`.  The configuration options for this
         pro forma are documented on the configuration object.
+    cache_dir : string, optional
+        A directory in which to store the generated lookup tables.  Tables
+        are keyed by a hash of the configuration, so constructing a pro
+        forma with the same configuration again (e.g. every simulation year)
+        reads them back instead of regenerating them.  Tables are always
+        cached in memory for the life of the process.
 
     """
 
-    def __init__(self, config=None):
+    def __init__(self, config=None, cache_dir=None):
         if config is None:
             config = SqFtProFormaConfig()
         config.check_is_reasonable()
         self.config = config
         self.config._convert_types()
-        self._generate_lookup()
+        self.cache_dir = cache_dir
+        self.lookup_key = self.config.lookup_key()
+        self._envelope_cache = {}
+        if not self._load_lookup():
+            self._generate_lookup()
+            self._save_lookup()
+
+    def _lookup_cache_path(self):
+        return os.path.join(self.cache_dir,
+                            "sqftproforma_table_%s.npz" % self.lookup_key)
+
+    def _load_lookup(self):
+        """
+        Read the lookup table from the in memory cache or from cache_dir.
+        Returns whether the table was found.
+
+        """
+        if self.lookup_key not in _lookup_cache and self.cache_dir is not None \
+                and os.path.exists(self._lookup_cache_path()):
+            try:
+                with np.load(self._lookup_cache_path(),
+                             allow_pickle=False) as f:
+                    cached = (f["table"], [str(x) for x in f["forms"]],
+                              [str(x) for x in f["parking_configs"]],
+                              [str(x) for x in f["fields"]])
+            except (IOError, OSError, ValueError, KeyError, EOFError,
+                    zipfile.BadZipFile):
+                cached = None
+            if cached is not None and self._is_valid_lookup(*cached):
+                _lookup_cache[self.lookup_key] = cached
+                logger.debug("Read pro forma lookup from %s" %
+                             self._lookup_cache_path())
+            else:
+                logger.warning("Ignoring the stale pro forma lookup in %s" %
+                               self._lookup_cache_path())
+
+        if self.lookup_key not in _lookup_cache:
+            return False
+
+        table, forms, parking_configs, fields = _lookup_cache[self.lookup_key]
+        self._set_lookup_table(table.copy(), forms, parking_configs, fields)
+        return True
+
+    def _is_valid_lookup(self, table, forms, parking_configs, fields):
+        """
+        Whether a lookup table read from cache_dir is a table for this
+        configuration - a file can be stale, e.g. if it was copied from
+        another run or written by another version
+
+        """
+        c = self.config
+        if forms != sorted(c.forms) or \
+                parking_configs != sorted(c.parking_configs) or \
+                'far' not in fields or 'ave_cost_sqft' not in fields or \
+                table.shape != (len(forms), len(parking_configs), len(c.fars),
+                                len(fields)):
+            return False
+        return np.allclose(table[..., fields.index('far')], c.fars)
+
+    def _save_lookup(self):
+        """
+        Put the lookup table in the in memory cache and in cache_dir
+
+        """
+        _lookup_cache[self.lookup_key] = (
+            self.lookup_table.copy(), self.lookup_forms_order,
+            self.lookup_parking_configs, self.lookup_fields)
+
+        if self.cache_dir is None:
+            return
+
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        # write to a temporary file first so a concurrent reader never sees
+        # a partially written cache
+        tmp_path = self._lookup_cache_path() + ".%d.tmp.npz" % os.getpid()
+        np.savez(tmp_path, table=self.lookup_table,
+                 forms=np.array(self.lookup_forms_order, dtype='U'),
+                 parking_configs=np.array(self.lookup_parking_configs,
+                                          dtype='U'),
+                 fields=np.array(self.lookup_fields, dtype='U'))
+        os.replace(tmp_path, self._lookup_cache_path())
+
+    def _set_lookup_table(self, table, forms, parking_configs, fields):
+        """
+        Store the lookup table - a contiguous (forms, parking configs, fars,
+        fields) array - along with the maps from names to positions on each
+        axis
+
+        """
+        self.lookup_table = np.ascontiguousarray(table, dtype='float')
+        self.lookup_forms_order = list(forms)
+        self.lookup_parking_configs = list(parking_configs)
+        self.lookup_fields = list(fields)
+        self.form_index = {name: i for i, name in enumerate(forms)}
+        self.parking_config_index = {
+            name: i for i, name in enumerate(parking_configs)}
+        self.field_index = {name: i for i, name in enumerate(fields)}
+
+    def _lookup_field(self, form, field):
+        """
+        A (parking configs, fars) view of one field of the lookup table for
+        a form
+
+        """
+        return self.lookup_table[self.form_index[form], :, :,
+                                 self.field_index[field]]
+
+    @property
+    def dev_d(self):
+        """
+        The lookup table as a dictionary where keys are (form, parking config)
+        tuples and values are the dataframes returned by get_debug_info
+
+        """
+        return {(form, parking_config): self.get_debug_info(form, parking_config)
+                for form in self.lookup_forms_order
+                for parking_config in self.lookup_parking_configs}
 
-    def _building_cost(self, use_mix, stories):
+    def _building_cost(self, use_mixes, stories):
         """
-        Generate building cost for a set of buildings
+        Generate building cost for a set of buildings of every form at once
 
         Parameters
         ----------
-        use_mix : array
-            The mix of uses for this form
-        stories : series
-            A Pandas Series of stories
+        use_mixes : array
+            The mix of uses for each form - a (forms, uses) array
+        stories : array
+            An array of stories with forms on the first axis, e.g. a (forms,
+            parking configs, fars) array.  Stories which are nan aren't
+            allowed.
 
         Returns
         -------
         array
-            The cost per sqft for this unit mix and height.
+            The cost per sqft for each form's unit mix and height, in the
+            shape of stories.
 
         """
         c = self.config
+        # cost per sqft of each form in each height bracket - a (forms,
+        # heights for costs) array
+        form_costs = np.dot(use_mixes, np.transpose(c.costs))
         # stories to heights
         heights = stories * c.height_per_story
         # cost index for this height
         costs = np.searchsorted(c.heights_for_costs, heights)
         # this will get set to nan later
         costs[np.isnan(heights)] = 0
-        # compute cost with matrix multiply
-        costs = np.dot(np.squeeze(c.costs[costs.astype('int32')]), use_mix)
+        # look up the cost of each building in its form's row
+        form_ind = np.arange(len(use_mixes)).reshape(
+            (-1,) + (1,) * (stories.ndim - 1))
+        costs = form_costs[form_ind, costs]
         # some heights aren't allowed - cost should be nan
-        costs[np.isnan(stories).flatten()] = np.nan
-        return costs.flatten()
+        costs[np.isnan(stories)] = np.nan
+        return costs
 
     def _generate_lookup(self):
         """
@@ -314,88 +553,112 @@ class SqFtProForma(object):
         then turns it into the yearly rent necessary to make break even on
         that cost.
 
+        Every form and parking configuration is computed in one pass on
+        (forms, parking configs, fars) arrays, which are the fields of the
+        lookup table.
+
         """
         c = self.config
 
-        # get all the building forms we can use
+        for parking_config in c.parking_configs:
+            assert parking_config in ['surface', 'deck', 'underground'], \
+                "Unknown parking config: %s" % parking_config
+
+        # get all the building forms we can use, and the use distribution
+        # for each as a (forms, 1, 1) stack of rows
         keys = c.forms.keys()
         keys = sorted(keys)
-        df_d = {}
-        for name in keys:
-            # get the use distribution for each
-            uses_distrib = c.forms[name]
-
-            for parking_config in c.parking_configs:
-
-                # going to make a dataframe to store values to make
-                # pro forma results transparent
-                df = pd.DataFrame(index=c.fars)
-                df['far'] = c.fars
-                df['pclsz'] = c.tiled_parcel_sizes
-
-                building_bulk = np.reshape(
-                    c.parcel_sizes, (-1, 1)) * np.reshape(c.fars, (1, -1))
-                building_bulk = np.reshape(building_bulk, (-1, 1))
-
-                # need to converge in on exactly how much far is available for
-                # deck pkg
-                if parking_config == 'deck':
-                    building_bulk /= (1.0 + np.sum(uses_distrib * c.parking_rates) *
-                                      c.parking_sqft_d[parking_config] /
-                                      c.sqft_per_rate)
-
-                df['building_sqft'] = building_bulk
-
-                parkingstalls = building_bulk * \
-                    np.sum(uses_distrib * c.parking_rates) / c.sqft_per_rate
-                parking_cost = (c.parking_cost_d[parking_config] *
-                                parkingstalls *
-                                c.parking_sqft_d[parking_config])
-
-                df['spaces'] = parkingstalls
-
-                if parking_config == 'underground':
-                    df['park_sqft'] = parkingstalls * \
-                        c.parking_sqft_d[parking_config]
-                    stories = building_bulk / c.tiled_parcel_sizes
-                if parking_config == 'deck':
-                    df['park_sqft'] = parkingstalls * \
-                        c.parking_sqft_d[parking_config]
-                    stories = ((building_bulk + parkingstalls *
-                                c.parking_sqft_d[parking_config]) /
-                               c.tiled_parcel_sizes)
-                if parking_config == 'surface':
-                    stories = building_bulk / \
-                        (c.tiled_parcel_sizes - parkingstalls *
-                         c.parking_sqft_d[parking_config])
-                    df['park_sqft'] = 0
-                    # not all fars support surface parking
-                    stories[stories < 0.0] = np.nan
-                    # I think we can assume that stories over 3
-                    # do not work with surface parking
-                    stories[stories > 5.0] = np.nan
-
-                df['total_built_sqft'] = df.building_sqft + df.park_sqft
-                df['parking_sqft_ratio'] = df.park_sqft / df.total_built_sqft
-                stories /= c.parcel_coverage
-                df['stories'] = np.ceil(stories)
-                df['height'] = df.stories * c.height_per_story
-                df['build_cost_sqft'] = self._building_cost(uses_distrib, stories)
-
-                df['build_cost'] = df.build_cost_sqft * df.building_sqft
-                df['park_cost'] = parking_cost
-                df['cost'] = df.build_cost + df.park_cost
-
-                df['ave_cost_sqft'] = (df.cost / df.total_built_sqft) * c.profit_factor
-
-                if name == 'retail':
-                    df['ave_cost_sqft'][c.fars > c.max_retail_height] = np.nan
-                if name == 'industrial':
-                    df['ave_cost_sqft'][c.fars > c.max_industrial_height] = np.nan
-
-                df_d[(name, parking_config)] = df
-        df.to_csv("debug_urbansimdeveolperprofomay397_df.csv")
-        self.dev_d = df_d
+        uses_distrib = np.array([c.forms[name] for name in keys])
+        parking_rate = np.sum(uses_distrib * c.parking_rates, axis=1)
+        parking_rate = parking_rate[:, np.newaxis, np.newaxis]
+
+        # parking configs are sorted like the forms - the lookup engines break
+        # ties between parking configs in this order, which is the order the
+        # columns of the original per parking config pivot were in
+        parking_configs = sorted(c.parking_configs)
+
+        # parking config values as (1, parking configs, 1) arrays
+        def config_values(values):
+            return np.array(values, dtype='float')[np.newaxis, :, np.newaxis]
+
+        configs = np.array(parking_configs)
+        is_surface = config_values(configs == 'surface').astype('bool')
+        is_deck = config_values(configs == 'deck').astype('bool')
+        parking_sqft = config_values(
+            [c.parking_sqft_d[pc] for pc in parking_configs])
+        parking_cost_sqft = config_values(
+            [c.parking_cost_d[pc] for pc in parking_configs])
+        shape = (len(keys), len(parking_configs), len(c.fars))
+        parcel_sizes = np.reshape(c.tiled_parcel_sizes, (1, 1, -1))
+
+        building_bulk = np.reshape(
+            c.parcel_sizes, (-1, 1)) * np.reshape(c.fars, (1, -1))
+        building_bulk = np.broadcast_to(
+            np.reshape(building_bulk, (1, 1, -1)), shape)
+
+        # need to converge in on exactly how much far is available for
+        # deck pkg
+        building_bulk = np.where(
+            is_deck, building_bulk / (1.0 + parking_rate * parking_sqft /
+                                      c.sqft_per_rate), building_bulk)
+
+        parkingstalls = building_bulk * parking_rate / c.sqft_per_rate
+        parking_cost = parking_cost_sqft * parkingstalls * parking_sqft
+
+        park_sqft = np.where(is_surface, 0.0, parkingstalls * parking_sqft)
+        stories = np.where(
+            is_surface,
+            building_bulk / (parcel_sizes - parkingstalls * parking_sqft),
+            (building_bulk + np.where(is_deck, park_sqft, 0.0)) /
+            parcel_sizes)
+        # not all fars support surface parking and I think we can assume
+        # that stories over 3 do not work with surface parking
+        stories[np.broadcast_to(is_surface, shape) &
+                ((stories < 0.0) | (stories > 5.0))] = np.nan
+
+        total_built_sqft = building_bulk + park_sqft
+        stories /= c.parcel_coverage
+        cost_factors = np.array([c.form_cost_factors.get(name, 1.0)
+                                 for name in keys])
+        build_cost_sqft = self._building_cost(uses_distrib, stories) * \
+            cost_factors[:, np.newaxis, np.newaxis]
+        build_cost = build_cost_sqft * building_bulk
+        cost = build_cost + parking_cost
+        ave_cost_sqft = (cost / total_built_sqft) * c.profit_factor
+
+        form_index = {name: i for i, name in enumerate(keys)}
+        if 'retail' in form_index:
+            ave_cost_sqft[form_index['retail'], :,
+                          c.fars > c.max_retail_height] = np.nan
+        if 'industrial' in form_index:
+            ave_cost_sqft[form_index['industrial'], :,
+                          c.fars > c.max_industrial_height] = np.nan
+
+        # going to keep every intermediate value to make pro forma results
+        # transparent - see get_debug_info
+        fields = collections.OrderedDict([
+            ('far', c.fars),
+            ('pclsz', parcel_sizes),
+            ('building_sqft', building_bulk),
+            ('spaces', parkingstalls),
+            ('park_sqft', park_sqft),
+            ('total_built_sqft', total_built_sqft),
+            ('parking_sqft_ratio', park_sqft / total_built_sqft),
+            ('stories', np.ceil(stories)),
+            ('height', np.ceil(stories) * c.height_per_story),
+            ('build_cost_sqft', build_cost_sqft),
+            ('build_cost', build_cost),
+            ('park_cost', parking_cost),
+            ('cost', cost),
+            ('ave_cost_sqft', ave_cost_sqft)
+        ])
+        table = np.stack([np.broadcast_to(v, shape) for v in fields.values()],
+                         axis=-1)
+        self._set_lookup_table(table, keys, parking_configs, list(fields))
+
+        debugsink.get_debug_sink().write(
+            "debug_urbansimdeveolperprofomay397_df",
+            self.get_debug_info(keys[-1], c.parking_configs[-1]))
 
     def get_debug_info(self, form, parking_config):
         """
@@ -418,7 +681,10 @@ class SqFtProForma(object):
             many of the columns should be fairly self-expanatory.
 
         """
-        return self.dev_d[(form, parking_config)]
+        return pd.DataFrame(
+            self.lookup_table[self.form_index[form],
+                              self.parking_config_index[parking_config]],
+            index=self.config.fars, columns=self.lookup_fields, copy=False)
 
     def get_ave_cost_sqft(self, form, parking_config):
         """
@@ -440,9 +706,10 @@ class SqFtProForma(object):
             configuration parameters that were passed at run time.
 
         """
-        return self.dev_d[(form, parking_config)].ave_cost_sqft
+        return self.get_debug_info(form, parking_config).ave_cost_sqft
 
-    def lookup(self, form, df, only_built=True, pass_through=None):
+    def lookup(self, form, df, only_built=True, pass_through=None,
+               chunksize=None, engine="grid"):
         """
         This function does the developer model lookups for all the actual input data.
 
@@ -463,6 +730,25 @@ class SqFtProForma(object):
             to the output feasibility frame - is usually used for debugging
             purposes - these fields will be passed all the way through
             developer
+        chunksize : int, optional
+            If passed, parcels are evaluated in blocks of this many rows and
+            the results for each block are concatenated.  Peak memory is then
+            bounded by the block size rather than by the number of parcels,
+            which matters for regional runs with hundreds of thousands of
+            parcels.  By default all parcels are evaluated at once.
+        engine : string, optional
+            How the maximum profit building is found on each parcel.  "grid"
+            (the default) evaluates the profit at every far in the
+            configuration.  "envelope" precomputes, for each parking config,
+            the upper envelope of the profit lines for every number of
+            allowed fars and finds each parcel's optimum with a binary search
+            on its rent, so time and memory don't grow linearly with the
+            number of fars - use it with fine far grids.  The envelope engine
+            requires the fars to be sorted.  "fused" walks the (parking
+            config, far) pairs keeping the running best building for each
+            parcel, so memory is linear in the number of parcels instead of
+            in parcels times fars - it is compiled with numba if numba is
+            installed and falls back to a loop of vectorized steps otherwise.
 
         Input Dataframe Columns
         rent : dataframe
@@ -494,7 +780,11 @@ class SqFtProForma(object):
         Returns
         -------
         index : Series, int
-            parcel identifiers
+            parcel identifiers, in the order of df (the original lookup
+            sorted them by parcel id)
+        parking_config : Series, string
+            The parking config of the maximum profit building - ties go to
+            the first parking config in sorted order
         building_sqft : Series, float
             The number of square feet for the building to build.  Keep in mind
             this includes parking and common space.  Will need a helpful function
@@ -519,48 +809,740 @@ class SqFtProForma(object):
             and max_height from the input dataframe).
 
         """
-        df = pd.concat(self._lookup_parking_cfg(form, parking_config, df, only_built,
-                                                pass_through)
-                       for parking_config in self.config.parking_configs)
+        if chunksize is None or len(df) <= chunksize:
+            return self._lookup(form, df, only_built, pass_through, engine)
 
-        if len(df) == 0:
+        assert chunksize > 0
+        chunks = [self._lookup(form, df.iloc[i:i + chunksize], only_built,
+                               pass_through, engine)
+                  for i in range(0, len(df), chunksize)]
+        chunks = [chunk for chunk in chunks if len(chunk) > 0]
+
+        if len(chunks) == 0:
             return pd.DataFrame()
 
-        max_profit_ind = df.pivot(
-            columns="parking_config",
-            values="max_profit").idxmax(axis=1).to_frame("parking_config")
+        return pd.concat(chunks)
 
-        df.set_index(["parking_config"], append=True, inplace=True)
-        max_profit_ind.set_index(["parking_config"], append=True, inplace=True)
+    def lookup_forms(self, forms, df, allowed=None, only_built=True,
+                     pass_through=None, chunksize=None, engine="grid",
+                     n_jobs=1, shards=1, executor=None):
+        """
+        Run the lookup for several forms, optionally in a pool of worker
+        processes.  Each form (and each parcel shard within a form) is
+        independent given the parcel frame, so they can be evaluated
+        concurrently.
 
-        # get the max_profit idx
-        return df.loc[max_profit_ind.index].reset_index(1)
+        Parameters
+        ----------
+        forms : list of strings
+            The forms to look up - each one of the forms specified in the
+            configuration object
+        df : dataframe
+            The parcel frame - see `lookup` for the required columns
+        allowed : dict, optional
+            A dictionary where keys are forms and values are boolean series
+            aligned to df which say whether the form is allowed on each
+            parcel.  If not passed, all forms are allowed on all parcels.
+        only_built : bool
+            Passed directly to `lookup`
+        pass_through : list of strings
+            Passed directly to `lookup`
+        chunksize : int, optional
+            Passed directly to `lookup`
+        engine : string, optional
+            Passed directly to `lookup`
+        n_jobs : int
+            The number of worker processes to use.  Set to -1 to use all
+            cores.  When set to 1 (and no executor is passed) the forms are
+            looked up one at a time in this process.  The pro forma is put
+            in shared memory once and unpickled once per worker, the workers
+            write debug tables to a sink with the settings of this process's
+            debug sink, and the span of each task is added to this
+            process's instrumentation recorder.
+        shards : int
+            The number of parcel shards to split each form into, so that a
+            single large form can also be spread across workers.
+        executor : `concurrent.futures.Executor`, optional
+            An executor to submit the work to instead of creating a process
+            pool - useful to reuse one pool across simulation years.  It is
+            not shut down by this method.
 
-    def _lookup_parking_cfg(self, form, parking_config, df, only_built=True,
-                            pass_through=None):
+        Returns
+        -------
+        feasibility : dict
+            A dictionary where keys are the forms and values are the frames
+            returned by `lookup`
 
-        dev_info = self.dev_d[(form, parking_config)]
+        """
+        if n_jobs == -1:
+            n_jobs = os.cpu_count() or 1
+
+        masks = {}
+        for form in forms:
+            if allowed is None:
+                masks[form] = np.ones(len(df.index), dtype='bool')
+            else:
+                masks[form] = np.asarray(allowed[form], dtype='bool')
+                assert len(masks[form]) == len(df.index)
+
+        recorder = instrument.get_recorder()
+        if executor is None and n_jobs == 1:
+            d = {}
+            for form in forms:
+                with recorder.span("lookup." + form, rows=masks[form].sum()):
+                    d[form] = self.lookup(form, df[masks[form]], only_built,
+                                          pass_through, chunksize, engine)
+            return d
+
+        c = self.config
+        columns = c.uses + ['land_cost', 'parcel_size', 'max_far',
+                            'max_height', 'max_dua', 'ave_unit_size']
+        columns += list(pass_through or [])
+        columns = [col for i, col in enumerate(columns)
+                   if col in df.columns and col not in columns[:i]]
+
+        # the workers write to a sink like this process's sink and send their
+        # spans back to be recorded here
+        context = {
+            "sink": debugsink.get_debug_sink().settings(),
+            "recording": recorder.enabled
+        }
+        with recorder.span("lookup.pool", rows=len(df.index)):
+            shared = _SharedParcels(df, columns)
+            shared_pf = _SharedProForma(self)
+            own_executor = executor is None
+            if own_executor:
+                executor = ProcessPoolExecutor(max_workers=n_jobs)
+            try:
+                futures = []
+                for form in forms:
+                    rows = np.flatnonzero(masks[form])
+                    for shard in np.array_split(rows, max(min(shards, len(rows)), 1)):
+                        futures.append((form, executor.submit(
+                            _lookup_worker, shared_pf.spec, form,
+                            shared.task(shard), only_built, pass_through,
+                            chunksize, engine, context)))
+
+                results = {form: [] for form in forms}
+                for form, future in futures:
+                    result, records = future.result()
+                    recorder.add_records(records)
+                    if len(result) > 0:
+                        results[form].append(result)
+            finally:
+                if own_executor:
+                    executor.shutdown()
+                shared.close()
+                shared_pf.close()
+
+        return {form: pd.concat(results[form]) if len(results[form]) > 0
+                else pd.DataFrame() for form in forms}
+
+    def lookup_top_forms(self, forms, df, k=1, allowed=None,
+                         only_built=True, pass_through=None, chunksize=None,
+                         score=None):
+        """
+        Run the lookup for a catalog of forms at once and keep only the k
+        most profitable forms on each parcel.  All forms are evaluated in one
+        batched computation (per block of parcels) rather than one lookup
+        per form, and the wide per-form feasibility frame is never built -
+        the result is a long frame with a row per parcel and kept form.
+
+        Parameters
+        ----------
+        forms : list of strings
+            The forms to look up - each one of the forms specified in the
+            configuration object
+        df : dataframe
+            The parcel frame - see `lookup` for the required columns
+        k : int
+            The number of forms to keep per parcel
+        allowed : dict, optional
+            Passed directly to `lookup_forms`
+        only_built : bool
+            Passed directly to `lookup`
+        pass_through : list of strings
+            Passed directly to `lookup`
+        chunksize : int, optional
+            Evaluate parcels in blocks of this many rows - memory grows with
+            the number of forms so this is usually needed for large catalogs
+        score : function, optional
+            Ranks the forms on each parcel by a score instead of by max
+            profit - a function which takes the list of forms, the max profit
+            and max profit far of each form on each parcel as (forms,
+            parcels) arrays and the block of the parcel frame, and returns a
+            (forms, parcels) array of scores, higher being better.  E.g.
+            `feasibility.profit_per_sqft_score` ranks forms like REMM's
+            profit per sqft.  The max profit in the result isn't changed.
+
+        Returns
+        -------
+        feasibility : dataframe
+            The rows `lookup` would return for the kept forms, indexed by
+            parcel id in the order of df, with a form column and a rank
+            column (0 for the most profitable form on the parcel)
 
-        cost_sqft_col = np.reshape(dev_info.ave_cost_sqft.values, (-1, 1))
-        cost_sqft_index_col = np.reshape(dev_info.index.values, (-1, 1))
+        """
+        assert k > 0
+
+        masks = np.ones((len(forms), len(df.index)), dtype='bool')
+        if allowed is not None:
+            for i, form in enumerate(forms):
+                masks[i] = np.asarray(allowed[form], dtype='bool')
+
+        if chunksize is None:
+            chunksize = max(len(df), 1)
+        assert chunksize > 0
+
+        frames = []
+        for i in range(0, len(df), chunksize):
+            frame = self._lookup_top_forms(
+                forms, df.iloc[i:i + chunksize], k,
+                masks[:, i:i + chunksize], only_built, pass_through, score)
+            if len(frame) > 0:
+                frames.append(frame)
+
+        if len(frames) == 0:
+            return pd.DataFrame()
 
-        parking_sqft_ratio = np.reshape(dev_info.parking_sqft_ratio.values, (-1, 1))
-        heights = np.reshape(dev_info.height.values, (-1, 1))
+        return pd.concat(frames)
 
-        # don't really mean to edit the df that's passed in
-        df = df.copy()
+    def _lookup_top_forms(self, forms, df, k, masks, only_built,
+                          pass_through, score=None):
+        """
+        Run lookup_top_forms for a single block of parcels
 
+        """
         c = self.config
 
-        # weighted rent for this form
-        df['weighted_rent'] = np.dot(df[c.uses], c.forms[form])
+        if only_built:
+            masks = masks[:, df.parcel_size.values > 0]
+            df = df[df.parcel_size.values > 0]
+
+        # the rents and zoning constraints depend on the form, so there is
+        # one of each per form and parcel - a parcel which isn't allowed to
+        # build a form gets a max far which no building meets
+        weighted_rent = np.dot(
+            np.array([c.forms[form] for form in forms]), df[c.uses].values.T)
+        # the max fars only depend on the form through its residential ratio
+        max_fars = {}
+        for form in forms:
+            if c.res_ratios[form] not in max_fars:
+                max_fars[c.res_ratios[form]] = self._max_fars(form, df)[2]
+        min_max_fars = np.array([max_fars[c.res_ratios[form]]
+                                 for form in forms])
+        if only_built:
+            masks = masks & (min_max_fars > 0)
+        min_max_fars = np.where(masks, min_max_fars, -np.inf)
+
+        keep = np.zeros((len(forms), len(df.index)), dtype='bool')
+        num_fars = 0
+        for i, form in enumerate(forms):
+            keep[i], num_allowed = self._prune(
+                form, df, min_max_fars[i], only_built,
+                weighted_rent=weighted_rent[i])
+            keep[i] &= masks[i]
+            if keep[i].any():
+                num_fars = max(num_fars, num_allowed[:, keep[i]].max())
+
+        parcels = keep.any(axis=0)
+        if not parcels.any():
+            return pd.DataFrame()
+        df = df[parcels]
+        keep, weighted_rent, min_max_fars = \
+            keep[:, parcels], weighted_rent[:, parcels], \
+            min_max_fars[:, parcels]
+
+        # evaluate every (form, parking config, far) on every parcel - the
+        # fields of the lookup table are (forms, parking configs, allowed
+        # fars, 1) arrays which broadcast against the parcels
+        form_inds = [self.form_index[form] for form in forms]
+
+        def field(name):
+            return self.lookup_table[form_inds, :, :num_fars,
+                                     self.field_index[name], np.newaxis]
+
+        profit = self._profit(
+            df, field('far'), field('ave_cost_sqft'),
+            field('parking_sqft_ratio'), field('height'),
+            min_max_fars=min_max_fars[:, np.newaxis, np.newaxis, :],
+            weighted_rent=weighted_rent[:, np.newaxis, np.newaxis, :])[-1]
+        profit = profit.reshape(len(forms), -1, len(df.index))
+        maxprofitind = np.argmax(profit, axis=1)
+        maxprofit = np.take_along_axis(
+            profit, maxprofitind[:, np.newaxis, :], axis=1)[:, 0]
+        del profit
+
+        # forms which lookup wouldn't return can't be kept
+        if only_built:
+            keep &= maxprofit > 0
+        else:
+            keep &= maxprofit != -np.inf
+        maxprofit = np.where(keep, maxprofit, -np.inf)
+
+        if score is not None:
+            parking_config_ind, far_ind = np.divmod(maxprofitind, num_fars)
+            fars = self.lookup_table[
+                np.array(form_inds)[:, np.newaxis], parking_config_ind,
+                far_ind, self.field_index['far']]
+            maxprofit = np.where(keep, np.asarray(
+                score(forms, maxprofit, fars, df), dtype='float'), -np.inf)
+
+        # rank the forms on each parcel - ties go to the form listed first
+        order = np.argsort(-maxprofit, axis=0, kind='mergesort')[:k]
+
+        # the kept buildings in the order of df, most profitable form first
+        rank, position = np.nonzero(np.take_along_axis(keep, order, axis=0))
+        if len(position) == 0:
+            return pd.DataFrame()
+        kept = order[rank, position]
+        order = np.lexsort((rank, position))
+        position, kept = position[order], kept[order]
+        parking_config_ind, far_ind = np.divmod(
+            maxprofitind[kept, position], num_fars)
+
+        outdf = self._lookup_output(
+            np.array(forms)[kept], df.iloc[position], parking_config_ind,
+            far_ind, only_built, pass_through,
+            min_max_fars=min_max_fars[kept, position],
+            weighted_rent=weighted_rent[kept, position])
+        if len(outdf) > 0:
+            outdf['rank'] = outdf.groupby(level=0).cumcount()
+        return outdf
+
+    @staticmethod
+    def _num_fars_allowed(table, limits):
+        """
+        The number of leading fars in a (parking configs, fars) table of
+        fars or heights which hold every value allowed by the limits
+
+        Parameters
+        ----------
+        table : array
+            A (parking configs, fars) field of the lookup table.  Values above
+            a limit (plus a .01 tolerance) are not allowed.  Nan values are
+            never allowed.
+        limits : array
+            One limit per parcel.  A nan limit allows every value.
+
+        Returns
+        -------
+        array
+            A (parking configs, parcels) array of counts
+
+        """
+        # the minimum of each suffix of the table is sorted along the far
+        # axis, so a binary search finds the last allowed far even if the
+        # table itself is not sorted
+        table = np.where(np.isnan(table), np.inf, table)
+        suffix_min = np.minimum.accumulate(table[:, ::-1], axis=1)[:, ::-1]
+        return np.array([np.searchsorted(row, limits + .01, side='right')
+                         for row in suffix_min])
+
+    def explain(self, form, df, parcel_ids):
+        """
+        Explain the lookup on a few parcels - e.g. why a parcel was or wasn't
+        built - by returning the pro forma for every far and parking config
+        in the lookup and the zoning constraint which limits the far.  Only
+        the given parcels are evaluated, against the lookup table which has
+        already been generated.
+
+        Parameters
+        ----------
+        form : string
+            One of the forms specified in the configuration file
+        df : dataframe
+            The parcel frame as passed to `lookup` - this can be the frame for
+            the whole region, only the rows of parcel_ids are used
+        parcel_ids : list
+            The ids of the parcels to explain
+
+        Returns
+        -------
+        surface : dataframe
+            One row per parcel, parking config and far in the lookup with the
+            parcel_id, parking_config, far and stories of the building,
+            whether zoning allows it (allowed), its building_sqft,
+            building_cost, total_cost, building_revenue and profit (-inf if
+            it can't be built), and whether it is the building the lookup
+            picks for the parcel (best)
+        summary : dataframe
+            Indexed by parcel id, with the max far allowed by each zoning
+            constraint (max_far, max_far_from_heights and max_far_from_dua -
+            nan if the constraint isn't set or doesn't apply to the form),
+            the min_max_fars used by the lookup and the binding_constraint
+            which sets it ("far", "height" or "dua", or None if the parcel
+            is unconstrained), the max_profit, max_profit_far and
+            parking_config of the best building and whether the lookup
+            would return the parcel when only_built is true (built)
+
+        """
+        c = self.config
+
+        rows = df.loc[parcel_ids]
+        parcels = self._parcel_frame(
+            form, rows, ['max_far', 'max_far_from_heights', 'max_far_from_dua'])
+
+        def field(name):
+            return self._lookup_field(form, name)[:, :, np.newaxis]
+
+        fars, building_bulks, building_costs, total_costs, building_revenue, \
+            profit = self._profit(parcels, field('far'), field('ave_cost_sqft'),
+                                  field('parking_sqft_ratio'), field('height'))
+
+        num_configs, num_fars, num_parcels = profit.shape
+        best = np.zeros((num_configs * num_fars, num_parcels), dtype='bool')
+        best[np.argmax(profit.reshape(-1, num_parcels), axis=0),
+             np.arange(num_parcels)] = True
+
+        # the surface has the parcels on the outer axis, then parking
+        # configs, then fars
+        def long(values):
+            values = np.broadcast_to(values, profit.shape)
+            return np.moveaxis(values, -1, 0).ravel()
+
+        surface = pd.DataFrame({
+            'parcel_id': np.repeat(parcels.index.values,
+                                   num_configs * num_fars),
+            'parking_config': np.tile(np.repeat(
+                self.lookup_parking_configs, num_fars), num_parcels),
+            'far': long(field('far')),
+            'stories': long(field('stories')),
+            'allowed': long(~np.isnan(fars)),
+            'building_sqft': long(building_bulks),
+            'building_cost': long(building_costs),
+            'total_cost': long(total_costs),
+            'building_revenue': long(building_revenue),
+            'profit': long(profit),
+            'best': long(best.reshape(profit.shape))
+        })
+
+        summary = parcels[['max_far', 'max_far_from_heights',
+                           'max_far_from_dua', 'min_max_fars']].copy()
+        if 'max_dua' not in df.columns or c.res_ratios[form] == 0:
+            summary['max_far_from_dua'] = np.nan
+
+        # the constraint with the smallest max far binds - ties go to far,
+        # then height, then dua
+        constraints = summary[['max_far', 'max_far_from_heights',
+                               'max_far_from_dua']].values
+        unconstrained = np.isnan(constraints).all(axis=1)
+        binding = np.array(['far', 'height', 'dua'], dtype='object')[
+            np.argmin(np.where(np.isnan(constraints), np.inf, constraints),
+                      axis=1)]
+        binding[unconstrained] = None
+        summary['binding_constraint'] = binding
+
+        chosen = surface[surface.best.values]
+        summary['max_profit'] = chosen.profit.values
+        summary['max_profit_far'] = np.where(
+            chosen.profit.values == -np.inf, np.nan, chosen.far.values)
+        summary['parking_config'] = chosen.parking_config.values
+        summary['built'] = (summary.max_profit.values > 0) & \
+            (summary.min_max_fars.values > 0) & \
+            (parcels.parcel_size.values > 0)
+
+        return surface, summary
+
+    def compare_dtype(self, form, df, **kwargs):
+        """
+        Validate the configured dtype (usually float32) against float64 by
+        running the lookup in both and comparing the chosen buildings.
+
+        Parameters
+        ----------
+        form : string
+            The form to look up
+        df : dataframe
+            The parcel frame - see `lookup`
+        kwargs
+            Passed directly to `lookup`
+
+        Returns
+        -------
+        comparison : dataframe
+            Indexed by parcel_id for every parcel returned by either lookup,
+            with the max_profit_far and max_profit in float64 and in the
+            configured dtype, whether the same far and parking config were
+            chosen and the relative difference in profit.  Parcels returned
+            by only one of the lookups have nans for the other.
+
+        """
+        pf64 = copy.copy(self)
+        pf64.config = copy.copy(self.config)
+        pf64.config.dtype = 'float64'
+
+        columns = ['max_profit_far', 'max_profit', 'parking_config']
+        a = pf64.lookup(form, df, **kwargs)
+        b = self.lookup(form, df, **kwargs)
+        a = a[columns] if len(a) > 0 else pd.DataFrame(columns=columns)
+        b = b[columns] if len(b) > 0 else pd.DataFrame(columns=columns)
+
+        comparison = a.join(b, how='outer', lsuffix='_float64',
+                            rsuffix='_' + self.config.dtype)
+        a, b = comparison.iloc[:, :3].values, comparison.iloc[:, 3:].values
+        # fars are compared with a tolerance as the configured fars
+        # themselves are rounded to the dtype
+        comparison['same_building'] = np.isclose(
+            a[:, 0].astype('float'), b[:, 0].astype('float'), rtol=1e-6) & \
+            (a[:, 2] == b[:, 2])
+        comparison['profit_rel_diff'] = \
+            np.abs(b[:, 1] - a[:, 1]).astype('float') / \
+            np.abs(a[:, 1]).astype('float')
+
+        logger.debug("%d of %d parcels choose the same building in %s and "
+                     "float64, max relative profit difference %g" % (
+                         comparison.same_building.sum(), len(comparison),
+                         self.config.dtype, comparison.profit_rel_diff.max()))
+        return comparison
+
+    def _profit(self, df, fars, cost_sqft, parking_sqft_ratio, heights,
+                min_max_fars=None, building_efficiency=None, cap_rate=None,
+                weighted_rent=None):
+        """
+        The pro forma for candidate buildings on the parcels in df.  The
+        candidate arguments are fields of the lookup table and either have a
+        trailing axis of length one, which broadcasts against the parcels, or
+        hold one value per parcel.  The max fars, weighted rents, building
+        efficiency and cap rate come from the parcels and the configuration
+        unless passed, in which case they must broadcast against the
+        candidates.
+
+        Returns
+        -------
+        tuple
+            The fars (nan where not allowed by zoning), building bulks,
+            building costs, total costs, building revenues and profits (-inf
+            where the building can't be built) for each candidate
+
+        """
+        c = self.config
+
+        # everything is computed in the configured dtype
+        fars, cost_sqft, parking_sqft_ratio, heights = [
+            np.asarray(x, dtype=c.dtype)
+            for x in (fars, cost_sqft, parking_sqft_ratio, heights)]
+
+        def parcel_values(col):
+            return df[col].values.astype(c.dtype, copy=False)
+
+        if min_max_fars is None:
+            min_max_fars = parcel_values('min_max_fars')
+        if weighted_rent is None:
+            weighted_rent = parcel_values('weighted_rent')
+        if building_efficiency is None:
+            building_efficiency = c.building_efficiency
+        if cap_rate is None:
+            cap_rate = c.cap_rate
+
+        # turn fars into nans which are not allowed by zoning - either by the
+        # far itself or by the height of the building
+        fars = np.where((fars > np.asarray(min_max_fars, dtype=c.dtype) + .01) |
+                        (heights > parcel_values('max_height') + .01),
+                        np.nan, fars)
+
+        # parcel sizes * possible fars
+        building_bulks = fars * parcel_values('parcel_size')
+
+        # cost to build the new building
+        building_costs = building_bulks * cost_sqft
+
+        # add cost to buy the current building
+        total_costs = building_costs + parcel_values('land_cost')
+
+        # rent to make for the new building
+        building_revenue = building_bulks * (1-parking_sqft_ratio) * \
+            building_efficiency * \
+            np.asarray(weighted_rent, dtype=c.dtype) / cap_rate
+
+        # profit for each form
+        profit = building_revenue - total_costs
+        profit[np.isnan(profit)] = -np.inf
+
+        return fars, building_bulks, building_costs, total_costs, \
+            building_revenue, profit
+
+    def _grid_argmax(self, form, df, num_fars):
+        """
+        Evaluate the profit of every allowed (parking config, far) pair for
+        every parcel as a (parking configs, fars, parcels) array and return
+        the parking config and far index of the maximum for each parcel.
+
+        """
+        # the lookup table holds every parking config for this form - the
+        # arrays below are all (parking configs, allowed fars, 1) and
+        # broadcast against the parcels
+        def field(name):
+            return self._lookup_field(form, name)[:, :num_fars, np.newaxis]
+
+        profit = self._profit(df, field('far'), field('ave_cost_sqft'),
+                              field('parking_sqft_ratio'), field('height'))[-1]
+
+        # one argmax over the flattened (parking config, far) axis picks the
+        # best parking config and far at the same time
+        maxprofitind = np.argmax(profit.reshape(-1, len(df.index)), axis=0)
+        return np.divmod(maxprofitind, num_fars)
+
+    def _fused_argmax(self, form, df, num_allowed):
+        """
+        Find the parking config and far index of the maximum profit for each
+        parcel without building the (parking configs, fars, parcels) profit
+        array - the pairs are visited in the order of the flattened grid and
+        the running best is only replaced by a strictly larger profit, so
+        the result is the same as the grid engine's argmax.
+
+        """
+        c = self.config
+        kernel = _jit_fused_kernel()
+
+        if kernel is None:
+            best_profit = np.full(len(df.index), -np.inf, dtype=c.dtype)
+            parking_config_ind = np.zeros(len(df.index), dtype='int')
+            far_ind = np.zeros(len(df.index), dtype='int')
+            fars, cost_sqft, parking_sqft_ratio, heights = [
+                self._lookup_field(form, name) for name in
+                ['far', 'ave_cost_sqft', 'parking_sqft_ratio', 'height']]
+            for i in range(len(self.lookup_parking_configs)):
+                for j in range(num_allowed[i].max()):
+                    profit = self._profit(df, fars[i, j], cost_sqft[i, j],
+                                          parking_sqft_ratio[i, j],
+                                          heights[i, j])[-1]
+                    better = profit > best_profit
+                    best_profit[better] = profit[better]
+                    parking_config_ind[better] = i
+                    far_ind[better] = j
+            return parking_config_ind, far_ind
+
+        # the kernel gets everything in the configured dtype, constants
+        # included, so it does the same arithmetic as _profit
+        def field(name):
+            return np.ascontiguousarray(self._lookup_field(form, name),
+                                        dtype=c.dtype)
+
+        def parcel_values(col):
+            return np.ascontiguousarray(df[col].values, dtype=c.dtype)
+
+        dtype = np.dtype(c.dtype).type
+        return kernel(
+            field('far'), field('ave_cost_sqft'), field('parking_sqft_ratio'),
+            field('height'), np.ascontiguousarray(num_allowed),
+            parcel_values('min_max_fars'), parcel_values('max_height'),
+            parcel_values('parcel_size'), parcel_values('land_cost'),
+            parcel_values('weighted_rent'), dtype(c.building_efficiency),
+            dtype(c.cap_rate), dtype(.01), dtype(1))
+
+    def _envelopes(self, form):
+        """
+        For each parking config and each number of allowed fars k, the upper
+        envelope of the lines profit / parcel_size = slope * rent + intercept
+        for the first k fars.  Profit is linear in the weighted rent for a
+        given far, so the best far for a parcel is the envelope line at its
+        rent, which is found with a binary search over the breakpoints.
+
+        Returns
+        -------
+        lines : array
+            A (parking configs, fars + 1, fars) array of the far indexes on
+            each envelope, from the smallest slope, padded with -1
+        breaks : array
+            A (parking configs, fars + 1, fars) array of the rents at which
+            each envelope line takes over from the previous one, padded
+            with inf
+
+        """
+        if form in self._envelope_cache:
+            return self._envelope_cache[form]
+
+        c = self.config
+        fars = self._lookup_field(form, 'far')
+        heights = self._lookup_field(form, 'height')
+        assert np.all(np.diff(fars, axis=1) > 0), \
+            "the envelope engine requires fars sorted in increasing order"
+        heights = np.where(np.isnan(heights), np.inf, heights)
+        assert np.all(heights == np.maximum.accumulate(heights, axis=1)), \
+            "the envelope engine requires heights which increase with far"
+
+        slopes = fars * (1 - self._lookup_field(form, 'parking_sqft_ratio')) * \
+            c.building_efficiency / c.cap_rate
+        intercepts = -fars * self._lookup_field(form, 'ave_cost_sqft')
+
+        num_configs, num_fars = fars.shape
+        lines = np.full((num_configs, num_fars + 1, num_fars), -1, dtype='int')
+        breaks = np.full((num_configs, num_fars + 1, num_fars), np.inf)
+        for i in range(num_configs):
+            for k in range(1, num_fars + 1):
+                hull, hull_breaks = _upper_envelope(slopes[i, :k],
+                                                    intercepts[i, :k])
+                lines[i, k, :len(hull)] = hull
+                breaks[i, k, :len(hull_breaks)] = hull_breaks
+
+        self._envelope_cache[form] = lines, breaks
+        return lines, breaks
+
+    def _envelope_argmax(self, form, df, num_allowed):
+        """
+        Find the parking config and far index of the maximum profit building
+        for each parcel by searching the upper envelope for its number of
+        allowed fars - O(log fars) per parcel and parking config instead of
+        evaluating every far.
+
+        """
+        lines, breaks = self._envelopes(form)
+        num_configs, num_fars = lines.shape[0], lines.shape[2]
+        rent = df.weighted_rent.values
+        num_parcels = len(rent)
+
+        far_ind = np.zeros((num_configs, num_parcels), dtype='int')
+        profit = np.full((num_configs, num_parcels), -np.inf)
+        for i in range(num_configs):
+            k = num_allowed[i]
+            # vectorized binary search for the number of breakpoints at or
+            # below the rent - this is the position of the best line
+            lo = np.zeros(num_parcels, dtype='int')
+            hi = np.full(num_parcels, num_fars - 1, dtype='int')
+            for _ in range(int(np.ceil(np.log2(num_fars))) + 1):
+                active = lo < hi
+                mid = (lo + hi) // 2
+                right = breaks[i, k, mid] <= rent
+                lo = np.where(active & right, mid + 1, lo)
+                hi = np.where(active & ~right, mid, hi)
+            best = lines[i, k, lo]
+
+            valid = best >= 0
+            far_ind[i, valid] = best[valid]
+
+            def field(name):
+                return self._lookup_field(form, name)[i, far_ind[i]]
+
+            profit[i] = self._profit(df, field('far'), field('ave_cost_sqft'),
+                                     field('parking_sqft_ratio'),
+                                     field('height'))[-1]
+            profit[i, ~valid] = -np.inf
+
+        parking_config_ind = np.argmax(profit, axis=0)
+        return parking_config_ind, \
+            far_ind[parking_config_ind, np.arange(num_parcels)]
+
+    def _max_fars(self, form, df):
+        """
+        The maximum far allowed on each parcel by each zoning constraint for
+        this form
+
+        Returns
+        -------
+        tuple
+            The max far from max_height, the max far from max_dua (0 if
+            max_dua isn't used for this form) and the minimum of the
+            constraints, which is the max far used by the lookup
+
+        """
+        c = self.config
 
         # min between max_fars and max_heights
-        df['max_far_from_heights'] = df.max_height / c.height_per_story * \
+        max_far_from_heights = df.max_height / c.height_per_story * \
             c.parcel_coverage
 
         resratio = c.res_ratios[form]
-        nonresratio = 1.0 - resratio
 
         # now also minimize with max_dua from zoning - since this pro forma is
         # really geared toward per sqft metrics, this is a bit tricky.  dua
@@ -571,7 +1553,7 @@ class SqFtProForma(object):
             # if max_dua is in the data frame, ave_unit_size must also be there
             assert 'ave_unit_size' in df.columns
 
-            df['max_far_from_dua'] = (
+            max_far_from_dua = (
                 # this is the max_dua times the parcel size in acres, which gives
                 # the number of units that are allowable on the parcel
                 df.max_dua * (df.parcel_size / 43560) *
@@ -583,7 +1565,7 @@ class SqFtProForma(object):
                 # divided by the building efficiency which is a
                 # factor that indicates that the actual units are not the whole
                 # FAR of the building
-                self.config.building_efficiency /
+                c.building_efficiency /
 
                 # divided by the resratio which is a  factor that indicates that
                 # the actual units are not the only use of the building
@@ -594,62 +1576,177 @@ class SqFtProForma(object):
                 # cancels here as it should, but the calc was hard to get right
                 # and it's just so much more transparent to have it in there twice
                 df.parcel_size)
-            df['min_max_fars'] = df[['max_far_from_heights', 'max_far',
-                                     'max_far_from_dua']].min(axis=1)
+            # fmin ignores a nan constraint as long as the other one is set
+            min_max_fars = np.fmin(
+                np.fmin(max_far_from_heights.values, df.max_far.values),
+                max_far_from_dua.values)
         else:
-            df['min_max_fars'] = df[['max_far_from_heights', 'max_far']].min(axis=1)
-            df['max_far_from_dua'] =0
-        if only_built:
-            df = df.query('min_max_fars > 0 and parcel_size > 0')
+            min_max_fars = np.fmin(max_far_from_heights.values,
+                                   df.max_far.values)
+            max_far_from_dua = 0
 
-        fars = np.repeat(cost_sqft_index_col, len(df.index), axis=1)
+        return max_far_from_heights, max_far_from_dua, min_max_fars
 
-        # turn fars into nans which are not allowed by zoning
-        # (so we can fillna with one of the other zoning constraints)
-        fars[fars > df.min_max_fars.values + .01] = np.nan
+    def _parcel_frame(self, form, df, pass_through):
+        """
+        A narrow frame of the parcel columns the lookup reads and the pass
+        through columns, plus the derived columns for this form - the
+        weighted rent and the max far.  The parcel frame that's passed in
+        can be very wide so it is never copied as a whole, and the zoning
+        columns max_far_from_heights and max_far_from_dua are only added if
+        they are passed through.
 
-        # same thing for heights
-        heights = np.repeat(heights, len(df.index), axis=1)
+        """
+        c = self.config
+        pass_through = list(pass_through or [])
+        zoning = ['max_far_from_heights', 'max_far_from_dua']
 
-        # turn heights into nans which are not allowed by zoning
-        # (so we can fillna with one of the other zoning constraints)
-        fars[heights > df.max_height.values + .01] = np.nan
+        columns = ['parcel_size', 'land_cost', 'max_height'] + \
+            [col for col in pass_through
+             if col not in zoning + ['weighted_rent', 'min_max_fars']]
+        columns = [col for i, col in enumerate(columns)
+                   if col not in columns[:i]]
+        parcels = pd.DataFrame({col: df[col].values for col in columns},
+                               index=df.index, columns=columns)
 
-        # parcel sizes * possible fars
-        building_bulks = fars * df.parcel_size.values
+        # weighted rent for this form
+        parcels['weighted_rent'] = np.dot(df[c.uses].values, c.forms[form])
 
-        # cost to build the new building
-        building_costs = building_bulks * cost_sqft_col
+        max_fars = self._max_fars(form, df)
+        parcels['min_max_fars'] = max_fars[2]
+        for col, values in zip(zoning, max_fars):
+            if col in pass_through:
+                parcels[col] = values
 
-        # add cost to buy the current building
-        total_costs = building_costs + df.land_cost.values
+        return parcels
 
-        # rent to make for the new building
-        building_revenue = building_bulks * (1-parking_sqft_ratio) * \
-            c.building_efficiency * df.weighted_rent.values / c.cap_rate
+    def _prune(self, form, df, min_max_fars, only_built, weighted_rent=None):
+        """
+        Find how many of the fars in the lookup each parcel can build before
+        any (parking configs, fars, parcels) matrix is allocated, so that
+        only the allowed prefix of fars is evaluated and parcels which can't
+        build anything are dropped up front.
 
-        # profit for each form
-        profit = building_revenue - total_costs
+        Returns
+        -------
+        keep : array
+            Whether each parcel needs to be evaluated
+        num_allowed : array
+            A (parking configs, parcels) array of the number of allowed fars
 
-        profit = profit.astype('float')
-        profit[np.isnan(profit)] = -np.inf
-        maxprofitind = np.argmax(profit, axis=0)
+        """
+        c = self.config
+        if weighted_rent is None:
+            weighted_rent = df.weighted_rent.values
+
+        num_allowed = np.minimum(
+            self._num_fars_allowed(self._lookup_field(form, 'far'),
+                                   min_max_fars),
+            self._num_fars_allowed(self._lookup_field(form, 'height'),
+                                   df.max_height.values))
+        keep = num_allowed.max(axis=0) > 0
+
+        if only_built:
+            # the largest possible revenue for a parcel is at its largest
+            # allowed far with the smallest parking ratio - if that can't
+            # even cover the land cost, the parcel can't be profitable
+            far_revenue = np.maximum.accumulate(np.nanmax(
+                self._lookup_field(form, 'far') *
+                (1 - self._lookup_field(form, 'parking_sqft_ratio')), axis=0))
+            max_revenue = \
+                far_revenue[np.maximum(num_allowed.max(axis=0) - 1, 0)] * \
+                df.parcel_size.values * c.building_efficiency * \
+                np.maximum(weighted_rent, 0) / c.cap_rate
+            keep &= ~(max_revenue <= df.land_cost.values)
+
+        return keep, num_allowed
+
+    def _lookup(self, form, df, only_built=True, pass_through=None,
+                engine="grid"):
+        """
+        Run the lookup for a single block of parcels - see `lookup` for a
+        description of the parameters and the returned columns.
+
+        All parking configurations are evaluated together: the engine finds
+        the most profitable (parking config, far) pair for each parcel and
+        the pro forma is then evaluated for just that building.
+
+        """
+        df = self._parcel_frame(form, df, pass_through)
+        if only_built:
+            df = df[(df.min_max_fars.values > 0) &
+                    (df.parcel_size.values > 0)]
+
+        keep, num_allowed = self._prune(form, df, df.min_max_fars.values,
+                                        only_built)
+        df = df[keep]
+        if len(df) == 0:
+            return pd.DataFrame()
+        num_allowed = num_allowed[:, keep]
+
+        if engine == "grid":
+            parking_config_ind, far_ind = self._grid_argmax(
+                form, df, num_allowed.max())
+        elif engine == "envelope":
+            parking_config_ind, far_ind = self._envelope_argmax(
+                form, df, num_allowed)
+        elif engine == "fused":
+            parking_config_ind, far_ind = self._fused_argmax(
+                form, df, num_allowed)
+        else:
+            raise ValueError("Unknown pro forma engine: %s" % engine)
+
+        return self._lookup_output(form, df, parking_config_ind, far_ind,
+                                   only_built, pass_through)
+
+    def _lookup_output(self, form, df, parking_config_ind, far_ind,
+                       only_built, pass_through, min_max_fars=None,
+                       weighted_rent=None):
+        """
+        Evaluate the pro forma again for just the chosen building on each
+        parcel and build the output frame of `lookup`.  The form can also be
+        an array with the form of the building on each row of df.
+
+        """
+        c = self.config
+
+        if isinstance(form, str):
+            form_ind = self.form_index[form]
+            resratio = c.res_ratios[form]
+        else:
+            form = pd.Series(form)
+            form_ind = form.map(self.form_index).values
+            resratio = form.map(c.res_ratios).values
+        nonresratio = 1.0 - resratio
+
+        def chosen(field):
+            return self.lookup_table[form_ind, parking_config_ind, far_ind,
+                                     self.field_index[field]]
 
-        def twod_get(indexes, arr):
-            return arr[indexes, np.arange(indexes.size)].astype('float')
+        heights = chosen('height')
+        parking_sqft_ratio = chosen('parking_sqft_ratio')
+        fars, building_bulks, building_costs, total_costs, building_revenue, \
+            profit = self._profit(df, chosen('far'), chosen('ave_cost_sqft'),
+                                  parking_sqft_ratio, heights,
+                                  min_max_fars=min_max_fars,
+                                  weighted_rent=weighted_rent)
 
         outdf = pd.DataFrame({
-            'building_sqft': twod_get(maxprofitind, building_bulks),
-            'building_cost': twod_get(maxprofitind, building_costs),
-            'parking_ratio': parking_sqft_ratio[maxprofitind].flatten(),
-            'stories': twod_get(maxprofitind, heights) / c.height_per_story,
-            'total_cost': twod_get(maxprofitind, total_costs),
-            'building_revenue': twod_get(maxprofitind, building_revenue),
-            'max_profit_far': twod_get(maxprofitind, fars),
-            'max_profit': twod_get(maxprofitind, profit),
-            'parking_config': parking_config
+            'parking_config': np.array(self.lookup_parking_configs)[
+                parking_config_ind],
+            'building_sqft': building_bulks,
+            'building_cost': building_costs,
+            'parking_ratio': parking_sqft_ratio,
+            'stories': heights / c.height_per_story,
+            'total_cost': total_costs,
+            'building_revenue': building_revenue,
+            'max_profit_far': fars,
+            'max_profit': profit
         }, index=df.index)
-        outdf.to_csv("debug_urbansimdeveolperprofomay652_outdf.csv")
+        if not isinstance(form, str):
+            outdf.insert(0, 'form', form.values)
+        debugsink.get_debug_sink().write(
+            "debug_urbansimdeveolperprofomay652_outdf", outdf)
         if pass_through:
             outdf[pass_through] = df[pass_through]
 
@@ -661,8 +1758,192 @@ class SqFtProForma(object):
         else:
             outdf = outdf.loc[outdf.max_profit != -np.inf].copy()
 
+        if len(outdf) == 0:
+            return pd.DataFrame()
+
         return outdf
 
+    @staticmethod
+    def expand_scenarios(grid):
+        """
+        Turn a grid of configuration overrides into a list of scenarios
+
+        Parameters
+        ----------
+        grid : dict
+            Keys are configuration options and values are lists of values to
+            test for that option
+
+        Returns
+        -------
+        scenarios : list of dicts
+            One dictionary of overrides for every combination of values, with
+            keys in sorted order
+
+        """
+        keys = sorted(grid.keys())
+        return [dict(zip(keys, values))
+                for values in itertools.product(*[grid[k] for k in keys])]
+
+    def _with_overrides(self, overrides):
+        """
+        A pro forma with this configuration except for the overrides, which
+        are given in the same (user facing) form as the configuration
+        options.  Options which change the shape of the lookup - the fars,
+        uses, forms and parking configs - can't be overridden.
+
+        """
+        c = copy.deepcopy(self.config)
+        for key, value in overrides.items():
+            assert key not in ['parcel_sizes', 'fars', 'uses', 'forms',
+                               'residential_uses', 'parking_configs', 'dtype'], \
+                "%s can't be overridden" % key
+            assert hasattr(c, key), "%s is not a configuration option" % key
+
+            # options which are converted to arrays by the configuration
+            # can be overridden for some of the uses only
+            if key == 'costs':
+                costs = dict(zip(c.uses, np.transpose(c.costs)))
+                costs.update(value)
+                value = np.transpose(np.array([costs[use] for use in c.uses]))
+            elif key == 'parking_rates':
+                rates = dict(zip(c.uses, c.parking_rates))
+                rates.update(value)
+                value = np.array([rates[use] for use in c.uses])
+            elif isinstance(value, dict):
+                value = dict(getattr(c, key), **value)
+            setattr(c, key, value)
+
+        pf = copy.copy(self)
+        pf.config = c
+        pf.lookup_key = c.lookup_key()
+        pf._envelope_cache = {}
+        if not pf._load_lookup():
+            pf._generate_lookup()
+            pf._save_lookup()
+        return pf
+
+    def sweep(self, form, df, scenarios, only_built=True, pass_through=None,
+              chunksize=None):
+        """
+        Run the lookup for several scenarios of configuration overrides at
+        once - e.g. alternative cap rates, profit factors, building
+        efficiencies, parking costs or construction costs.  The scenarios are
+        evaluated together as an extra axis of the pro forma matrices, so the
+        parcel side of the lookup is only done once.
+
+        Parameters
+        ----------
+        form : string
+            One of the forms specified in the configuration file
+        df : dataframe
+            The parcel frame - see `lookup`
+        scenarios : list of dicts or dict
+            A list of dictionaries of configuration overrides, one per
+            scenario, where keys are options of `SqFtProFormaConfig` and
+            values are given in the same form as on the configuration (e.g.
+            {"cap_rate": .06, "costs": {"residential": [...]}}).  Dictionary
+            valued options may be given for only some of their keys.  If a
+            dictionary of lists is passed, every combination of the values is
+            a scenario (see `expand_scenarios`).
+        only_built : bool
+            Passed directly to `lookup`
+        pass_through : list of strings
+            Passed directly to `lookup`
+        chunksize : int, optional
+            Evaluate parcels in blocks of this many rows - memory grows with
+            the number of scenarios so this is usually needed for large
+            sweeps
+
+        Returns
+        -------
+        sweep : dataframe
+            The frames returned by `lookup` for each scenario stacked on top
+            of each other, with a scenario column which is the position of the
+            scenario in the list of scenarios
+
+        """
+        if isinstance(scenarios, dict):
+            scenarios = self.expand_scenarios(scenarios)
+        pfs = [self._with_overrides(overrides) for overrides in scenarios]
+
+        if chunksize is None:
+            chunksize = max(len(df), 1)
+        assert chunksize > 0
+
+        frames = []
+        for i in range(0, len(df), chunksize):
+            frames += self._sweep(form, df.iloc[i:i + chunksize], pfs,
+                                  only_built, pass_through)
+        frames = [frame for frame in frames if len(frame) > 0]
+
+        if len(frames) == 0:
+            return pd.DataFrame()
+
+        return pd.concat(frames).sort_values('scenario', kind='mergesort')
+
+    def _sweep(self, form, df, pfs, only_built, pass_through):
+        """
+        Run the sweep for a single block of parcels - returns a list of
+        output frames, one per scenario
+
+        """
+        # the rents are the same in every scenario but the zoning
+        # constraints can depend on the scenario (e.g. through the building
+        # efficiency), so there is one max far per scenario and parcel
+        min_max_fars = np.array([pf._max_fars(form, df)[2] for pf in pfs])
+        df = self._parcel_frame(form, df, pass_through)
+        if only_built:
+            has_size = df.parcel_size.values > 0
+            df = df[has_size]
+            min_max_fars = min_max_fars[:, has_size]
+            # a parcel without a positive max far isn't built in a scenario
+            min_max_fars = np.where(min_max_fars > 0, min_max_fars, -np.inf)
+
+        pruned = [pf._prune(form, df, mmf, only_built)
+                  for pf, mmf in zip(pfs, min_max_fars)]
+        keep = np.any([k for k, _ in pruned], axis=0)
+        num_fars = max([n[:, keep].max() if keep.any() else 0
+                        for _, n in pruned])
+        df = df[keep]
+        min_max_fars = min_max_fars[:, keep]
+        if len(df) == 0:
+            return []
+
+        # the fields of the lookup table for every scenario are stacked into
+        # (scenarios, parking configs, allowed fars, 1) arrays which broadcast
+        # against the parcels
+        def field(name):
+            return np.array([pf._lookup_field(form, name)[:, :num_fars]
+                             for pf in pfs])[..., np.newaxis]
+
+        def scenario_values(name):
+            return np.array([getattr(pf.config, name)
+                             for pf in pfs])[:, np.newaxis, np.newaxis,
+                                             np.newaxis]
+
+        profit = self._profit(
+            df, field('far'), field('ave_cost_sqft'),
+            field('parking_sqft_ratio'), field('height'),
+            min_max_fars=min_max_fars[:, np.newaxis, np.newaxis, :],
+            building_efficiency=scenario_values('building_efficiency'),
+            cap_rate=scenario_values('cap_rate'))[-1]
+
+        maxprofitind = np.argmax(profit.reshape(len(pfs), -1, len(df.index)),
+                                 axis=1)
+        del profit
+
+        frames = []
+        for i, pf in enumerate(pfs):
+            parking_config_ind, far_ind = np.divmod(maxprofitind[i], num_fars)
+            frame = pf._lookup_output(form, df, parking_config_ind, far_ind,
+                                      only_built, pass_through,
+                                      min_max_fars=min_max_fars[i])
+            if len(frame) > 0:
+                frame['scenario'] = i
+            frames.append(frame)
+        return frames
+
     def _debug_output(self):
         """
         this code creates the debugging plots to understand
@@ -714,3 +1995,349 @@ class SqFtProForma(object):
                 title='Parking type')
             cnt += 1
         plt.savefig('even_rents.png', bbox_inches=0)
+
+
+class IncrementalFeasibility(object):
+    """
+    Keeps the feasibility computed for each form in the previous call (e.g.
+    the previous simulation year) along with the parcel inputs it was
+    computed from.  The next call only looks up parcels whose inputs
+    changed, so the cost of computing feasibility every year is
+    proportional to the number of parcels whose prices, zoning or
+    buildings changed rather than to the number of parcels.
+
+    The parcel inputs compared are the rents for each use, land_cost,
+    parcel_size, max_far, max_height, max_dua, ave_unit_size, the pass
+    through columns and whether each form is allowed on the parcel.  Any
+    change to the pro forma configuration or to the lookup options starts
+    over with a full lookup.
+
+    """
+
+    def __init__(self):
+        self.key = None
+        self.inputs = None
+        self.allowed = {}
+        self.results = {}
+
+    def reset(self):
+        self.key = None
+        self.inputs = None
+        self.allowed = {}
+        self.results = {}
+
+    def lookup_forms(self, pf, forms, df, allowed=None, only_built=True,
+                     pass_through=None, **kwargs):
+        """
+        Same as `SqFtProForma.lookup_forms` but only parcels which are new or
+        whose inputs changed since the previous call are looked up - the
+        results for all other parcels are reused.
+
+        Parameters
+        ----------
+        pf : `SqFtProForma`
+            The pro forma to use for the lookup
+        forms, df, allowed, only_built, pass_through
+            See `SqFtProForma.lookup_forms`
+        kwargs
+            Passed directly to `SqFtProForma.lookup_forms`
+
+        Returns
+        -------
+        feasibility : dict
+            A dictionary where keys are the forms and values are the frames
+            returned by `SqFtProForma.lookup`.  The frames are copies, so they
+            can be modified by the caller.
+
+        """
+        c = pf.config
+        columns = c.uses + ['land_cost', 'parcel_size', 'max_far',
+                            'max_height', 'max_dua', 'ave_unit_size']
+        columns += list(pass_through or [])
+        columns = [col for i, col in enumerate(columns)
+                   if col in df.columns and col not in columns[:i]]
+
+        key = (pf.lookup_key, only_built, tuple(pass_through or []),
+               tuple(columns), kwargs.get("engine", "grid"))
+        if key != self.key:
+            self.reset()
+            self.key = key
+
+        inputs = df[columns]
+        if self.inputs is None:
+            changed = np.ones(len(df.index), dtype='bool')
+        else:
+            # new parcels don't exist in the previous inputs so they come
+            # back all nan and are always marked as changed
+            prev = self.inputs.reindex(inputs.index)
+            same = (inputs == prev) | (inputs.isnull() & prev.isnull())
+            changed = ~same.all(axis=1).values
+            changed |= ~inputs.index.isin(self.inputs.index)
+
+        masks = {}
+        for form in forms:
+            if allowed is None:
+                mask = pd.Series(True, index=df.index)
+            else:
+                mask = pd.Series(np.asarray(allowed[form], dtype='bool'),
+                                 index=df.index)
+            dirty = changed.copy()
+            if form in self.allowed:
+                dirty |= (mask != self.allowed[form].reindex(
+                    df.index).fillna(False)).values
+            else:
+                dirty[:] = True
+            masks[form] = mask.values & dirty
+            self.allowed[form] = mask
+
+        logger.debug("Looking up %d of %d parcels which changed since the "
+                     "previous feasibility" % (changed.sum(), len(changed)))
+        new = pf.lookup_forms(forms, df, masks, only_built=only_built,
+                              pass_through=pass_through, **kwargs)
+
+        d = {}
+        for form in forms:
+            # reuse results for parcels which are still present and allowed
+            # and whose inputs didn't change
+            clean = df.index[self.allowed[form].values & ~masks[form]]
+            frames = [new[form]]
+            if form in self.results and len(self.results[form]) > 0:
+                prev = self.results[form]
+                frames.insert(0, prev[prev.index.isin(clean)])
+            frames = [f for f in frames if len(f) > 0]
+            if len(frames) == 0:
+                result = pd.DataFrame()
+            else:
+                result = pd.concat(frames)
+                # keep the parcel order of the input frame
+                result = result.iloc[np.argsort(
+                    df.index.get_indexer(result.index), kind='mergesort')]
+            self.results[form] = result
+            d[form] = result.copy()
+
+        self.inputs = inputs.copy()
+        return d
+
+
+def _fused_kernel(fars, cost_sqft, parking_sqft_ratio, heights, num_allowed,
+                  min_max_fars, max_height, parcel_size, land_cost,
+                  weighted_rent, building_efficiency, cap_rate, tolerance,
+                  one):
+    """
+    The loop of the fused engine for numba - the same pro forma as
+    `SqFtProForma._profit` for one candidate building at a time
+
+    """
+    num_configs = fars.shape[0]
+    num_parcels = parcel_size.shape[0]
+    parking_config_ind = np.zeros(num_parcels, dtype=np.int64)
+    far_ind = np.zeros(num_parcels, dtype=np.int64)
+
+    for n in range(num_parcels):
+        best_profit = -np.inf
+        for i in range(num_configs):
+            # fars past the allowed prefix are never allowed on this parcel
+            for j in range(num_allowed[i, n]):
+                if fars[i, j] > min_max_fars[n] + tolerance or \
+                        heights[i, j] > max_height[n] + tolerance:
+                    continue
+                building_bulk = fars[i, j] * parcel_size[n]
+                total_cost = building_bulk * cost_sqft[i, j] + land_cost[n]
+                building_revenue = building_bulk * \
+                    (one - parking_sqft_ratio[i, j]) * building_efficiency * \
+                    weighted_rent[n] / cap_rate
+                profit = building_revenue - total_cost
+                # nan profits are never better
+                if profit > best_profit:
+                    best_profit = profit
+                    parking_config_ind[n] = i
+                    far_ind[n] = j
+
+    return parking_config_ind, far_ind
+
+
+_jit_kernels = {}
+
+
+def _jit_fused_kernel():
+    """
+    The numba compiled fused kernel, or None if numba isn't installed
+
+    """
+    if "fused" not in _jit_kernels:
+        try:
+            import numba
+        except ImportError:
+            _jit_kernels["fused"] = None
+        else:
+            _jit_kernels["fused"] = numba.njit(nogil=True)(_fused_kernel)
+    return _jit_kernels["fused"]
+
+
+def _upper_envelope(slopes, intercepts):
+    """
+    The upper envelope of the lines y = slopes * x + intercepts
+
+    Returns
+    -------
+    hull : list
+        The indexes of the lines on the envelope, ordered by slope.  Lines
+        with nan coefficients are ignored and of lines with the same slope and
+        intercept the first one is used.
+    breaks : list
+        The x values at which each line on the envelope takes over from the
+        previous one - one fewer than the number of lines
+
+    """
+    valid = np.flatnonzero(~(np.isnan(slopes) | np.isnan(intercepts)))
+    order = valid[np.lexsort((valid, -intercepts[valid], slopes[valid]))]
+
+    hull, breaks = [], []
+    for i in order:
+        # lines with the same slope are sorted by decreasing intercept
+        if hull and slopes[hull[-1]] == slopes[i]:
+            continue
+        while hull:
+            x = (intercepts[hull[-1]] - intercepts[i]) / \
+                (slopes[i] - slopes[hull[-1]])
+            if breaks and x <= breaks[-1]:
+                hull.pop()
+                breaks.pop()
+            else:
+                breaks.append(x)
+                break
+        hull.append(i)
+
+    return hull, breaks
+
+
+class _SharedParcels(object):
+    """
+    Parcel columns copied once into shared memory blocks so that worker
+    processes can read them without pickling the parcel frame for every
+    task.  Columns which can't live in a flat buffer (e.g. strings) are
+    sent along with each task instead.
+
+    """
+
+    def __init__(self, df, columns):
+        from multiprocessing import shared_memory
+
+        self._blocks = []
+        self.specs = []
+        self.objects = {}
+        arrays = [('index', df.index.values)] + \
+            [(col, df[col].values) for col in columns]
+        for name, arr in arrays:
+            if arr.dtype.hasobject:
+                self.objects[name] = arr
+                continue
+            arr = np.ascontiguousarray(arr)
+            shm = shared_memory.SharedMemory(create=True,
+                                             size=max(arr.nbytes, 1))
+            np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)[:] = arr
+            self._blocks.append(shm)
+            self.specs.append((name, shm.name, arr.dtype.str, arr.shape))
+        self.index_name = df.index.name
+        self.columns = columns
+
+    def task(self, rows):
+        """
+        The payload for a worker which should look up the parcels at the
+        positions given by rows
+
+        """
+        return {
+            "rows": rows,
+            "specs": self.specs,
+            "objects": {name: arr[rows] for name, arr in self.objects.items()},
+            "index_name": self.index_name,
+            "columns": self.columns
+        }
+
+    def close(self):
+        for shm in self._blocks:
+            shm.close()
+            shm.unlink()
+        self._blocks = []
+
+
+class _SharedProForma(object):
+    """
+    A pro forma (with its lookup table) pickled once into a shared memory
+    block, so it isn't pickled and sent with every task.  Each worker
+    process unpickles it once and keeps it for the following tasks.
+
+    """
+
+    def __init__(self, pf):
+        from multiprocessing import shared_memory
+
+        data = pickle.dumps(pf, protocol=pickle.HIGHEST_PROTOCOL)
+        self._shm = shared_memory.SharedMemory(create=True, size=len(data))
+        self._shm.buf[:len(data)] = data
+        self.spec = (uuid.uuid4().hex, self._shm.name, len(data))
+
+    def close(self):
+        self._shm.close()
+        self._shm.unlink()
+
+
+# the pro forma most recently unpickled by this worker process, keyed by the
+# key of its _SharedProForma spec
+_worker_pro_forma = {}
+
+
+def _worker_context(pf_spec, context):
+    """
+    The pro forma of a task, unpickled from shared memory the first time the
+    worker sees it, and the debug sink of this process set up like the sink
+    of the process which submitted the task
+    """
+    from multiprocessing import shared_memory
+
+    key, shm_name, size = pf_spec
+    if key not in _worker_pro_forma:
+        shm = shared_memory.SharedMemory(name=shm_name)
+        try:
+            pf = pickle.loads(bytes(shm.buf[:size]))
+        finally:
+            shm.close()
+        _worker_pro_forma.clear()
+        _worker_pro_forma[key] = pf
+
+    if debugsink.get_debug_sink().settings() != context["sink"]:
+        debugsink.set_debug_sink(debugsink.DebugSink(**context["sink"]))
+
+    return _worker_pro_forma[key]
+
+
+def _lookup_worker(pf_spec, form, task, only_built, pass_through, chunksize,
+                   engine, context):
+    """
+    Rebuild the parcel frame for a task from shared memory and run the
+    lookup - runs in a worker process.  Returns the lookup and the records
+    of its span, which the submitting process adds to its recorder.
+
+    """
+    from multiprocessing import shared_memory
+
+    pf = _worker_context(pf_spec, context)
+
+    rows = task["rows"]
+    data = dict(task["objects"])
+    for name, shm_name, dtype, shape in task["specs"]:
+        shm = shared_memory.SharedMemory(name=shm_name)
+        try:
+            data[name] = np.ndarray(shape, dtype=dtype, buffer=shm.buf)[rows]
+        finally:
+            shm.close()
+
+    index = pd.Index(data.pop("index"), name=task["index_name"])
+    df = pd.DataFrame({col: data[col] for col in task["columns"]}, index=index)
+
+    recorder = instrument.Recorder(enabled=context["recording"])
+    with recorder.span("lookup." + form, rows=len(df)):
+        result = pf.lookup(form, df, only_built, pass_through, chunksize,
+                           engine)
+    return result, recorder.records
@@ -0,0 +1,105 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from ..developer import Developer
+from ..buildings import BuildingIdAllocator, BuildingStore
+
+
+@pytest.fixture
+def buildings():
+    df = pd.DataFrame({
+        "parcel_id": [1, 1, 2, 3, 4],
+        "residential_units": [10, 20, 30, 40, 50]
+    }, index=pd.Index([3, 5, 8, 9, 12], name="building_id"))
+    return df
+
+
+@pytest.fixture
+def new_buildings():
+    return pd.DataFrame({
+        "parcel_id": [1, 4],
+        "residential_units": [100, 200],
+        "max_profit": [1., 2.]
+    })
+
+
+def test_allocator_never_reuses_ids():
+    allocator = BuildingIdAllocator.from_index(pd.Index([4, 7]))
+    assert list(allocator.allocate(2)) == [8, 9]
+    assert list(allocator.allocate(1)) == [10]
+
+
+def test_store_changes(buildings, new_buildings):
+    original = buildings.copy()
+    store = BuildingStore(buildings)
+
+    removed = store.remove_parcels(new_buildings.parcel_id)
+    assert list(removed.index) == [3, 5, 12]
+    index = store.append(new_buildings)
+    assert list(index) == [13, 14]
+    assert len(store) == 4
+
+    df = store.to_frame()
+    assert df is not buildings
+    assert list(df.index) == [8, 9, 13, 14]
+    assert list(df.columns) == list(buildings.columns)
+    assert list(df.residential_units) == [30, 40, 100, 200]
+    # the frame the store was created with isn't changed
+    pd.testing.assert_frame_equal(buildings, original)
+
+
+def test_store_syncs_with_table(buildings, new_buildings):
+    store = BuildingStore(buildings)
+    assert store.to_frame() is buildings
+
+    store.remove_parcels([4])
+    table = store.to_frame()
+    # another model updates the table in place, and a new frame replaces it
+    table.loc[8, "residential_units"] = 31
+    table = table.assign(residential_units=table.residential_units + 1)
+
+    store.sync(table)
+    store.remove_parcels([1])
+    store.append(new_buildings)
+    df = store.to_frame()
+    assert list(df.index) == [8, 9, 13, 14]
+    assert list(df.residential_units) == [32, 41, 100, 200]
+
+    # the ids of removed buildings are never given to new buildings
+    store.sync(df)
+    store.remove([13, 14])
+    index = store.append(new_buildings)
+    assert list(index) == [15, 16]
+    assert not np.in1d(store.to_frame().index, [3, 5, 12, 13, 14]).any()
+
+
+def test_store_ids_after_synced_ids(buildings, new_buildings):
+    store = BuildingStore(buildings)
+    store.append(new_buildings)
+    df = store.to_frame()
+
+    # another model adds buildings with ids the store hasn't handed out
+    added = new_buildings.drop(columns="max_profit")
+    added.index = pd.Index([15, 20], name="building_id")
+    store.sync(pd.concat([df, added]))
+
+    index = store.append(new_buildings)
+    assert list(index) == [21, 22]
+    assert store.to_frame().index.is_unique
+
+
+def test_store_to_frame_verifies_ids(buildings, new_buildings):
+    store = BuildingStore(buildings)
+    store.id_allocator.next_id = 12
+    store.append(new_buildings)
+    with pytest.raises(ValueError):
+        store.to_frame()
+
+
+def test_merge_ids_after_old_ids(buildings, new_buildings):
+    allocator = BuildingIdAllocator(5)
+    df, index = Developer.merge(buildings, new_buildings, return_index=True,
+                                id_allocator=allocator)
+    assert list(index) == [13, 14]
+    assert allocator.next_id == 15
@@ -0,0 +1,104 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from .. import debugsink
+
+
+@pytest.fixture
+def table():
+    rng = np.random.RandomState(0)
+    return pd.DataFrame({"a": rng.rand(50), "b": np.arange(50)},
+                        index=pd.Index(np.arange(50) * 2, name="parcel_id"))
+
+
+def read(sink, name):
+    path = sink.path(name)
+    if sink.fmt == "csv":
+        return pd.read_csv(path, index_col=0)
+    if sink.fmt == "pickle":
+        return pd.read_pickle(path)
+    if sink.fmt == "parquet":
+        return pd.read_parquet(path).set_index("parcel_id")
+    return pd.read_feather(path).set_index("parcel_id")
+
+
+def test_off_writes_nothing(table, tmpdir):
+    sink = debugsink.DebugSink(out_dir=str(tmpdir.join("debug")))
+    assert not sink.enabled
+    sink.write("table", table)
+    sink.close()
+    assert not os.path.exists(str(tmpdir.join("debug")))
+
+
+@pytest.mark.parametrize("asynchronous", [False, True])
+@pytest.mark.parametrize("fmt", ["pickle", "parquet", "csv"])
+@pytest.mark.parametrize("level", ["sampled", "full"])
+def test_levels_and_formats(table, tmpdir, level, fmt, asynchronous):
+    if fmt == "parquet":
+        pytest.importorskip("pyarrow")
+    sink = debugsink.DebugSink(level=level, out_dir=str(tmpdir.join("debug")),
+                               fmt=fmt, sample_size=10,
+                               asynchronous=asynchronous, random_state=1)
+    sink.write("table", table)
+    # the table is copied when it is written, so the caller can change it
+    table["a"] = -1.0
+    sink.flush()
+
+    written = read(sink, "table")
+    assert written.index.name == "parcel_id"
+    if level == "full":
+        assert len(written) == len(table)
+    else:
+        # a reproducible sample of the rows
+        assert len(written) == 10
+        assert written.index.isin(table.index).all()
+        other = debugsink.DebugSink(
+            level=level, out_dir=str(tmpdir.join("other")), fmt=fmt,
+            sample_size=10, asynchronous=False, random_state=1)
+        other.write("table", table)
+        assert list(read(other, "table").index) == list(written.index)
+    assert (written.a >= 0).all()
+    np.testing.assert_array_equal(written.b.values, written.index.values / 2)
+    sink.close()
+
+
+def test_small_tables_are_not_sampled(table, tmpdir):
+    sink = debugsink.DebugSink(level="sampled", out_dir=str(tmpdir),
+                               fmt="pickle", sample_size=100,
+                               asynchronous=False)
+    sink.write("table", table)
+    pd.testing.assert_frame_equal(read(sink, "table"), table)
+
+
+def test_columnar_formats_flatten_columns(table, tmpdir):
+    pytest.importorskip("pyarrow")
+    sink = debugsink.DebugSink(level="full", out_dir=str(tmpdir),
+                               fmt="parquet", asynchronous=False)
+    wide = pd.concat([table, table], keys=["residential", "office"], axis=1)
+    sink.write("wide", wide)
+    sink.write("series", table.a)
+    assert list(pd.read_parquet(sink.path("wide")).columns) == [
+        "parcel_id", "residential.a", "residential.b", "office.a", "office.b"]
+    assert list(pd.read_parquet(sink.path("series")).columns) == [
+        "parcel_id", "a"]
+
+
+def test_set_debug_sink_flushes_previous(table, tmpdir):
+    sink = debugsink.DebugSink(level="full", out_dir=str(tmpdir),
+                               fmt="pickle", asynchronous=True)
+    previous = debugsink.set_debug_sink(sink)
+    try:
+        assert debugsink.get_debug_sink() is sink
+        sink.write("table", table)
+    finally:
+        assert debugsink.set_debug_sink(previous) is sink
+    # the pending write finished when the sink was replaced
+    assert os.path.exists(sink.path("table"))
+    sink.close()
+
+    settings = sink.settings()
+    assert settings["asynchronous"] is False
+    assert debugsink.DebugSink(**settings).path("table") == sink.path("table")
@@ -0,0 +1,126 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from .. import developer, sqftproforma
+from ..benchmark import synthetic_parcels
+
+
+class StackDeveloper(developer.Developer):
+    """
+    The developer with the original stack / unstack implementation of
+    keep_form_with_max_profit
+    """
+
+    @staticmethod
+    def _max_form(f, colname):
+        df = f.stack(level=0)[[colname]].stack().unstack(level=1).\
+            reset_index(level=1, drop=True)
+        return df.idxmax(axis=1)
+
+    def keep_form_with_max_profit(self, forms=None):
+        f = self.feasibility
+        if forms is not None:
+            f = f[forms]
+        mu = self._max_form(f, "max_profit")
+        indexes = [tuple(x) for x in mu.reset_index().values]
+        df = f.stack(level=0).loc[indexes]
+        df.index.names = ["parcel_id", "form"]
+        return df.reset_index(level=1)
+
+
+@pytest.fixture
+def parcels():
+    return synthetic_parcels(3000, seed=3)
+
+
+@pytest.fixture
+def wide(parcels):
+    pf = sqftproforma.SqFtProForma()
+    d = pf.lookup_forms(sorted(pf.config.forms), parcels)
+    wide = pd.concat(d.values(), keys=d.keys(), axis=1)
+    # the parcels in no particular order, as concat leaves them
+    return wide.sample(frac=1, random_state=0)
+
+
+FORMS = [None, ["residential", "mixedresidential", "office"],
+         ["residential"]]
+
+
+def pick(dev, parcels, forms):
+    np.random.seed(0)
+    return dev.pick(forms or sorted(dev.feasibility.columns.levels[0]), 2000,
+                    parcels.parcel_size, parcels.ave_unit_size.copy(),
+                    pd.Series(0, index=parcels.index))
+
+
+@pytest.mark.parametrize("forms", FORMS)
+def test_keep_form_with_max_profit(wide, forms):
+    expected = StackDeveloper(wide).keep_form_with_max_profit(forms)
+    actual = developer.Developer(wide).keep_form_with_max_profit(forms)
+    pd.testing.assert_frame_equal(actual, expected, check_dtype=False)
+
+
+@pytest.mark.parametrize("forms", FORMS)
+def test_pick_matches_stack_implementation(wide, parcels, forms):
+    expected = pick(StackDeveloper(wide), parcels, forms)
+    actual = pick(developer.Developer(wide), parcels, forms)
+    pd.testing.assert_frame_equal(actual, expected, check_dtype=False)
+
+
+def test_sample_keys_skips_zero_probabilities():
+    p = np.array([.5, 0, .3, 0, .2])
+    net_units = np.ones(5)
+    for seed in range(20):
+        # the target can't be met without the zero probability buildings
+        sampled = developer.Developer._sample_keys(p, net_units, 5, seed)
+        assert sorted(sampled) == [0, 2, 4]
+    assert len(developer.Developer._sample_keys(
+        np.zeros(3), np.ones(3), 2, 0)) == 0
+
+
+def test_sample_keys_seed():
+    r = np.random.RandomState(0)
+    p = r.rand(1000)
+    p /= p.sum()
+    net_units = r.randint(1, 10, 1000).astype("float")
+    a = developer.Developer._sample_keys(p, net_units, 500, 1)
+    b = developer.Developer._sample_keys(p, net_units, 500, 1)
+    c = developer.Developer._sample_keys(p, net_units, 500, 2)
+    assert (a == b).all()
+    assert net_units[a].sum() >= 500 > net_units[a[:-1]].sum()
+    assert not np.array_equal(a, c)
+
+
+def test_pick_demands_draw_independently(wide, parcels):
+    demand = {"form": ["residential", "mixedresidential"],
+              "target_units": 500,
+              "current_units": pd.Series(0, index=parcels.index)}
+    new_buildings = developer.Developer(wide).pick_demands(
+        {"a": demand, "b": demand}, parcels.parcel_size,
+        parcels.ave_unit_size.copy(), drop_after_build=False,
+        sampler="keys", seed=0)
+    a, b = new_buildings["a"].parcel_id, new_buildings["b"].parcel_id
+    # the same candidates but different draws
+    assert not np.array_equal(a.values, b.values)
+
+    # and the draws are reproducible
+    again = developer.Developer(wide).pick_demands(
+        {"a": demand, "b": demand}, parcels.parcel_size,
+        parcels.ave_unit_size.copy(), drop_after_build=False,
+        sampler="keys", seed=0)
+    pd.testing.assert_series_equal(again["b"].parcel_id, b)
+
+
+def test_pick_doesnt_copy_feasibility_for_debugging(wide, parcels):
+    dev = developer.Developer(wide)
+    forms = ["residential", "mixedresidential"]
+    assert pick(dev, parcels, forms) is not None
+    assert dev._num_built > 0
+
+    # with the debug sink off the feasibility of the available parcels is
+    # never put together
+    def feasibility_frame():
+        raise AssertionError("feasibility_frame was called")
+    dev.feasibility_frame = feasibility_frame
+    assert pick(dev, parcels, forms) is not None
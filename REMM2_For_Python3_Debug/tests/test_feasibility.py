@@ -0,0 +1,58 @@
+import pandas as pd
+import pytest
+
+from .. import developer, feasibility, sqftproforma
+from ..benchmark import synthetic_parcels
+
+REMM_FORMS = ["residential", "industrial", "retail", "office"]
+
+
+@pytest.fixture
+def parcels():
+    df = synthetic_parcels(3000, seed=2)
+    df["shape_area"] = df.parcel_size
+    return df
+
+
+@pytest.fixture
+def pf():
+    return sqftproforma.SqFtProForma()
+
+
+def wide_profit_per_sqft(d):
+    d = feasibility.profit_per_sqft(d, REMM_FORMS)
+    return pd.concat(d.values(), keys=d.keys(), axis=1)
+
+
+def test_sparse_and_wide_profit_per_sqft(pf, parcels):
+    forms = sorted(pf.config.forms)
+    d = pf.lookup_forms(forms, parcels, pass_through=["shape_area"])
+    wide = wide_profit_per_sqft(d)
+    sparse = feasibility.FeasibilityStore.from_forms(
+        feasibility.profit_per_sqft(d, REMM_FORMS)).to_frame()
+
+    for form in forms:
+        expected = wide[form].max_profit.dropna().sort_index()
+        actual = sparse.max_profit[sparse.form == form].sort_index()
+        pd.testing.assert_series_equal(actual, expected, check_names=False)
+        if form in REMM_FORMS:
+            f = d[form].sort_index()
+            pd.testing.assert_series_equal(
+                actual, f.max_profit / (f.max_profit_far * f.shape_area),
+                check_names=False)
+
+
+def test_top_forms_rank_by_profit_per_sqft(pf, parcels):
+    forms = sorted(pf.config.forms)
+    top = pf.lookup_top_forms(
+        forms, parcels, k=1, pass_through=["shape_area"],
+        score=feasibility.profit_per_sqft_score(REMM_FORMS))
+    top = feasibility.profit_per_sqft(top, REMM_FORMS)
+
+    wide = wide_profit_per_sqft(pf.lookup_forms(
+        forms, parcels, pass_through=["shape_area"]))
+    best = developer.Developer(wide).keep_form_with_max_profit().sort_index()
+
+    assert top.index.equals(best.index)
+    assert (top.form == best.form).all()
+    pd.testing.assert_series_equal(top.max_profit, best.max_profit)
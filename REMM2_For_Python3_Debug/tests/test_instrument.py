@@ -0,0 +1,55 @@
+import collections
+import sys
+
+import numpy as np
+import pytest
+
+from .. import instrument
+
+
+def test_spans():
+    recorder = instrument.Recorder()
+    recorder.year = 2020
+    with recorder.span("outer", rows=10):
+        with recorder.span("inner") as span:
+            span.rows = 5
+
+    df = recorder.to_frame()
+    assert list(df.stage) == ["outer/inner", "outer"]
+    assert list(df.rows) == [5, 10]
+    assert (df.year == 2020).all()
+    assert (df.wall_seconds >= 0).all()
+
+
+@pytest.mark.skipif(not sys.platform.startswith("linux"),
+                    reason="memory is read from /proc without psutil")
+def test_span_memory():
+    recorder = instrument.Recorder()
+    with recorder.span("allocate"):
+        kept = np.ones(50 * 1000 * 1000 // 8)
+    with recorder.span("nothing"):
+        pass
+
+    df = recorder.to_frame().set_index("stage")
+    # the memory allocated in the span, not the peak of the process
+    assert df.rss_delta_mb["allocate"] > 40
+    assert abs(df.rss_delta_mb["nothing"]) < 10
+    assert df.max_rss_mb["allocate"] > df.rss_delta_mb["allocate"]
+    del kept
+
+
+def test_span_memory_from_psutil(monkeypatch):
+    # windows has no resource module or /proc, only psutil
+    info = collections.namedtuple("info", ["rss", "peak_wset"])
+    values = iter([100e6, 150e6])
+    monkeypatch.setitem(sys.modules, "resource", None)
+    monkeypatch.setattr(instrument, "_memory_info",
+                        lambda: info(next(values, 150e6), 300e6))
+
+    recorder = instrument.Recorder()
+    with recorder.span("stage"):
+        pass
+
+    record = recorder.records[0]
+    assert record["rss_delta_mb"] == pytest.approx(50)
+    assert record["max_rss_mb"] == pytest.approx(300)
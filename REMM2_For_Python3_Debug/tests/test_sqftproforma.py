@@ -0,0 +1,603 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from .. import debugsink, instrument, sqftproforma
+from ..benchmark import synthetic_parcels
+
+FORMS = ["industrial", "mixedoffice", "mixedresidential", "office",
+         "residential", "retail"]
+
+
+def baseline_building_cost(c, use_mix, stories):
+    """
+    The original building cost of one form
+    """
+    heights = stories * c.height_per_story
+    costs = np.searchsorted(c.heights_for_costs, heights)
+    costs[np.isnan(heights)] = 0
+    costs = np.dot(np.squeeze(c.costs[costs.astype('int32')]), use_mix)
+    costs[np.isnan(stories).flatten()] = np.nan
+    return costs.flatten()
+
+
+def baseline_dev_d(c):
+    """
+    The original lookup - a frame per form and parking config - for a
+    converted configuration
+    """
+    df_d = {}
+    for name in sorted(c.forms.keys()):
+        uses_distrib = c.forms[name]
+        for parking_config in c.parking_configs:
+            df = pd.DataFrame(index=c.fars)
+            df['far'] = c.fars
+            df['pclsz'] = c.tiled_parcel_sizes
+            building_bulk = np.reshape(
+                c.parcel_sizes, (-1, 1)) * np.reshape(c.fars, (1, -1))
+            building_bulk = np.reshape(building_bulk, (-1, 1))
+            if parking_config == 'deck':
+                building_bulk /= (1.0 + np.sum(uses_distrib * c.parking_rates) *
+                                  c.parking_sqft_d[parking_config] /
+                                  c.sqft_per_rate)
+            df['building_sqft'] = building_bulk
+            parkingstalls = building_bulk * \
+                np.sum(uses_distrib * c.parking_rates) / c.sqft_per_rate
+            parking_cost = (c.parking_cost_d[parking_config] * parkingstalls *
+                            c.parking_sqft_d[parking_config])
+            df['spaces'] = parkingstalls
+            if parking_config == 'underground':
+                df['park_sqft'] = parkingstalls * \
+                    c.parking_sqft_d[parking_config]
+                stories = building_bulk / c.tiled_parcel_sizes
+            if parking_config == 'deck':
+                df['park_sqft'] = parkingstalls * \
+                    c.parking_sqft_d[parking_config]
+                stories = ((building_bulk + parkingstalls *
+                            c.parking_sqft_d[parking_config]) /
+                           c.tiled_parcel_sizes)
+            if parking_config == 'surface':
+                stories = building_bulk / \
+                    (c.tiled_parcel_sizes - parkingstalls *
+                     c.parking_sqft_d[parking_config])
+                df['park_sqft'] = 0
+                stories[stories < 0.0] = np.nan
+                stories[stories > 5.0] = np.nan
+            df['total_built_sqft'] = df.building_sqft + df.park_sqft
+            df['parking_sqft_ratio'] = df.park_sqft / df.total_built_sqft
+            stories /= c.parcel_coverage
+            df['stories'] = np.ceil(stories)
+            df['height'] = df.stories * c.height_per_story
+            df['build_cost_sqft'] = baseline_building_cost(c, uses_distrib,
+                                                           stories)
+            df['build_cost'] = df.build_cost_sqft * df.building_sqft
+            df['park_cost'] = parking_cost
+            df['cost'] = df.build_cost + df.park_cost
+            df['ave_cost_sqft'] = (df.cost / df.total_built_sqft) * \
+                c.profit_factor
+            if name == 'retail':
+                df.loc[c.fars > c.max_retail_height, 'ave_cost_sqft'] = np.nan
+            if name == 'industrial':
+                df.loc[c.fars > c.max_industrial_height,
+                       'ave_cost_sqft'] = np.nan
+            df_d[(name, parking_config)] = df
+    return df_d
+
+
+def baseline_lookup(pf, form, df, only_built=True, pass_through=None):
+    """
+    The original lookup - a lookup per parking config, on the lookup table
+    of pf, and a pivot to pick the most profitable parking config
+    """
+    def lookup_parking_cfg(parking_config):
+        dev_info = pf.get_debug_info(form, parking_config)
+        cost_sqft_col = np.reshape(dev_info.ave_cost_sqft.values, (-1, 1))
+        parking_sqft_ratio = np.reshape(
+            dev_info.parking_sqft_ratio.values, (-1, 1))
+        heights = np.reshape(dev_info.height.values, (-1, 1))
+
+        c = pf.config
+        f = df.copy()
+        f['weighted_rent'] = np.dot(f[c.uses], c.forms[form])
+        f['max_far_from_heights'] = f.max_height / c.height_per_story * \
+            c.parcel_coverage
+        resratio = c.res_ratios[form]
+        if 'max_dua' in f.columns and resratio > 0:
+            f['max_far_from_dua'] = f.max_dua * (f.parcel_size / 43560) * \
+                f.ave_unit_size / c.building_efficiency / resratio / \
+                f.parcel_size
+            f['min_max_fars'] = f[['max_far_from_heights', 'max_far',
+                                   'max_far_from_dua']].min(axis=1)
+        else:
+            f['min_max_fars'] = f[['max_far_from_heights',
+                                   'max_far']].min(axis=1)
+            f['max_far_from_dua'] = 0
+        if only_built:
+            f = f.query('min_max_fars > 0 and parcel_size > 0')
+
+        fars = np.repeat(np.reshape(dev_info.index.values, (-1, 1)),
+                         len(f.index), axis=1)
+        fars[fars > f.min_max_fars.values + .01] = np.nan
+        heights = np.repeat(heights, len(f.index), axis=1)
+        fars[heights > f.max_height.values + .01] = np.nan
+        building_bulks = fars * f.parcel_size.values
+        building_costs = building_bulks * cost_sqft_col
+        total_costs = building_costs + f.land_cost.values
+        building_revenue = building_bulks * (1 - parking_sqft_ratio) * \
+            c.building_efficiency * f.weighted_rent.values / c.cap_rate
+        profit = (building_revenue - total_costs).astype('float')
+        profit[np.isnan(profit)] = -np.inf
+        ind = np.argmax(profit, axis=0)
+
+        def twod_get(arr):
+            return arr[ind, np.arange(ind.size)].astype('float')
+
+        outdf = pd.DataFrame({
+            'building_sqft': twod_get(building_bulks),
+            'building_cost': twod_get(building_costs),
+            'parking_ratio': parking_sqft_ratio[ind].flatten(),
+            'stories': twod_get(heights) / c.height_per_story,
+            'total_cost': twod_get(total_costs),
+            'building_revenue': twod_get(building_revenue),
+            'max_profit_far': twod_get(fars),
+            'max_profit': twod_get(profit),
+            'parking_config': parking_config
+        }, index=f.index)
+        if pass_through:
+            outdf[pass_through] = f[pass_through]
+        outdf["residential_sqft"] = outdf.building_sqft * \
+            c.building_efficiency * resratio
+        outdf["non_residential_sqft"] = outdf.building_sqft * \
+            c.building_efficiency * (1.0 - resratio)
+        if only_built:
+            return outdf.query('max_profit > 0').copy()
+        return outdf.loc[outdf.max_profit != -np.inf].copy()
+
+    df = pd.concat(lookup_parking_cfg(parking_config)
+                   for parking_config in pf.config.parking_configs)
+    max_profit_ind = df.pivot(
+        columns="parking_config",
+        values="max_profit").idxmax(axis=1).to_frame("parking_config")
+    df.set_index(["parking_config"], append=True, inplace=True)
+    max_profit_ind.set_index(["parking_config"], append=True, inplace=True)
+    return df.loc[max_profit_ind.index].reset_index(1)
+
+
+@pytest.fixture
+def parcels():
+    return synthetic_parcels(2000, seed=1)
+
+
+@pytest.fixture
+def pf():
+    return sqftproforma.SqFtProForma()
+
+
+def test_lookup_forms_pool(pf, parcels, tmpdir):
+    forms = ["residential", "office", "retail"]
+    expected = pf.lookup_forms(forms, parcels)
+
+    recorder = instrument.Recorder()
+    previous_recorder = instrument.set_recorder(recorder)
+    previous_sink = debugsink.set_debug_sink(debugsink.DebugSink(
+        level="full", out_dir=str(tmpdir), fmt="pickle", asynchronous=False))
+    try:
+        d = pf.lookup_forms(forms, parcels, n_jobs=2, shards=2)
+    finally:
+        instrument.set_recorder(previous_recorder)
+        debugsink.set_debug_sink(previous_sink)
+
+    for form in forms:
+        pd.testing.assert_frame_equal(d[form], expected[form])
+
+    # the spans and debug tables of the workers aren't lost
+    stages = recorder.to_frame().stage
+    for form in forms:
+        assert (stages == "lookup.pool/lookup." + form).sum() == 2
+    assert os.path.exists(str(tmpdir.join(
+        "debug_urbansimdeveolperprofomay652_outdf.pkl")))
+
+
+@pytest.fixture
+def fresh_cache(monkeypatch):
+    # only read tables from cache_dir, not from the in memory cache
+    monkeypatch.setattr(sqftproforma, "_lookup_cache", {})
+
+
+def cache_files(tmpdir):
+    return sorted(f.basename for f in tmpdir.listdir()
+                  if f.basename.endswith(".npz"))
+
+
+def test_lookup_cache_round_trip(parcels, tmpdir, fresh_cache, monkeypatch):
+    pf = sqftproforma.SqFtProForma(cache_dir=str(tmpdir))
+    assert cache_files(tmpdir) == [
+        "sqftproforma_table_%s.npz" % pf.lookup_key]
+
+    monkeypatch.setattr(sqftproforma, "_lookup_cache", {})
+
+    def generate(self):
+        raise AssertionError("the lookup should be read from the cache")
+
+    with monkeypatch.context() as m:
+        m.setattr(sqftproforma.SqFtProForma, "_generate_lookup", generate)
+        cached = sqftproforma.SqFtProForma(cache_dir=str(tmpdir))
+
+    np.testing.assert_array_equal(cached.lookup_table, pf.lookup_table)
+    assert cached.lookup_parking_configs == pf.lookup_parking_configs
+    pd.testing.assert_frame_equal(cached.lookup("residential", parcels),
+                                  pf.lookup("residential", parcels))
+
+
+def changed_config(change):
+    config = sqftproforma.SqFtProFormaConfig()
+    if change == "costs":
+        config.costs = dict(config.costs)
+        config.costs["residential"] = [c * 1.1 for c in
+                                       config.costs["residential"]]
+    elif change == "fars":
+        config.fars = config.fars[:-3]
+    return config
+
+
+@pytest.mark.parametrize("change", ["costs", "fars"])
+def test_lookup_cache_changed_config(tmpdir, fresh_cache, change):
+    pf = sqftproforma.SqFtProForma(cache_dir=str(tmpdir))
+    changed = sqftproforma.SqFtProForma(changed_config(change),
+                                        cache_dir=str(tmpdir))
+
+    assert changed.lookup_key != pf.lookup_key
+    assert len(cache_files(tmpdir)) == 2
+
+    sqftproforma._lookup_cache.clear()
+    expected = sqftproforma.SqFtProForma(changed_config(change))
+    np.testing.assert_array_equal(changed.lookup_table, expected.lookup_table)
+    if change == "costs":
+        assert not np.array_equal(changed.lookup_table, pf.lookup_table,
+                                  equal_nan=True)
+    else:
+        assert changed.lookup_table.shape[2] == pf.lookup_table.shape[2] - 3
+
+
+@pytest.mark.parametrize("stale", ["other_table", "garbage"])
+def test_lookup_cache_stale_file(tmpdir, fresh_cache, stale):
+    expected = sqftproforma.SqFtProForma()
+    path = str(tmpdir.join("sqftproforma_table_%s.npz" %
+                           expected.lookup_key))
+
+    if stale == "other_table":
+        # e.g. a table of another configuration or version under this key
+        other = sqftproforma.SqFtProForma(changed_config("fars"),
+                                          cache_dir=str(tmpdir))
+        os.rename(other._lookup_cache_path(), path)
+    else:
+        with open(path, "wb") as f:
+            f.write(b"not a lookup table")
+
+    sqftproforma._lookup_cache.clear()
+    pf = sqftproforma.SqFtProForma(cache_dir=str(tmpdir))
+    np.testing.assert_array_equal(pf.lookup_table, expected.lookup_table)
+
+    # the stale file is replaced by the regenerated table
+    sqftproforma._lookup_cache.clear()
+    pf = sqftproforma.SqFtProForma(cache_dir=str(tmpdir))
+    assert pf._is_valid_lookup(pf.lookup_table, pf.lookup_forms_order,
+                               pf.lookup_parking_configs, pf.lookup_fields)
+    np.testing.assert_array_equal(pf.lookup_table, expected.lookup_table)
+
+
+@pytest.mark.parametrize("only_built", [True, False])
+@pytest.mark.parametrize("form", FORMS)
+def test_lookup_matches_baseline(pf, parcels, form, only_built):
+    parcels["shape_area"] = parcels.parcel_size
+    expected = baseline_lookup(pf, form, parcels, only_built,
+                               pass_through=["shape_area"])
+    actual = pf.lookup(form, parcels, only_built,
+                       pass_through=["shape_area"])
+    # the same columns in the same order, and the same rows - the parcels
+    # are sorted by id like the baseline's pivot sorts them
+    pd.testing.assert_frame_equal(actual, expected, check_like=False)
+
+
+def test_lookup_parking_config_ties(parcels):
+    # without parking every parking config gives the same building, and the
+    # baseline's pivot picks the first parking config in sorted order
+    config = sqftproforma.SqFtProFormaConfig()
+    config.parking_rates = {use: 0.0 for use in config.parking_rates}
+    pf = sqftproforma.SqFtProForma(config)
+    expected = baseline_lookup(pf, "residential", parcels)
+    for engine in ["grid", "envelope", "fused"]:
+        actual = pf.lookup("residential", parcels, engine=engine)
+        assert (actual.parking_config == "deck").all()
+        pd.testing.assert_frame_equal(actual, expected, check_like=False)
+
+
+@pytest.mark.parametrize("only_built", [True, False])
+@pytest.mark.parametrize("engine", ["envelope", "fused"])
+@pytest.mark.parametrize("form", FORMS)
+def test_engines_match_grid(pf, parcels, form, engine, only_built):
+    expected = pf.lookup(form, parcels, only_built)
+    actual = pf.lookup(form, parcels, only_built, engine=engine)
+    pd.testing.assert_frame_equal(actual, expected)
+
+    # the parcels include buildings limited by the far and by the height
+    # limit of their zoning
+    c = pf.config
+    zoning = parcels.loc[expected.index]
+    assert np.isclose(expected.max_profit_far, zoning.max_far,
+                      atol=.01).any()
+    assert ((expected.stories + 1) * c.height_per_story >
+            zoning.max_height + .01).any()
+
+
+def test_incremental_feasibility(pf, parcels, monkeypatch):
+    forms = ["residential", "office", "retail"]
+    looked_up = []
+    lookup_forms = pf.lookup_forms
+
+    def spy(forms, df, allowed=None, **kwargs):
+        looked_up.append(sum(allowed[form].sum() for form in forms))
+        return lookup_forms(forms, df, allowed, **kwargs)
+
+
+    rng = np.random.RandomState(0)
+    allowed = {form: pd.Series(rng.rand(len(parcels)) < .9,
+                               index=parcels.index) for form in forms}
+    inc = sqftproforma.IncrementalFeasibility()
+    inc.lookup_forms(pf, forms, parcels, allowed)
+    monkeypatch.setattr(pf, "lookup_forms", spy)
+
+    # next year some prices and zoning change, some parcels are gone, a form
+    # is no longer allowed on a few parcels and there are new parcels
+    df = parcels.copy()
+    df.loc[df.index[:100], "residential"] *= 1.5
+    df.loc[df.index[100:150], "max_far"] = 10.0
+    df.loc[df.index[150:170], "land_cost"] = 0.0
+    df = df.drop(df.index[200:300])
+    new = synthetic_parcels(50, seed=5)
+    new.index = new.index + parcels.index.max()
+    df = pd.concat([df, new])
+    allowed = {form: pd.Series(rng.rand(len(df)) < .9, index=df.index)
+               for form in forms}
+
+    actual = inc.lookup_forms(pf, forms, df, allowed)
+    expected = lookup_forms(forms, df, allowed)
+    # only the changed and new parcels (and parcels where a form became
+    # allowed) are looked up again
+    assert 0 < looked_up[-1] < .5 * len(df) * len(forms)
+    for form in forms:
+        pd.testing.assert_frame_equal(actual[form], expected[form])
+        assert not actual[form].index.isin(parcels.index[200:300]).any()
+        assert actual[form].index.isin(new.index).any()
+
+    # nothing changed - everything is reused
+    actual = inc.lookup_forms(pf, forms, df, allowed)
+    assert looked_up[-1] == 0
+    for form in forms:
+        pd.testing.assert_frame_equal(actual[form], expected[form])
+
+
+def scenario_config(overrides):
+    config = sqftproforma.SqFtProFormaConfig()
+    for key, value in overrides.items():
+        if isinstance(value, dict):
+            value = dict(getattr(config, key), **value)
+        setattr(config, key, value)
+    return config
+
+
+@pytest.mark.parametrize("only_built", [True, False])
+@pytest.mark.parametrize("form", ["residential", "mixedoffice", "retail"])
+def test_sweep_matches_lookup(pf, parcels, form, only_built):
+    scenarios = [
+        {},
+        {"cap_rate": .06, "profit_factor": 1.2},
+        {"building_efficiency": .8},
+        {"parking_cost_d": {"deck": 60, "underground": 150}},
+        {"costs": {"residential": [150.0, 170.0, 190.0, 220.0],
+                   "retail": [180.0, 200.0, 230.0, 260.0]}}
+    ]
+    sweep = pf.sweep(form, parcels, scenarios, only_built=only_built,
+                     chunksize=700)
+    assert sorted(sweep.scenario.unique()) == list(range(len(scenarios)))
+
+    for i, overrides in enumerate(scenarios):
+        expected = sqftproforma.SqFtProForma(
+            scenario_config(overrides)).lookup(form, parcels, only_built)
+        actual = sweep[sweep.scenario.values == i].drop(columns="scenario")
+        pd.testing.assert_frame_equal(actual, expected)
+
+
+@pytest.mark.parametrize("only_built", [True, False])
+@pytest.mark.parametrize("chunksize", [50, 333, 5000])
+def test_lookup_chunksize(pf, parcels, chunksize, only_built):
+    # nothing can be built on the first chunks
+    parcels.loc[parcels.index[:100], "max_far"] = 0.0
+    for form in ["residential", "retail"]:
+        pd.testing.assert_frame_equal(
+            pf.lookup(form, parcels, only_built, chunksize=chunksize),
+            pf.lookup(form, parcels, only_built))
+
+    forms = ["office", "industrial"]
+    expected = pf.lookup_forms(forms, parcels, only_built=only_built)
+    actual = pf.lookup_forms(forms, parcels, only_built=only_built,
+                             chunksize=chunksize)
+    for form in forms:
+        pd.testing.assert_frame_equal(actual[form], expected[form])
+
+
+def test_lookup_table_matches_baseline(pf):
+    expected = baseline_dev_d(pf.config)
+    dev_d = pf.dev_d
+    assert sorted(dev_d) == sorted(expected)
+    for (form, parking_config), df in expected.items():
+        info = pf.get_debug_info(form, parking_config)
+        pd.testing.assert_frame_equal(info, df, check_dtype=False, rtol=1e-12)
+        pd.testing.assert_frame_equal(dev_d[form, parking_config], info)
+        pd.testing.assert_series_equal(
+            pf.get_ave_cost_sqft(form, parking_config), info.ave_cost_sqft)
+        # the frames are views of the one contiguous table
+        np.testing.assert_array_equal(
+            pf.lookup_table[pf.form_index[form],
+                            pf.parking_config_index[parking_config]],
+            info.values)
+    assert pf.lookup_table.flags.c_contiguous
+
+
+def no_prune(self, form, df, min_max_fars, only_built, weighted_rent=None):
+    # evaluate every far on every parcel
+    num_configs, num_fars = self._lookup_field(form, 'far').shape
+    return np.ones(len(df.index), dtype='bool'), \
+        np.full((num_configs, len(df.index)), num_fars)
+
+
+@pytest.mark.parametrize("only_built", [True, False])
+def test_prune_matches_full_grid(pf, parcels, only_built, monkeypatch):
+    expected = {form: pf.lookup(form, parcels, only_built) for form in FORMS}
+    top = pf.lookup_top_forms(FORMS, parcels, k=2, only_built=only_built)
+
+    keep, num_allowed = pf._prune("residential", pf._parcel_frame(
+        "residential", parcels, None), pf._max_fars("residential", parcels)[2],
+        only_built)
+    # pruning drops parcels and fars
+    assert not keep.all()
+    assert (num_allowed < len(pf.config.fars)).any()
+
+    monkeypatch.setattr(sqftproforma.SqFtProForma, "_prune", no_prune)
+    for form in FORMS:
+        pd.testing.assert_frame_equal(
+            expected[form], pf.lookup(form, parcels, only_built))
+    pd.testing.assert_frame_equal(
+        top, pf.lookup_top_forms(FORMS, parcels, k=2, only_built=only_built))
+
+
+@pytest.fixture
+def pf32():
+    config = sqftproforma.SqFtProFormaConfig()
+    config.dtype = "float32"
+    return sqftproforma.SqFtProForma(config)
+
+
+@pytest.mark.parametrize("form", FORMS)
+def test_float32_matches_float64(pf, pf32, parcels, form):
+    expected = pf.lookup(form, parcels)
+    actual = pf32.lookup(form, parcels)
+    assert actual.max_profit.dtype == np.float32
+    pd.testing.assert_frame_equal(actual, expected, check_dtype=False,
+                                  rtol=1e-3)
+
+    comparison = pf32.compare_dtype(form, parcels)
+    assert len(comparison) == len(expected)
+    assert comparison.same_building.all()
+    assert comparison.profit_rel_diff.max() < 1e-3
+
+    for engine in ["envelope", "fused"]:
+        pd.testing.assert_frame_equal(
+            pf32.lookup(form, parcels, engine=engine), actual)
+
+
+def test_building_cost_matches_per_form(pf):
+    c = pf.config
+    forms = sorted(c.forms)
+    rng = np.random.RandomState(0)
+    stories = rng.uniform(0, 40, (len(forms), 3, 50))
+    stories[rng.rand(*stories.shape) < .1] = np.nan
+
+    costs = pf._building_cost(np.array([c.forms[f] for f in forms]), stories)
+    assert costs.shape == stories.shape
+    for i, form in enumerate(forms):
+        for j in range(stories.shape[1]):
+            np.testing.assert_allclose(
+                costs[i, j], baseline_building_cost(
+                    c, c.forms[form], stories[i, j].reshape(-1, 1)),
+                rtol=1e-12)
+
+
+def test_lookup_table_with_more_forms():
+    config = sqftproforma.SqFtProFormaConfig()
+    config.forms = dict(config.forms, townhome={"residential": .9,
+                                                "retail": .1})
+    config.parking_configs = ["underground", "surface", "deck"]
+    pf = sqftproforma.SqFtProForma(config)
+    for (form, parking_config), df in baseline_dev_d(pf.config).items():
+        pd.testing.assert_frame_equal(
+            pf.get_debug_info(form, parking_config), df, check_dtype=False,
+            rtol=1e-12)
+
+
+@pytest.mark.parametrize("compiled", [False, True])
+@pytest.mark.parametrize("dtype", ["float64", "float32"])
+def test_fused_kernel_matches_grid(parcels, dtype, compiled, monkeypatch):
+    if compiled:
+        pytest.importorskip("numba")
+    else:
+        # run the kernel numba would compile as plain python
+        monkeypatch.setattr(sqftproforma, "_jit_fused_kernel",
+                            lambda: sqftproforma._fused_kernel)
+    config = sqftproforma.SqFtProFormaConfig()
+    config.dtype = dtype
+    pf = sqftproforma.SqFtProForma(config)
+    parcels = parcels.iloc[:300]
+    for form in FORMS:
+        for only_built in [True, False]:
+            pd.testing.assert_frame_equal(
+                pf.lookup(form, parcels, only_built, engine="fused"),
+                pf.lookup(form, parcels, only_built))
+
+
+@pytest.mark.parametrize("form", FORMS)
+def test_lookup_derived_columns(pf, parcels, form):
+    original = parcels.copy()
+    pass_through = ["max_far_from_heights", "max_far_from_dua",
+                    "min_max_fars", "weighted_rent", "max_dua"]
+    expected = baseline_lookup(pf, form, parcels, pass_through=pass_through)
+    actual = pf.lookup(form, parcels, pass_through=pass_through)
+    pd.testing.assert_frame_equal(actual, expected)
+
+    # the zoning columns are only derived when they are passed through, and
+    # the parcel frame isn't changed
+    columns = pf.lookup(form, parcels).columns
+    assert "max_far_from_heights" not in columns
+    assert "max_far_from_dua" not in columns
+    pd.testing.assert_frame_equal(parcels, original)
+
+
+@pytest.mark.parametrize("form", ["residential", "retail", "mixedoffice"])
+def test_explain_matches_lookup(pf, parcels, form):
+    parcel_ids = parcels.index[::20]
+    surface, summary = pf.explain(form, parcels, parcel_ids)
+
+    num_configs, num_fars = len(pf.config.parking_configs), \
+        len(pf.config.fars)
+    assert len(surface) == len(parcel_ids) * num_configs * num_fars
+    assert (surface.groupby("parcel_id").best.sum() == 1).all()
+    assert list(summary.index) == list(parcel_ids)
+
+    everything = pf.lookup(form, parcels, only_built=False)
+    built = pf.lookup(form, parcels)
+    assert summary.built.sum() > 0 and not summary.built.all()
+    np.testing.assert_array_equal(summary.built.values,
+                                  summary.index.isin(built.index))
+
+    found = summary[summary.index.isin(everything.index)]
+    assert len(found) > 0
+    expected = everything.loc[found.index]
+    for col in ["max_profit", "max_profit_far", "parking_config"]:
+        pd.testing.assert_series_equal(found[col], expected[col],
+                                       check_names=False)
+    pd.testing.assert_series_equal(
+        surface.groupby("parcel_id").profit.max().loc[parcel_ids],
+        summary.max_profit, check_names=False)
+
+    # the binding constraint sets the max far used by the lookup
+    constrained = summary[summary.binding_constraint.notnull()]
+    columns = {"far": "max_far", "height": "max_far_from_heights",
+               "dua": "max_far_from_dua"}
+    binding = [constrained[columns[c]].iloc[i] for i, c in
+               enumerate(constrained.binding_constraint)]
+    if form == "residential":
+        assert set(constrained.binding_constraint) == {"far", "height",
+                                                       "dua"}
+    np.testing.assert_allclose(binding, constrained.min_max_fars)
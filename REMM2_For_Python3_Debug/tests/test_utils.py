@@ -0,0 +1,54 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+try:
+    import orca
+    from .. import utils
+except ImportError:
+    pytest.skip("the REMM utilities need orca, pysal and urbansim",
+                allow_module_level=True)
+
+
+@pytest.fixture
+def agents():
+    households = pd.DataFrame({
+        "building_id": np.array([1, 2, 3, -1, 2, 5], dtype="int64"),
+        "persons": [1, 2, 3, 4, 5, 6]
+    }, index=pd.Index(np.arange(10, 16), name="household_id"))
+    jobs = pd.DataFrame({
+        "building_id": np.array([2, 4, 4, 1], dtype="int32"),
+        "sector_id": [1, 1, 2, 2]
+    }, index=pd.Index(np.arange(4), name="job_id"))
+    orca.add_table("households", households)
+    orca.add_table("jobs", jobs)
+    yield households, jobs
+    orca.clear_all()
+
+
+def test_unplace_agents(agents):
+    households, jobs = agents
+    original = households.copy(), jobs.copy()
+
+    utils._unplace_agents(pd.Index([2, 4, 7]), ["households", "jobs"])
+
+    hh = orca.get_table("households").local
+    j = orca.get_table("jobs").local
+    # the agents in the demolished buildings are unplaced, in place
+    assert hh is households and j is jobs
+    assert list(hh.building_id) == [1, -1, 3, -1, -1, 5]
+    assert list(j.building_id) == [-1, -1, -1, 1]
+    # update_col_from_series raises on a dtype mismatch
+    assert hh.building_id.dtype == np.dtype("int64")
+    assert j.building_id.dtype == np.dtype("int32")
+    # everyone else and the other columns are left alone
+    pd.testing.assert_series_equal(hh.persons, original[0].persons)
+    pd.testing.assert_series_equal(j.sector_id, original[1].sector_id)
+
+
+def test_unplace_agents_no_agents(agents):
+    households, jobs = agents
+    original = households.copy()
+    utils._unplace_agents(pd.Index([8, 9]), ["households"])
+    pd.testing.assert_frame_equal(orca.get_table("households").local,
+                                  original)
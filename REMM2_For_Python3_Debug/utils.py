@@ -4,7 +4,7 @@ import pysal as ps
 import os
 import orca.orca as sim
 from urbansim.utils import misc
-from urbansim.developer import sqftproforma, developer
+from urbansim.developer import sqftproforma, developer, debugsink, feasibility, instrument
 from urbansim.models import SegmentedMNLLocationChoiceModel
 from urbansim_defaults import utils
 #import WFRCDeveloper
@@ -57,6 +57,17 @@ def dbf2df(dbf_path, index=None, cols=False, incl_index=False):
         db.close()
         return pd.DataFrame(data)
     
+def _span(name, rows=None):
+    """
+    A span of the instrumentation recorder (see instrument.Recorder) for a
+    stage of the current simulation year
+    """
+    recorder = instrument.get_recorder()
+    if recorder.enabled and 'year' in sim.list_injectables():
+        recorder.year = sim.get_injectable('year')
+    return recorder.span(name, rows=rows)
+
+
 def lcm_simulate(cfg, choosers, buildings, join_tbls, out_fname,
                  supply_fname, vacant_fname,
                  enable_supply_correction=None):
@@ -91,7 +102,9 @@ def lcm_simulate(cfg, choosers, buildings, join_tbls, out_fname,
     """
     cfg = misc.config(cfg)
 
-    choosers_df = utils.to_frame(choosers, [], cfg, additional_columns=[out_fname])
+    with _span("lcm_simulate.choosers.to_frame") as span:
+        choosers_df = utils.to_frame(choosers, [], cfg, additional_columns=[out_fname])
+        span.rows = len(choosers_df)
     
     additional_columns = [supply_fname, vacant_fname]
     if enable_supply_correction is not None and \
@@ -100,8 +113,10 @@ def lcm_simulate(cfg, choosers, buildings, join_tbls, out_fname,
     if enable_supply_correction is not None and \
             "price_col" in enable_supply_correction:
         additional_columns += [enable_supply_correction["price_col"]]
-    locations_df = utils.to_frame(buildings, join_tbls, cfg,
-                            additional_columns=additional_columns)
+    with _span("lcm_simulate.buildings.to_frame") as span:
+        locations_df = utils.to_frame(buildings, join_tbls, cfg,
+                                additional_columns=additional_columns)
+        span.rows = len(locations_df)
     
     
     available_units = buildings[supply_fname]
@@ -193,7 +208,8 @@ def lcm_simulate(cfg, choosers, buildings, join_tbls, out_fname,
     #    print "    reducing locations to size of movers for performance gain"
     #    movers = movers.head(vacant_units.sum())
 
-    new_units, _ = utils.yaml_to_class(cfg).predict_from_cfg(movers, units, cfg)
+    with _span("lcm_simulate.predict", rows=len(movers)):
+        new_units, _ = utils.yaml_to_class(cfg).predict_from_cfg(movers, units, cfg)
     # new_units returns nans when there aren't enough units,
     # get rid of them and they'll stay as -1s
     new_units = new_units.dropna()
@@ -202,7 +218,8 @@ def lcm_simulate(cfg, choosers, buildings, join_tbls, out_fname,
     new_buildings = pd.Series(units.loc[new_units.values][out_fname].values,
                               index=new_units.index)
 
-    choosers.update_col_from_series(out_fname, new_buildings)
+    with _span("lcm_simulate.update", rows=len(new_buildings)):
+        choosers.update_col_from_series(out_fname, new_buildings)
     utils._print_number_unplaced(choosers, out_fname)
 
     if enable_supply_correction is not None:
@@ -220,13 +237,133 @@ def lcm_simulate(cfg, choosers, buildings, join_tbls, out_fname,
     print("    and %d overfull buildings" % len(vacant_units[vacant_units < 0]))
 
 
+def _year_seed(seed, year):
+    """
+    The seed of the developer's "keys" sampler for a simulation year - an int
+    seed is offset by the year so every year gets different draws which are
+    still reproducible, a random state is used as is
+    """
+    if seed is None or year is None or \
+            isinstance(seed, np.random.RandomState):
+        return seed
+    return seed + year
+
+
+def _new_building_columns(new_buildings, year, form_to_btype_callback=None,
+                          add_more_columns_callback=None):
+    """
+    Add the building type, stories, note and year built columns to the
+    buildings picked by the developer - returns the new buildings and the
+    new buildings before add_more_columns_callback, with the debugging
+    columns from the developer
+    """
+    if form_to_btype_callback is not None:
+        new_buildings["building_type_id"] = new_buildings.\
+            apply(form_to_btype_callback, axis=1)
+
+    new_buildings["stories"] = new_buildings.stories.apply(np.ceil)
+    new_buildings["note"] = "simulated"
+    
+    ret_buildings = new_buildings
+    if add_more_columns_callback is not None:
+        new_buildings = add_more_columns_callback(new_buildings)
+        
+    if year is not None:
+        new_buildings["year_built"] = year
+
+    return new_buildings, ret_buildings
+
+
+def _unplace_agents(building_ids, unplace_agents, stage="run_developer"):
+    """
+    Set building_id to -1 for the agents in the buildings - only the
+    building_id of the displaced agents is updated, the agents table isn't
+    copied or replaced
+    """
+    for tbl in unplace_agents:
+        with _span(stage + ".unplace." + tbl, rows=len(building_ids)):
+            agents = sim.get_table(tbl)
+            building_id = agents.get_column("building_id")
+            rows = np.flatnonzero(building_id.isin(building_ids).values)
+            unplaced = int((building_id.values == -1).sum())
+            print("Unplaced {} before: {}".format(tbl, unplaced))
+            if len(rows) > 0:
+                agents.update_col_from_series(
+                    "building_id",
+                    pd.Series(-1, index=building_id.index[rows],
+                              dtype=building_id.dtype))
+            print("Unplaced {} after: {}".format(tbl, unplaced + len(rows)))
+
+
+def _add_buildings(new_buildings, buildings, buildings_all,
+                   remove_developed_buildings=True,
+                   unplace_agents=['households', 'jobs'],
+                   stage="run_developer", building_store=None):
+    """
+    Write new buildings to the buildings table, removing the buildings on
+    the parcels which are redeveloped and unplacing their agents - see
+    run_developer
+    """
+    if building_store is not None:
+        # other models update the buildings table in place, so start from
+        # the current table rather than the one the store wrote last year
+        building_store.sync(buildings_all.local)
+        new_buildings = new_buildings[building_store.columns]
+        with _span(stage + ".building_store", rows=len(new_buildings)):
+            if remove_developed_buildings:
+                drop_buildings_all = building_store.remove_parcels(
+                    new_buildings.parcel_id)
+                print("Dropped {} buildings because they were redeveloped".
+                      format(len(drop_buildings_all)))
+            building_store.append(new_buildings)
+
+        if remove_developed_buildings:
+            _unplace_agents(drop_buildings_all.index, unplace_agents, stage)
+
+        with _span(stage + ".add_table.buildings", rows=len(building_store)):
+            sim.add_table("buildings", building_store.to_frame())
+        return
+
+    with _span(stage + ".buildings.to_frame") as span:
+        old_buildings = buildings.to_frame(buildings.local_columns)
+        old_buildings_all = buildings_all.to_frame(buildings.local_columns)
+        span.rows = len(old_buildings_all)
+    new_buildings = new_buildings[buildings.local_columns]
+    
+    if remove_developed_buildings:
+        redev_buildings = old_buildings.parcel_id.isin(new_buildings.parcel_id)
+        redev_buildings_all = old_buildings_all.parcel_id.isin(new_buildings.parcel_id)
+        l = len(old_buildings)
+        drop_buildings = old_buildings[redev_buildings]
+        drop_buildings_all = old_buildings_all[redev_buildings_all]
+        old_buildings = old_buildings[np.logical_not(redev_buildings)]
+        old_buildings_all = old_buildings_all[np.logical_not(redev_buildings_all)]
+        l2 = len(old_buildings)
+        print("before dropped l:" + str(l))
+        print("after dropped l2: " + str(l2))
+        #print redev_buildings
+        #print drop_buildings
+        if l2-l > 0:
+            print("Dropped {} buildings because they were redeveloped".
+                  format(l2 - l))
+
+        _unplace_agents(drop_buildings_all.index, unplace_agents, stage)
+    
+    with _span(stage + ".merge", rows=len(new_buildings)):
+        all_buildings = developer.Developer.merge(old_buildings_all, new_buildings)
+    
+    with _span(stage + ".add_table.buildings", rows=len(all_buildings)):
+        sim.add_table("buildings", all_buildings)
+
+
 def run_developer(forms, agents, buildings, buildings_all, supply_fname, parcel_size,
                   ave_unit_size, total_units, feasibility, year=None,
                   target_vacancy=.1, form_to_btype_callback=None,
                   add_more_columns_callback=None, max_parcel_size=34647265,
                   residential=True, bldg_sqft_per_job=400.0,
                   min_unit_size=400, remove_developed_buildings=True,
-                  unplace_agents=['households', 'jobs']):
+                  unplace_agents=['households', 'jobs'], sampler="choice",
+                  seed=None, building_store=None):
     """
     Run the developer model to pick and build buildings
 
@@ -280,6 +417,23 @@ def run_developer(forms, agents, buildings, buildings_all, supply_fname, parcel_
         For all tables in the list, will look for field building_id and set
         it to -1 for buildings which are removed - only executed if
         remove_developed_buildings is true
+    sampler : optional, string (default "choice")
+        Passed directly to dev.pick - "keys" samples with exponential keys,
+        which is faster when there are many feasible buildings
+    seed : optional, int or np.random.RandomState
+        The random state of the "keys" sampler - an int is added to the
+        simulation year and passed to dev.pick, so every year draws
+        different keys
+    building_store : optional, buildings.BuildingStore
+        Removes the redeveloped buildings and appends the new buildings
+        without copying the local columns of the buildings table first - the
+        new buildings get their ids from the store's id allocator, so ids
+        are never reused.  The whole buildings table is still read and
+        rebuilt every year, like the merge.  Create
+        it once, e.g. BuildingStore(buildings_all.local), and pass the same
+        store every year - it is synced with the current buildings table
+        before the new buildings are added, so the changes other models
+        make to the table are kept.
 
     Returns
     -------
@@ -287,30 +441,37 @@ def run_developer(forms, agents, buildings, buildings_all, supply_fname, parcel_
     buildings with available debugging information on each new building
     """
 
-    dev = developer.Developer(feasibility.to_frame())
+    with _span("run_developer.feasibility.to_frame") as span:
+        dev = developer.Developer(feasibility.to_frame())
+        span.rows = len(dev)
     #dev = WFRCDeveloper.WFRCDeveloper(feasibility.to_frame())
-    dev.feasibility.to_csv("debug_REMM_Util_292_feasibility.csv")
+    debugsink.get_debug_sink().write("debug_REMM_Util_292_feasibility",
+                                     dev.feasibility_frame())
     target_units = dev.\
         compute_units_to_build(len(agents),
                                buildings[supply_fname].sum(),
                                target_vacancy)
 
-    print("{:,} feasible buildings before running developer".format(
-        len(dev.feasibility)))
-
-    new_buildings = dev.pick(forms,
-                             target_units,
-                             parcel_size,
-                             ave_unit_size,
-                             total_units,
-                             max_parcel_size=max_parcel_size,
-                             min_unit_size=min_unit_size,
-                             drop_after_build=True,
-                             residential=residential,
-                             bldg_sqft_per_job=bldg_sqft_per_job)
-
-    sim.add_table("feasibility", dev.feasibility)
     year = sim.get_injectable('year')
+    print("{:,} feasible buildings before running developer".format(
+        len(dev)))
+
+    with _span("run_developer.pick", rows=len(dev)):
+        new_buildings = dev.pick(forms,
+                                 target_units,
+                                 parcel_size,
+                                 ave_unit_size,
+                                 total_units,
+                                 max_parcel_size=max_parcel_size,
+                                 min_unit_size=min_unit_size,
+                                 drop_after_build=True,
+                                 residential=residential,
+                                 bldg_sqft_per_job=bldg_sqft_per_job,
+                                 sampler=sampler,
+                                 seed=_year_seed(seed, year))
+
+    with _span("run_developer.add_table.feasibility"):
+        sim.add_table("feasibility", dev.feasibility_frame())
     if new_buildings is None:
         return
 
@@ -321,19 +482,9 @@ def run_developer(forms, agents, buildings, buildings_all, supply_fname, parcel_
         # form gets set only if forms is a list
         new_buildings["form"] = forms
 
-    if form_to_btype_callback is not None:
-        new_buildings["building_type_id"] = new_buildings.\
-            apply(form_to_btype_callback, axis=1)
-
-    new_buildings["stories"] = new_buildings.stories.apply(np.ceil)
-    new_buildings["note"] = "simulated"
-    
-    ret_buildings = new_buildings
-    if add_more_columns_callback is not None:
-        new_buildings = add_more_columns_callback(new_buildings)
-        
-    if year is not None:
-        new_buildings["year_built"] = year
+    new_buildings, ret_buildings = _new_building_columns(
+        new_buildings, year, form_to_btype_callback,
+        add_more_columns_callback)
 
     print("Adding {:,} buildings with {:,} {}".
           format(len(new_buildings),
@@ -341,47 +492,122 @@ def run_developer(forms, agents, buildings, buildings_all, supply_fname, parcel_
                  supply_fname))
 
     print("{:,} feasible buildings after running developer".format(
-        len(dev.feasibility)))
+        len(dev)))
 
-    old_buildings = buildings.to_frame(buildings.local_columns)
-    old_buildings_all = buildings_all.to_frame(buildings.local_columns)
-    new_buildings = new_buildings[buildings.local_columns]
-    
-    if remove_developed_buildings:
-        redev_buildings = old_buildings.parcel_id.isin(new_buildings.parcel_id)
-        redev_buildings_all = old_buildings_all.parcel_id.isin(new_buildings.parcel_id)
-        l = len(old_buildings)
-        drop_buildings = old_buildings[redev_buildings]
-        drop_buildings_all = old_buildings_all[redev_buildings_all]
-        old_buildings = old_buildings[np.logical_not(redev_buildings)]
-        old_buildings_all = old_buildings_all[np.logical_not(redev_buildings_all)]
-        l2 = len(old_buildings)
-        print("before dropped l:" + str(l))
-        print("after dropped l2: " + str(l2))
-        #print redev_buildings
-        #print drop_buildings
-        if l2-l > 0:
-            print("Dropped {} buildings because they were redeveloped".
-                  format(l2 - l))
+    _add_buildings(new_buildings, buildings, buildings_all,
+                   remove_developed_buildings, unplace_agents,
+                   building_store=building_store)
 
-        for tbl in unplace_agents:
-            agents = sim.get_table(tbl)
-            agents = agents.to_frame(agents.local_columns)
-            #displaced_agents = agents.building_id.isin(drop_buildings.index)
-            displaced_agents = agents.building_id.isin(drop_buildings_all.index)
-            print("Unplaced {} before: {}".format(tbl, len(agents.query(
-                "building_id == -1"))))
-            agents.building_id[displaced_agents] = -1
-            print("Unplaced {} after: {}".format(tbl, len(agents.query(
-                "building_id == -1"))))
-            sim.add_table(tbl, agents)
-    
-    all_buildings = dev.merge(old_buildings_all, new_buildings)
+    return ret_buildings
     
-    sim.add_table("buildings", all_buildings)
+def run_developer_joint(demands, buildings, buildings_all, parcel_size,
+                        ave_unit_size, feasibility, year=None,
+                        form_to_btype_callback=None,
+                        add_more_columns_callback=None,
+                        max_parcel_size=34647265, min_unit_size=400,
+                        remove_developed_buildings=True,
+                        unplace_agents=['households', 'jobs'],
+                        sampler="choice", seed=None, building_store=None):
+    """
+    Run the developer model for several demands at once - e.g. residential
+    units and job spaces - instead of calling run_developer for each one.
+    The feasibility and buildings tables are read and written once and the
+    demands are picked (in order) against the same feasibility with
+    dev.pick_demands.
+
+    Parameters
+    ----------
+    demands : dict
+        Keys are names of the demands and values are dictionaries with
+        the arguments of run_developer for the demand - forms, agents,
+        supply_fname and total_units are required and target_vacancy,
+        residential, bldg_sqft_per_job, max_parcel_size and min_unit_size
+        are optional (the defaults are those of run_developer, except
+        max_parcel_size and min_unit_size which default to the arguments
+        below)
+    buildings : DataFrame Wrapper
+        Used to compute the current supply of units/floorspace in the area
+    buildings_all:
+        Buildings for the entire region, used to write back to buildings table
+    parcel_size, ave_unit_size, feasibility, year, form_to_btype_callback,
+    add_more_columns_callback, max_parcel_size, min_unit_size,
+    remove_developed_buildings, unplace_agents, sampler, seed, building_store
+        See run_developer
+
+    Returns
+    -------
+    Writes the result back to the buildings table and returns the new
+    buildings of all demands with available debugging information on each
+    new building and a demand column with the name of the demand
+    """
+    with _span("run_developer_joint.feasibility.to_frame") as span:
+        dev = developer.Developer(feasibility.to_frame())
+        span.rows = len(dev)
+    debugsink.get_debug_sink().write("debug_REMM_Util_292_feasibility",
+                                     dev.feasibility_frame())
+
+    pick_demands = {}
+    for name, demand in demands.items():
+        target_units = dev.\
+            compute_units_to_build(len(demand["agents"]),
+                                   buildings[demand["supply_fname"]].sum(),
+                                   demand.get("target_vacancy", .1))
+        pick_demands[name] = {
+            "form": demand["forms"],
+            "target_units": target_units,
+            "current_units": demand["total_units"],
+            "residential": demand.get("residential", True),
+            "bldg_sqft_per_job": demand.get("bldg_sqft_per_job", 400.0),
+            "max_parcel_size": demand.get("max_parcel_size", max_parcel_size),
+            "min_unit_size": demand.get("min_unit_size", min_unit_size)
+        }
+
+    year = sim.get_injectable('year')
+    print("{:,} feasible buildings before running developer".format(
+        len(dev)))
+
+    with _span("run_developer_joint.pick", rows=len(dev)):
+        picked = dev.pick_demands(pick_demands, parcel_size, ave_unit_size,
+                                  drop_after_build=True, sampler=sampler,
+                                  seed=_year_seed(seed, year))
+
+    with _span("run_developer_joint.add_table.feasibility"):
+        sim.add_table("feasibility", dev.feasibility_frame())
+
+    new_buildings = []
+    for name, demand in demands.items():
+        df = picked[name]
+        if df is None or len(df) == 0:
+            continue
+        if not isinstance(demand["forms"], list):
+            # form gets set only if forms is a list
+            df["form"] = demand["forms"]
+        df["demand"] = name
+        supply_fname = demand["supply_fname"]
+        print("Adding {:,} buildings with {:,} {} for {}".
+              format(len(df), int(df[supply_fname].sum()), supply_fname,
+                     name))
+        new_buildings.append(df)
+
+    if len(new_buildings) == 0:
+        return
+
+    new_buildings = pd.concat(new_buildings, ignore_index=True)
+    new_buildings, ret_buildings = _new_building_columns(
+        new_buildings, year, form_to_btype_callback,
+        add_more_columns_callback)
+
+    print("{:,} feasible buildings after running developer".format(
+        len(dev)))
+
+    _add_buildings(new_buildings, buildings, buildings_all,
+                   remove_developed_buildings, unplace_agents,
+                   stage="run_developer_joint",
+                   building_store=building_store)
 
     return ret_buildings
-    
+
+
 def compute_range(travel_data, attr, travel_time_attr, dist, agg=np.sum):
     """
     Compute a zone-based accessibility query using the urbansim format
@@ -589,10 +815,18 @@ class SimulationSummaryData(object):
         json.dump(self.zone_output, outf)
         outf.close()
         
+# the forms whose max profit is divided by the built floor area when
+# run_feasibility is asked for profit per sqft
+PROFIT_PER_SQFT_FORMS = ['residential', 'industrial', 'retail', 'office']
+
+
 def run_feasibility(parcels, parcel_price_callback,
                     parcel_use_allowed_callback, residential_to_yearly=True,
                     parcel_filter=None, only_built=True, forms_to_test=None,
-                    config=None, pass_through=[]):
+                    config=None, pass_through=[], chunksize=None,
+                    engine="grid", n_jobs=1, shards=1, executor=None,
+                    cache_dir=None, incremental=False, top_k=None,
+                    sparse=False, profit_per_sqft=False):
     """
     Execute development feasibility on all parcels
 
@@ -627,25 +861,80 @@ def run_feasibility(parcels, parcel_price_callback,
         Will be passed to the feasibility lookup function - is used to pass
         variables from the parcel dataframe to the output dataframe, usually
         for debugging
+    chunksize : int (optional)
+        Passed directly to the pro forma lookup - evaluate parcels in blocks
+        of this many rows to bound peak memory.  If set to None all parcels
+        for a form are evaluated at once
+    engine : string (optional)
+        Passed directly to the pro forma lookup - "grid" (the default)
+        evaluates every far, "envelope" searches a precomputed upper envelope
+        of the profit and is much faster with fine far grids, "fused" keeps
+        the running best building per parcel so memory is linear in parcels
+    n_jobs : int (optional)
+        The number of worker processes used to compute feasibility - forms
+        are independent of each other so they are run concurrently, with the
+        parcel columns placed in shared memory.  Set to -1 to use all cores.
+        Defaults to 1, which computes the forms one at a time
+    shards : int (optional)
+        The number of parcel shards to split each form into when running in
+        worker processes, so a single large form can use several cores
+    executor : concurrent.futures.Executor (optional)
+        Submit the work to this executor instead of creating a process pool
+        - useful to reuse one pool across simulation years
+    cache_dir : string (optional)
+        Passed directly to the pro forma - a directory in which the pro forma
+        lookup tables are cached so they aren't regenerated every year
+    incremental : boolean (optional)
+        If true, the feasibility from the previous call (usually the previous
+        simulation year) is kept in the injectable "incremental_feasibility"
+        and only parcels whose prices, zoning, buildings or allowed forms
+        changed since then are looked up again.  Defaults to False
+    top_k : int (optional)
+        If set, all forms are evaluated in one batched computation and only
+        the top_k most profitable forms on each parcel are kept - the
+        feasibility table is then a long table with a row per parcel and
+        kept form (see SqFtProForma.lookup_top_forms) instead of a wide table
+        with a column level per form.  Useful with large form catalogs.
+        Forms are ranked by max profit, or by profit per sqft if
+        profit_per_sqft is true.  n_jobs, shards, executor and incremental
+        are not used
+    sparse : boolean (optional)
+        If true, the feasibility table is a long table with a row per parcel
+        and feasible form and a form column (see feasibility.FeasibilityStore)
+        instead of the wide, mostly nan table with a column level per form.
+        Developer accepts either.  Defaults to False
+    profit_per_sqft : boolean (optional)
+        If true, the max profit of PROFIT_PER_SQFT_FORMS is divided by the
+        built floor area (max_profit_far * shape_area) in the feasibility
+        table, so the developer compares forms by profit per sqft -
+        shape_area has to be a parcel column and in pass_through.  This is
+        what the division after the lookup was written to do, but it
+        assigned to a copy of the table and never changed it, so turning it
+        on changes which form is picked on each parcel compared to earlier
+        runs.  Defaults to False, which keeps the max profit as it was
 
     Returns
     -------
     Adds a table called feasibility to the sim object (returns nothing)
     """
 
-    pf = sqftproforma.SqFtProForma(config) if config \
-        else sqftproforma.SqFtProForma()
+    pf = sqftproforma.SqFtProForma(config, cache_dir=cache_dir)
+
+    debug_sink = debugsink.get_debug_sink()
 
-    df = parcels.to_frame()
-    df.to_csv("debug_remmutility640_df.csv")
+    with _span("run_feasibility.parcels.to_frame") as span:
+        df = parcels.to_frame()
+        span.rows = len(df)
+    debug_sink.write("debug_remmutility640_df", df)
     if parcel_filter:
         df = df.query(parcel_filter)
     #print df.loc[765403]
     #df.to_csv("select_parcels.csv")
     # add prices for each use
-    for use in pf.config.uses:
-        # assume we can get the 80th percentile price for new development
-        df[use] = parcel_price_callback(use)
+    with _span("run_feasibility.price_callbacks", rows=len(df)):
+        for use in pf.config.uses:
+            # assume we can get the 80th percentile price for new development
+            df[use] = parcel_price_callback(use)
 
     # convert from cost to yearly rent
     if residential_to_yearly:
@@ -654,32 +943,77 @@ def run_feasibility(parcels, parcel_price_callback,
     print("Describe of the yearly rent by use")
     print(df[pf.config.uses].describe())
 
-    d = {}
+    forms = list(forms_to_test or pf.config.forms)
+    allowed = {}
+    with _span("run_feasibility.allowed_callbacks", rows=len(df)):
+        for form in forms:
+            allowed[form] = parcel_use_allowed_callback(form).loc[df.index]
+            #allowed[form].to_csv(str(form) + "allow.csv")
+
+    print("Computing feasibility for forms %s" % ", ".join(forms))
+    if top_k is not None:
+        with _span("run_feasibility.lookup_top_forms", rows=len(df)):
+            far_predictions = pf.lookup_top_forms(
+                forms, df, k=top_k, allowed=allowed, only_built=only_built,
+                pass_through=pass_through, chunksize=chunksize,
+                score=feasibility.profit_per_sqft_score(
+                    PROFIT_PER_SQFT_FORMS) if profit_per_sqft else None)
+        if len(far_predictions) > 0:
+            if residential_to_yearly and "residential" in pass_through:
+                far_predictions["residential"] /= pf.config.cap_rate
+            if profit_per_sqft:
+                far_predictions = feasibility.profit_per_sqft(
+                    far_predictions, PROFIT_PER_SQFT_FORMS)
+        with _span("run_feasibility.add_table", rows=len(far_predictions)):
+            sim.add_table("feasibility", far_predictions)
+        debug_sink.write("debug_remm_util_685_feasibility", far_predictions)
+        return
+
+    lookup_kwargs = dict(only_built=only_built, pass_through=pass_through,
+                         chunksize=chunksize, engine=engine, n_jobs=n_jobs,
+                         shards=shards, executor=executor)
+    with _span("run_feasibility.lookup", rows=len(df)):
+        if incremental:
+            if 'incremental_feasibility' not in sim.list_injectables():
+                sim.add_injectable("incremental_feasibility",
+                                   sqftproforma.IncrementalFeasibility())
+            d = sim.get_injectable("incremental_feasibility").lookup_forms(
+                pf, forms, df, allowed, **lookup_kwargs)
+        else:
+            d = pf.lookup_forms(forms, df, allowed, **lookup_kwargs)
 
-    forms = forms_to_test or pf.config.forms
     for form in forms:
-        print("Computing feasibility for form %s" % form)
-        allowed = parcel_use_allowed_callback(form).loc[df.index]
-        #allowed.to_csv(str(form) + "allow.csv")
-        #df[allowed].to_csv(str(form) + "allow.csv")
-        d[form] = pf.lookup(form, df[allowed], only_built=only_built,
-                            pass_through=pass_through)
         #d[form].to_csv(str(form) + "dform.csv")
         if residential_to_yearly and "residential" in pass_through:
             d[form]["residential"] /= pf.config.cap_rate
 
-    far_predictions = pd.concat(d.values(), keys=d.keys(), axis=1)
-    far_predictions['residential'].to_csv("residential_far_prediction.csv")
-    far_predictions['retail'].to_csv("retail_far_prediction.csv")
-    far_predictions['office'].to_csv("office_far_prediction.csv")
-    #far_predictions.to_csv("far_prediction.csv")
-    far_predictions.to_csv("debug_remm_util_676_feasibility.csv")
-    far_predictions['residential'].max_profit = far_predictions['residential'].max_profit / np.power(far_predictions['residential'].max_profit_far*far_predictions['residential'].shape_area,1)
-    far_predictions['industrial'].max_profit = far_predictions['industrial'].max_profit / np.power(far_predictions['industrial'].max_profit_far*far_predictions['industrial'].shape_area,1)
-    far_predictions['retail'].max_profit = far_predictions['retail'].max_profit / np.power(far_predictions['retail'].max_profit_far*far_predictions['retail'].shape_area,1)
-    far_predictions['office'].max_profit = far_predictions['office'].max_profit / np.power(far_predictions['office'].max_profit_far*far_predictions['office'].shape_area,1)
+    if sparse:
+        if profit_per_sqft:
+            d = feasibility.profit_per_sqft(d, PROFIT_PER_SQFT_FORMS)
+        with _span("run_feasibility.concat"):
+            far_predictions = feasibility.FeasibilityStore.from_forms(d).to_frame()
+        with _span("run_feasibility.add_table", rows=len(far_predictions)):
+            sim.add_table("feasibility", far_predictions)
+        debug_sink.write("debug_remm_util_685_feasibility", far_predictions)
+        return
+
+    with _span("run_feasibility.concat") as span:
+        far_predictions = pd.concat(d.values(), keys=d.keys(), axis=1)
+        span.rows = len(far_predictions)
+    if debug_sink.enabled:
+        debug_sink.write("residential_far_prediction",
+                         far_predictions['residential'])
+        debug_sink.write("retail_far_prediction", far_predictions['retail'])
+        debug_sink.write("office_far_prediction", far_predictions['office'])
+        debug_sink.write("debug_remm_util_676_feasibility", far_predictions)
+    if profit_per_sqft:
+        for form in PROFIT_PER_SQFT_FORMS:
+            if form in d and len(d[form]) > 0:
+                far_predictions[form, "max_profit"] = \
+                    feasibility.profit_per_sqft(far_predictions[form]).max_profit
     #far_predictions['residential'].max_profit = np.divide(far_predictions['residential'].max_profit,far_predictions['residential'].max_dua)
     #far_predictions['residential'].max_profit[far_predictions['residential'].max_profit==-np.inf] = np.nan
 
-    sim.add_table("feasibility", far_predictions)
-    far_predictions.to_csv("debug_remm_util_685_feasibility.csv")
\ No newline at end of file
+    with _span("run_feasibility.add_table", rows=len(far_predictions)):
+        sim.add_table("feasibility", far_predictions)
+    debug_sink.write("debug_remm_util_685_feasibility", far_predictions)
\ No newline at end of file